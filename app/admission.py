@@ -0,0 +1,198 @@
+"""
+app/admission.py – queue-depth-aware admission control for the enqueue routes
+
+A background task polls each lane's Service Bus runtime properties every
+ADMISSION_REFRESH seconds and estimates how fast the workers drain it (depth
+change plus what this replica sent in the meantime).  ``admit()`` then
+rejects with 429 + Retry-After when
+
+* the lane's backlog exceeds ADMISSION_MAX_DEPTH messages, or
+* its estimated drain time exceeds the lane's ADMISSION_MAX_WAIT*, or
+* the caller (JWT ``sub``) already has jobs in that backlog – counted as
+  its enqueues within the last drain-time window – and the new ones would
+  take it past ADMISSION_SUB_MAX.  A caller with nothing pending may always
+  submit one batch, however large (BATCH_MAX_ITEMS bounds it),
+
+and otherwise returns the estimated seconds until the new job is rendered.
+Counts are per API replica; other replicas' sends make the drain-rate
+estimate conservative, never optimistic.
+
+Reading runtime properties needs Manage rights on the namespace (Azure
+Service Bus Data Owner).  Without them every poll fails and admission only
+applies the per-caller limit; the first failure of each streak is logged.
+"""
+from __future__ import annotations
+
+import os, time, math, asyncio, logging, contextlib
+from collections import deque
+
+from fastapi import HTTPException, status
+
+import clients
+
+logger = logging.getLogger(__name__)
+
+REFRESH      = float(os.getenv("ADMISSION_REFRESH", "5"))            # seconds
+MAX_DEPTH    = int(os.getenv("ADMISSION_MAX_DEPTH", "0"))            # messages, 0 = off
+MAX_WAIT     = {"interactive": int(os.getenv("ADMISSION_MAX_WAIT", "300")),        # s, 0 = off
+                "bulk":        int(os.getenv("ADMISSION_MAX_WAIT_BULK", "3600"))}
+SUB_MAX      = int(os.getenv("ADMISSION_SUB_MAX", "1000"))           # jobs per caller, 0 = off
+RETRY_CAP    = 300                                                   # longest Retry-After we send
+_ALPHA       = 0.3                                                   # EWMA weight of a new sample
+
+
+class _Lane:
+    def __init__(self, queue: str):
+        self.queue   = queue
+        self.depth: int | None = None
+        self.rate:  float | None = None          # messages / s drained
+        self.sent    = 0                         # sends since the last poll
+        self.polled  = 0.0
+        self.stalled: float | None = None        # backlog not moving since (monotonic)
+        self.subs: dict[str, deque[float]] = {}  # sub → enqueue times
+
+    def eta(self, ahead: int = 0) -> float | None:
+        """Seconds to drain the backlog (+ *ahead*); inf when it is not draining."""
+        if self.depth is None or self.rate is None:
+            return None
+        backlog = self.depth + self.sent + ahead
+        if backlog <= 0:
+            return 0.0
+        return backlog / self.rate if self.rate > 1e-3 else math.inf
+
+    def pending(self, sub: str, window: float, now: float) -> deque[float]:
+        times = self.subs.setdefault(sub, deque())
+        while times and times[0] < now - window:
+            times.popleft()
+        return times
+
+
+class QueueMonitor:
+    def __init__(self, lanes: dict[str, str], every: float = REFRESH):
+        self.lanes = {}
+        for lane, queue in lanes.items():      # lanes sharing a queue share state
+            same = next((l for l in self.lanes.values() if l.queue == queue), None)
+            self.lanes[lane] = same or _Lane(queue)
+        self.every = every
+        self._failing: set[str] = set()          # queues whose last poll failed
+        self._task: asyncio.Task | None = None
+        self._stats = {"polls": 0, "poll_errors": 0, "admitted": 0,
+                       "rejected_depth": 0, "rejected_wait": 0, "rejected_sub": 0}
+
+    # ── background refresh ─────────────────────────────────────────────
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+
+    async def _run(self) -> None:
+        while True:
+            for lane in {id(l): l for l in self.lanes.values()}.values():
+                try:
+                    await self._poll(lane)
+                except Exception as exc:
+                    self._stats["poll_errors"] += 1
+                    if lane.queue not in self._failing:      # once per failure streak
+                        self._failing.add(lane.queue)
+                        logger.warning("admission: polling queue %r failed (%s) – depth-based "
+                                       "admission is off until it recovers; reading runtime "
+                                       "properties needs 'Azure Service Bus Data Owner'",
+                                       lane.queue, exc, exc_info=True)
+                else:
+                    if lane.queue in self._failing:
+                        self._failing.discard(lane.queue)
+                        logger.info("admission: polling queue %r recovered", lane.queue)
+            await asyncio.sleep(self.every)
+
+    async def _poll(self, lane: _Lane) -> None:
+        props = await clients.admin().get_queue_runtime_properties(lane.queue)
+        now, depth = time.monotonic(), props.active_message_count + props.scheduled_message_count
+        backlog = (lane.depth or 0) + lane.sent
+        if lane.depth is not None and backlog > 0 and now > lane.polled:
+            drained = max(backlog - depth, 0) / (now - lane.polled)
+            if depth == 0:                      # emptied: workers could have done more
+                lane.rate = drained if lane.rate is None else max(lane.rate, drained)
+            else:
+                lane.rate = drained if lane.rate is None else lane.rate + _ALPHA * (drained - lane.rate)
+            if drained > 0:
+                lane.stalled = None
+            elif lane.stalled is None:
+                lane.stalled = lane.polled
+        lane.depth, lane.sent, lane.polled = depth, 0, now
+        eta    = lane.eta()
+        window = max(eta if eta is not None and math.isfinite(eta) else 0.0, self.every)
+        lane.subs = {s: t for s, t in lane.subs.items() if t and t[-1] >= now - window}
+        self._stats["polls"] += 1
+
+    # ── admission ──────────────────────────────────────────────────────
+    def admit(self, lane_name: str, sub: str | None, n: int = 1,
+              reserve: bool = True) -> float | None:
+        """
+        Reserve *n* jobs for *sub* on the lane or raise 429; returns the ETA in s.
+        With *reserve=False* only check – ``sent(..., sub=sub)`` records the
+        job once it was actually queued.
+        """
+        lane = self.lanes[lane_name]
+        eta  = lane.eta(n)
+        if MAX_DEPTH and lane.depth is not None and lane.depth + lane.sent + n > MAX_DEPTH:
+            self._reject("depth", f"queue depth above {MAX_DEPTH}",
+                         (lane.depth + lane.sent + n - MAX_DEPTH) / lane.rate if lane.rate else None)
+        max_wait = MAX_WAIT.get(lane_name, 0)
+        if eta == math.inf and (lane.stalled is None or time.monotonic() - lane.stalled < max_wait):
+            eta = None                          # e.g. workers still scaling up from zero
+        if max_wait and eta is not None and eta > max_wait:
+            self._reject("wait", f"estimated wait {self._fmt(eta)} exceeds {max_wait}s",
+                         eta - max_wait)
+        now = time.monotonic()
+        if SUB_MAX and sub:
+            window  = self._window(eta)
+            pending = lane.pending(sub, window, now)
+            if pending and len(pending) + n > SUB_MAX:
+                self._reject("sub", f"more than {SUB_MAX} jobs pending for this caller",
+                             pending[0] + window - now)
+            if reserve:
+                pending.extend([now] * n)
+        return eta
+
+    def sent(self, lane_name: str, n: int = 1, sub: str | None = None) -> None:
+        """*n* jobs queued; with *sub*, they count against that caller from now."""
+        lane = self.lanes[lane_name]
+        lane.sent += n
+        self._stats["admitted"] += n
+        if SUB_MAX and sub:
+            now = time.monotonic()
+            lane.pending(sub, self._window(lane.eta()), now).extend([now] * n)
+
+    def release(self, lane_name: str, sub: str | None, n: int) -> None:
+        """Give back *n* reserved jobs that were never queued (e.g. invalid batch items)."""
+        times = self.lanes[lane_name].subs.get(sub) if sub else None
+        for _ in range(min(n, len(times or ()))):
+            times.pop()
+
+    def _window(self, eta: float | None) -> float:
+        return max(eta if eta is not None and math.isfinite(eta) else 0.0, self.every)
+
+    def _reject(self, kind: str, detail: str, retry: float | None) -> None:
+        self._stats[f"rejected_{kind}"] += 1
+        retry = RETRY_CAP if retry is None or not math.isfinite(retry) else retry
+        raise HTTPException(status.HTTP_429_TOO_MANY_REQUESTS, detail,
+                            headers={"Retry-After": str(min(max(math.ceil(retry), 1), RETRY_CAP))})
+
+    @staticmethod
+    def _fmt(eta: float) -> str:
+        return "unbounded" if not math.isfinite(eta) else f"{eta:.0f}s"
+
+    def stats(self) -> dict:
+        lanes = {}
+        for name, lane in self.lanes.items():
+            eta = lane.eta()
+            lanes[name] = {"queue": lane.queue, "depth": lane.depth,
+                           "drain_per_s": None if lane.rate is None else round(lane.rate, 2),
+                           "eta_s": None if eta is None else (round(eta) if math.isfinite(eta) else "inf"),
+                           "callers": len(lane.subs)}
+        return {**self._stats, "failing": sorted(self._failing), "lanes": lanes}
@@ -1,5 +1,5 @@
 # app/auth.py – with scope/role enforcement
-import os, time, httpx, functools
+import os, time, httpx, asyncio, hashlib
 from typing import Optional
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
@@ -16,18 +16,79 @@ AZ_ISSUER    = f"https://sts.windows.net/{AZ_TENANT_ID}/"
 AUTH0_JWKS_URL = f"https://{AUTH0_DOMAIN}/.well-known/jwks.json"
 AZ_JWKS_URL    = f"https://login.microsoftonline.com/{AZ_TENANT_ID}/discovery/v2.0/keys"
 
+# issuer (from the unverified "iss" claim) → (jwks url, audience)
+ISSUERS = {
+    AUTH0_ISSUER: (AUTH0_JWKS_URL, AUTH0_AUDIENCE),
+    AZ_ISSUER:    (AZ_JWKS_URL,    AZ_AUDIENCE),
+}
+
 bearer_scheme = HTTPBearer(auto_error=False)
-_jwks_cache: dict[str, tuple[list, float]] = {}     # {url: (keys, ts)}
-_JWKS_TTL = 12 * 60 * 60                            # 12 h
-
-async def _get_jwks(url: str):
-    now = time.time()
-    if url not in _jwks_cache or now - _jwks_cache[url][1] > _JWKS_TTL:
-        async with httpx.AsyncClient(timeout=3) as c:
-            res = await c.get(url)
-        res.raise_for_status()
-        _jwks_cache[url] = (res.json()["keys"], now)
-    return _jwks_cache[url][0]
+_jwks_cache: dict[str, tuple[dict, float]] = {}     # {url: ({kid: key}, ts)}
+_JWKS_TTL      = 12 * 60 * 60                       # 12 h
+_JWKS_COOLDOWN = int(os.getenv("JWKS_REFRESH_COOLDOWN", "60"))   # min. s between unknown-kid refreshes
+_jwks_refresh: dict[str, asyncio.Task] = {}         # single-flight per url
+_http: httpx.AsyncClient | None = None
+
+_claims_cache: dict[str, tuple[dict, float]] = {}   # {sha256(token): (claims, exp)}
+_CLAIMS_MAX   = int(os.getenv("AUTH_CLAIMS_CACHE_SIZE", "10000"))
+_stats = {"cache_hits": 0, "verified": 0, "jwks_refreshes": 0, "rejected": 0}
+
+async def _fetch_jwks(url: str) -> dict:
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(timeout=3)
+    res = await _http.get(url)
+    res.raise_for_status()
+    _stats["jwks_refreshes"] += 1
+    keys = {k["kid"]: k for k in res.json()["keys"] if "kid" in k}
+    _jwks_cache[url] = (keys, time.time())
+    return keys
+
+async def _refresh_jwks(url: str) -> dict:
+    """Concurrent callers share one in-flight JWKS download."""
+    task = _jwks_refresh.get(url)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_jwks(url))
+        _jwks_refresh[url] = task
+        task.add_done_callback(lambda _: _jwks_refresh.pop(url, None))
+    return await asyncio.shield(task)
+
+async def _get_key(url: str, kid: str) -> Optional[dict]:
+    keys, ts = _jwks_cache.get(url, ({}, 0.0))
+    age = time.time() - ts
+    if age > _JWKS_TTL or (kid not in keys and age > _JWKS_COOLDOWN):
+        keys = await _refresh_jwks(url)             # expired, or key rotation
+    return keys.get(kid)
+
+def _cache_claims(token_hash: str, claims: dict) -> None:
+    if len(_claims_cache) >= _CLAIMS_MAX:
+        now = time.time()
+        for k in [k for k, (_, exp) in _claims_cache.items() if exp <= now]:
+            del _claims_cache[k]
+        while len(_claims_cache) >= _CLAIMS_MAX:    # oldest insert first
+            del _claims_cache[next(iter(_claims_cache))]
+    _claims_cache[token_hash] = (claims, float(claims["exp"]))
+
+async def _verify(token: str) -> dict:
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    cached = _claims_cache.get(token_hash)
+    if cached and cached[1] > time.time():
+        _stats["cache_hits"] += 1
+        return cached[0]
+
+    issuer = jwt.get_unverified_claims(token).get("iss")
+    if issuer not in ISSUERS:
+        raise JWTError("unknown issuer")
+    jwks_url, aud = ISSUERS[issuer]
+    hdr = jwt.get_unverified_header(token)
+    key = await _get_key(jwks_url, hdr.get("kid"))
+    if key is None:
+        raise JWTError("unknown kid")
+    claims = jwt.decode(token, key, algorithms=[hdr["alg"]], audience=aud, issuer=issuer)
+    _stats["verified"] += 1
+    if "exp" in claims:
+        _cache_claims(token_hash, claims)
+    return claims
 
 async def verify_jwt(
     creds: HTTPAuthorizationCredentials = Depends(bearer_scheme),
@@ -37,26 +98,27 @@ async def verify_jwt(
     if not creds or creds.scheme.lower() != "bearer":
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Missing credentials")
 
-    token = creds.credentials
-    for issuer, jwks_url, aud in (
-        (AUTH0_ISSUER, AUTH0_JWKS_URL, AUTH0_AUDIENCE),
-        (AZ_ISSUER,   AZ_JWKS_URL,   AZ_AUDIENCE),
-    ):
-        try:
-            keys = await _get_jwks(jwks_url)
-            hdr  = jwt.get_unverified_header(token)
-            key  = next(k for k in keys if k["kid"] == hdr["kid"])
-            claims = jwt.decode(token, key, algorithms=[hdr["alg"]], audience=aud, issuer=issuer)
-
-            # ── optional authorisation ─────────────────────────────
-            if required_scope and required_scope not in claims.get("scope", "").split():
-                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
-                                    detail=f"Missing scope '{required_scope}'")
-            if required_role and required_role not in claims.get("roles", []):
-                raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
-                                    detail=f"Missing role '{required_role}'")
-
-            return claims
-        except (JWTError, StopIteration):
-            continue
-    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired token")
\ No newline at end of file
+    try:
+        claims = await _verify(creds.credentials)
+    except (JWTError, KeyError, httpx.HTTPError):
+        _stats["rejected"] += 1
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired token")
+
+    # ── optional authorisation ─────────────────────────────────────
+    if required_scope and required_scope not in claims.get("scope", "").split():
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail=f"Missing scope '{required_scope}'")
+    if required_role and required_role not in claims.get("roles", []):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail=f"Missing role '{required_role}'")
+
+    return claims
+
+def stats() -> dict:
+    return {**_stats, "cached_tokens": len(_claims_cache)}
+
+async def close() -> None:
+    global _http
+    if _http is not None:
+        await _http.aclose()
+        _http = None
@@ -0,0 +1,265 @@
+"""
+app/clients.py – process-wide Azure clients shared by the API, the worker
+and the template helpers.
+
+One credential (with a token cache in front of it), one ContainerClient per
+container of the configured storage account, one ServiceBusClient and one sender per queue (behind
+a micro-batcher), one Service Bus management client.  Everything is created lazily on first use and closed by
+``await close()`` on shutdown.
+"""
+from __future__ import annotations
+
+import os, time, asyncio
+
+from azure.identity.aio import DefaultAzureCredential
+from azure.storage.blob.aio import ContainerClient, BlobClient
+from azure.servicebus.aio import ServiceBusClient, ServiceBusSender
+from azure.servicebus.aio.management import ServiceBusAdministrationClient
+from azure.servicebus.exceptions import MessageSizeExceededError
+
+STORAGE_URL  = os.getenv("STORAGE_URL")
+SB_NAMESPACE = os.getenv("SB_NAMESPACE")
+TOKEN_SKEW   = int(os.getenv("TOKEN_REFRESH_SKEW", "300"))         # seconds
+BATCH_MAX    = int(os.getenv("ENQUEUE_BATCH_MAX", "100"))           # messages
+BATCH_LINGER = float(os.getenv("ENQUEUE_LINGER_MS", "5")) / 1000    # seconds
+
+
+class CachingCredential:
+    """
+    Async TokenCredential that hands out cached tokens until *skew* seconds
+    before expiry.  Concurrent misses for the same scope share one request.
+    """
+
+    def __init__(self, inner, skew: int = TOKEN_SKEW):
+        self._inner  = inner
+        self._skew   = skew
+        self._tokens: dict[tuple, object] = {}
+        self._locks:  dict[tuple, asyncio.Lock] = {}
+
+    async def get_token(self, *scopes: str, **kwargs):
+        key   = (scopes, kwargs.get("claims"), kwargs.get("tenant_id"))
+        token = self._tokens.get(key)
+        if token and token.expires_on - self._skew > time.time():
+            return token
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            token = self._tokens.get(key)
+            if not token or token.expires_on - self._skew <= time.time():
+                token = await self._inner.get_token(*scopes, **kwargs)
+                self._tokens[key] = token
+            return token
+
+    async def close(self) -> None:
+        await self._inner.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        pass                                # shared – closed by close() only
+
+
+_credential: CachingCredential | None = None
+_containers: dict[str, ContainerClient] = {}        # STORAGE_URL account only
+_sb_client:  ServiceBusClient | None = None
+_sb_admin:   ServiceBusAdministrationClient | None = None
+_senders:    dict[str, ServiceBusSender] = {}
+_batchers:   dict[str, "BatchingSender"] = {}
+
+
+def credential() -> CachingCredential:
+    global _credential
+    if _credential is None:
+        _credential = CachingCredential(DefaultAzureCredential())
+    return _credential
+
+
+def _configured(account_url: str | None) -> bool:
+    return account_url is None or \
+        account_url.rstrip("/").lower() == (STORAGE_URL or "").rstrip("/").lower()
+
+
+def container(name: str, account_url: str | None = None) -> ContainerClient:
+    """
+    Shared ContainerClient for the configured STORAGE_URL account.  Any other
+    account (e.g. the host of a caller-supplied URL) gets a private client
+    that the caller closes (``async with``) – it is never cached.
+    """
+    if not _configured(account_url):
+        return ContainerClient(account_url, name, credential=credential())
+    if name not in _containers:
+        _containers[name] = ContainerClient(STORAGE_URL, name, credential=credential())
+    return _containers[name]
+
+
+def blob(container_name: str, blob_name: str, account_url: str | None = None) -> BlobClient:
+    """
+    BlobClient sharing the container's pipeline (connection pool, token); for
+    another account a private one – use ``async with`` so it is closed.
+    Closing a shared one is harmless: its transport belongs to the container.
+    """
+    if not _configured(account_url):
+        return BlobClient(account_url, container_name, blob_name, credential=credential())
+    return container(container_name).get_blob_client(blob_name)
+
+
+def servicebus() -> ServiceBusClient:
+    global _sb_client
+    if _sb_client is None:
+        _sb_client = ServiceBusClient(f"{SB_NAMESPACE}.servicebus.windows.net",
+                                      credential=credential())
+    return _sb_client
+
+
+def admin() -> ServiceBusAdministrationClient:
+    """Management client (queue runtime properties)."""
+    global _sb_admin
+    if _sb_admin is None:
+        _sb_admin = ServiceBusAdministrationClient(f"{SB_NAMESPACE}.servicebus.windows.net",
+                                                   credential=credential())
+    return _sb_admin
+
+
+def sender(queue: str) -> ServiceBusSender:
+    """Long-lived sender; the AMQP link is attached once and reused."""
+    if queue not in _senders:
+        _senders[queue] = servicebus().get_queue_sender(queue)
+    return _senders[queue]
+
+
+def _settle(fut: asyncio.Future, exc: BaseException | None = None) -> None:
+    if fut.done():                                  # caller went away
+        return
+    if exc is None:
+        fut.set_result(None)
+    else:
+        fut.set_exception(exc)
+
+
+class BatchingSender:
+    """
+    Collects concurrent ``send()`` calls for one queue into a
+    ServiceBusMessageBatch, flushed when *max_messages* are waiting or
+    *linger* seconds after the first one arrived.  Each caller resumes once
+    the batch carrying its message has been acknowledged by the broker (or
+    gets the send error).  A single flusher task owns the sender, so sends
+    never overlap on the link.
+    """
+
+    def __init__(self, queue: str, max_messages: int = BATCH_MAX, linger: float = BATCH_LINGER):
+        self.queue        = queue
+        self.max_messages = max(max_messages, 1)
+        self.linger       = linger
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+        self._stats = {"messages": 0, "batches": 0, "errors": 0}
+
+    async def send(self, message) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((message, fut))
+        await fut
+
+    async def close(self) -> None:
+        if self._task and not self._task.done():
+            self._queue.put_nowait(None)            # flush what is queued, then stop
+            await self._task
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            first = await self._queue.get()
+            if first is None:
+                return
+            items, stop = [first], False
+            deadline = loop.time() + self.linger
+            while len(items) < self.max_messages:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stop = True
+                    break
+                items.append(item)
+            try:
+                await self._flush(items)
+            except Exception as exc:                # e.g. link could not attach
+                self._stats["errors"] += 1
+                for _, fut in items:
+                    _settle(fut, exc)
+            if stop:
+                return
+
+    async def _flush(self, items: list) -> None:
+        snd   = sender(self.queue)
+        batch = await snd.create_message_batch()
+        group: list[asyncio.Future] = []
+        for message, fut in items:
+            try:
+                batch.add_message(message)
+            except MessageSizeExceededError as exc:
+                if not group:                       # single message too large
+                    _settle(fut, exc)
+                    continue
+                await self._send(snd, batch, group)
+                batch, group = await snd.create_message_batch(), []
+                try:
+                    batch.add_message(message)
+                except MessageSizeExceededError as exc2:
+                    _settle(fut, exc2)
+                    continue
+            group.append(fut)
+        if group:
+            await self._send(snd, batch, group)
+
+    async def _send(self, snd, batch, group: list[asyncio.Future]) -> None:
+        try:
+            await snd.send_messages(batch)
+        except Exception as exc:
+            self._stats["errors"] += 1
+            for fut in group:
+                _settle(fut, exc)
+            return
+        self._stats["batches"]  += 1
+        self._stats["messages"] += len(group)
+        for fut in group:
+            _settle(fut)
+
+    def stats(self) -> dict:
+        return {**self._stats, "waiting": self._queue.qsize()}
+
+
+def batcher(queue: str) -> BatchingSender:
+    if queue not in _batchers:
+        _batchers[queue] = BatchingSender(queue)
+    return _batchers[queue]
+
+
+def sender_stats() -> dict:
+    """Per-queue micro-batcher stats (queues that have sent at least once)."""
+    return {q: b.stats() for q, b in _batchers.items()}
+
+
+async def close() -> None:
+    global _credential, _sb_client, _sb_admin
+    for b in _batchers.values():
+        await b.close()
+    for s in _senders.values():
+        await s.close()
+    if _sb_client:
+        await _sb_client.close()
+    if _sb_admin:
+        await _sb_admin.close()
+    for c in _containers.values():
+        await c.close()
+    if _credential:
+        await _credential.close()
+    _batchers.clear(); _senders.clear(); _containers.clear()
+    _credential = _sb_client = _sb_admin = None
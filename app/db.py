@@ -1,9 +1,8 @@
 """
 app/db.py – connection-string helper only.
 
-The actual database work happens through the async engine that is
-constructed in deps.py, so we no longer create a synchronous
-SQLAlchemy engine here (which would have required pyodbc).
+The engines are constructed in deps.py: the async one for the API and
+the worker, a synchronous pyodbc one for Report.fetch() threads.
 """
 from __future__ import annotations
 
@@ -17,16 +16,20 @@ DRIVER     = "ODBC Driver 18 for SQL Server"
 
 def build_url(*, async_driver: bool = False) -> str:
     """
-    Return a SQLAlchemy URL for Azure SQL using AAD MSI auth.
+    Return a SQLAlchemy URL for Azure SQL.  Authentication is the AAD access
+    token deps.py passes at connect (``attrs_before``), so the connection
+    string carries no ``Authentication=`` keyword – the driver rejects a token
+    next to one.  Server and database go into ``odbc_connect`` because
+    SQLAlchemy uses that string verbatim.
 
     Set  async_driver=True  for  mssql+aioodbc://…
     """
     params = urllib.parse.quote_plus(
         f"Driver={DRIVER};"
+        f"Server=tcp:{SQL_SERVER},1433;"
+        f"Database={SQL_DB};"
         "Encrypt=yes;"
-        "TrustServerCertificate=no;"
-        "Authentication=ActiveDirectoryMsi"
+        "TrustServerCertificate=no"
     )
     dialect = "aioodbc" if async_driver else "pyodbc"
     return f"mssql+{dialect}://@{SQL_SERVER}:1433/{SQL_DB}?odbc_connect={params}"
-
@@ -3,6 +3,8 @@ app/deps.py – Async SQLAlchemy session factory with AAD token injection.
 """
 from __future__ import annotations
 
+import os, time, struct, threading
+
 import sqlalchemy as sa
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
@@ -12,8 +14,8 @@ from db import build_url
 
 # ── Engine ────────────────────────────────────────────────────────────────
 # pool_pre_ping=True makes SQLAlchemy test each connection before handing it
-# out; an expired AAD token is therefore detected and the connection is
-# transparently re-established with a fresh token.
+# out; a dropped connection is transparently re-established, and every new
+# connection gets the current AAD token (see _inject_token below).
 ASYNC_ENGINE = create_async_engine(
     build_url(async_driver=True),
     pool_size=10,
@@ -21,18 +23,109 @@ ASYNC_ENGINE = create_async_engine(
     pool_pre_ping=True,
 )
 
-# ── Inject fresh access token on every *checkout* (not only on connect) ───
-_credential = DefaultAzureCredential()
-
-@sa.event.listens_for(ASYNC_ENGINE.sync_engine, "do_checkout")  # type: ignore[attr-defined]
-def _renew_token(dbapi_conn, conn_record, conn_proxy):          # noqa: N802
-    token = _credential.get_token("https://database.windows.net/.default")
-    attrs_before = {"AccessToken": bytes(token.token, "utf-8")}
-    # The private attribute below is the only way to pass attrs_before to
-    # pyodbc / aioodbc at checkout time.
-    dbapi_conn.add_output_converter          # keep mypy happy
-    conn_proxy.clear()                       # no-op but keeps linters calm
-    conn_record.info["attrs_before"] = attrs_before
+# Report.fetch() runs in executor threads, where ASYNC_ENGINE.sync_engine is
+# unusable (aioodbc needs the event loop's greenlet), so templates get a
+# plain pyodbc engine on the same database.
+SYNC_ENGINE = sa.create_engine(
+    build_url(),
+    pool_size=10,
+    max_overflow=5,
+    pool_pre_ping=True,
+)
+
+# ── Inject the cached access token on every *connect* ─────────────────────
+TOKEN_SCOPE = "https://database.windows.net/.default"
+SQL_COPT_SS_ACCESS_TOKEN = 1256                                 # msodbcsql pre-connect attribute
+TOKEN_SKEW  = int(os.getenv("SQL_TOKEN_REFRESH_SKEW", "300"))   # refresh this long before expiry
+RETRY_EVERY = 30                                                # s between failed refreshes
+
+
+class SqlTokenProvider:
+    """
+    Holds the current AAD token for Azure SQL.  A daemon thread fetches a new
+    one *skew* seconds before expiry, so ``attrs_before()`` – called from the
+    engines' connect hook – is a dictionary lookup.  Only the very first
+    connect (or one after the token actually expired because every
+    background refresh failed) has to fetch synchronously.
+    """
+
+    def __init__(self, credential, scope: str = TOKEN_SCOPE, skew: int = TOKEN_SKEW):
+        self._credential = credential
+        self._scope      = scope
+        self._skew       = skew
+        self._lock       = threading.Lock()
+        self._wake       = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._attrs: dict | None = None
+        self._expires_on = 0.0
+        self._stats = {"refreshes": 0, "failures": 0, "sync_fetches": 0,
+                       "connects": 0, "connect_ms_total": 0.0, "connect_ms_max": 0.0}
+
+    def _refresh(self, only_if_expired: bool = False) -> None:
+        with self._lock:
+            if only_if_expired and self._attrs and self._expires_on > time.time():
+                return                                  # another thread got there first
+            if only_if_expired:
+                self._stats["sync_fetches"] += 1
+            try:
+                token = self._credential.get_token(self._scope)
+            except Exception:
+                self._stats["failures"] += 1
+                raise
+            raw = token.token.encode("utf-16-le")       # length-prefixed UTF-16, as the driver wants it
+            self._attrs      = {SQL_COPT_SS_ACCESS_TOKEN: struct.pack(f"<I{len(raw)}s", len(raw), raw)}
+            self._expires_on = float(token.expires_on)
+            self._stats["refreshes"] += 1
+
+    def _run(self) -> None:
+        while True:
+            delay = self._expires_on - self._skew - time.time()
+            if delay > 0 and self._wake.wait(delay):
+                return                                  # close()
+            try:
+                self._refresh()
+            except Exception:
+                if self._wake.wait(RETRY_EVERY):
+                    return
+
+    def start(self) -> None:
+        """Begin background refreshes (the first one runs immediately)."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sql-token", daemon=True)
+            self._thread.start()
+
+    def close(self) -> None:
+        self._wake.set()
+
+    def attrs_before(self) -> dict:
+        t0 = time.perf_counter()
+        if self._attrs is None or self._expires_on <= time.time():
+            self._refresh(only_if_expired=True)
+            self.start()
+        attrs = self._attrs
+        ms = (time.perf_counter() - t0) * 1000
+        self._stats["connects"] += 1
+        self._stats["connect_ms_total"] += ms
+        self._stats["connect_ms_max"] = max(self._stats["connect_ms_max"], ms)
+        return attrs
+
+    def stats(self) -> dict:
+        s = dict(self._stats)
+        total = s.pop("connect_ms_total")
+        s["connect_ms_avg"] = round(total / s["connects"], 3) if s["connects"] else None
+        s["connect_ms_max"] = round(s["connect_ms_max"], 3)
+        s["expires_in"]      = round(self._expires_on - time.time()) if self._attrs else None
+        return s
+
+
+SQL_TOKEN = SqlTokenProvider(DefaultAzureCredential())
+
+@sa.event.listens_for(ASYNC_ENGINE.sync_engine, "do_connect")
+@sa.event.listens_for(SYNC_ENGINE, "do_connect")
+def _inject_token(dialect, conn_rec, cargs, cparams):
+    # pyodbc.connect() – and aioodbc.connect(), which forwards its kwargs –
+    # take the token as a pre-connect attribute
+    cparams["attrs_before"] = SQL_TOKEN.attrs_before()          # no I/O once warm
 
 # ── Session factory ───────────────────────────────────────────────────────
 AsyncSessionLocal = sessionmaker(
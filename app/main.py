@@ -4,40 +4,58 @@ Adds one-time, short-lived token links around the PDF-enqueue call.
 """
 from __future__ import annotations
 
-import os, sys, re, json, asyncio, hashlib, time, hmac, base64
+import os, sys, re, json, gzip, uuid, asyncio, hashlib, time, hmac, base64, logging
 from pathlib import Path
-from typing import Any
+from typing import Any, Literal
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Depends, HTTPException, status, Query
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from azure.core.exceptions import ResourceNotFoundError
-from azure.identity.aio import DefaultAzureCredential
-from azure.storage.blob.aio import BlobClient
-from azure.servicebus.aio import ServiceBusClient
 from azure.servicebus import ServiceBusMessage
 
-from auth import verify_jwt                       # local helper
+import auth                                      # local helper
+from auth import verify_jwt
+import clients                                    # shared Azure clients
+import admission                                  # queue-depth admission control
+
+@asynccontextmanager
+async def _lifespan(_: FastAPI):
+    QUEUES.start()
+    yield
+    await QUEUES.close()
+    if _batch_tasks:                              # finish enqueueing open batches
+        await asyncio.gather(*_batch_tasks, return_exceptions=True)
+    _fetch_pool.shutdown(wait=False, cancel_futures=True)
+    await clients.close()
+    await auth.close()
 
-app = FastAPI()
+app = FastAPI(lifespan=_lifespan)
 
 # ─── Configuration ───────────────────────────────────────────────────────
-SB_NAMESPACE = os.getenv("SB_NAMESPACE")
-SB_QUEUE     = os.getenv("SB_QUEUE", "pdf-jobs")
-STORAGE_URL  = os.getenv("STORAGE_URL")
+SB_QUEUE     = os.getenv("SB_QUEUE", "pdf-jobs")                   # interactive lane
+BULK_QUEUE   = os.getenv("SB_QUEUE_BULK") or SB_QUEUE               # unset = one lane
 PAYLOAD_CTN  = os.getenv("PAYLOAD_CONTAINER", "pdfpayloads")
 OUTPUT_CTN   = os.getenv("OUTPUT_CONTAINER", "pdfs")
 CACHE_TTL    = int(os.getenv("PDF_CACHE_TTL", "30"))                # seconds
+INLINE_MAX   = int(os.getenv("PAYLOAD_INLINE_MAX", "32768"))        # bytes, 0 = always blob
+COMPRESS_MIN = int(os.getenv("PAYLOAD_COMPRESS_MIN", "1024"))       # bytes, 0 = never gzip
+FETCH_POOL   = int(os.getenv("API_FETCH_WORKERS", "4"))             # threads for sync fetch()
+FETCH_QUEUE  = int(os.getenv("API_FETCH_QUEUE", "8"))               # waiting beyond that → 503
+FETCH_SECS   = float(os.getenv("API_FETCH_TIMEOUT", "30"))          # seconds, per template override
+RETRY_AFTER  = int(os.getenv("API_RETRY_AFTER", "5"))               # seconds
+BATCH_MAX    = int(os.getenv("BATCH_MAX_ITEMS", "5000"))
+BATCH_PAR    = int(os.getenv("BATCH_PARALLELISM", "32"))
+BATCH_TRIES  = 3                                                    # per item, on a saturated fetch pool (503)
 
 # one-time link signing key (URL-safe base64, 32 bytes recommended)
 HMAC_SECRET = base64.urlsafe_b64decode(
     os.getenv("HMAC_SECRET_B64", base64.urlsafe_b64encode(os.urandom(32)))
 )
 
-CRED      = DefaultAzureCredential()
-SB_FQDN   = f"{SB_NAMESPACE}.servicebus.windows.net"
-SB_CLIENT = ServiceBusClient(SB_FQDN, credential=CRED)
-
 # ─── Template handling ───────────────────────────────────────────────────
 TPL_RE = re.compile(r"[a-zA-Z0-9_-]{1,64}$")
 TEMPLATE_DIR = Path(os.getenv("SCRIPTS_DIR", "/opt/app/scripts")).resolve()
@@ -48,6 +66,10 @@ class ParamDict(BaseModel, extra="allow"):
     """Arbitrary JSON body forwarded to Report"""
     pass
 
+class BatchBody(BaseModel):
+    """One parameter set per report, all for the same template"""
+    items: list[dict[str, Any]]
+
 def _import_report(template: str):
     """Import and sanity-check a Report class for *template*."""
     if not TPL_RE.fullmatch(template):
@@ -65,13 +87,71 @@ def _import_report(template: str):
                             detail=f"{template}.Report missing")
     return report_cls
 
-async def run_report(template: str, params: dict[str, Any]) -> dict[str, Any]:
-    """Instantiate Report, await its result if needed, return placeholders."""
+def _validate_params(report_cls, params: dict[str, Any]) -> dict[str, Any]:
+    """Run the template's cheap ``Report.validate(params)`` if it has one."""
+    validate = getattr(report_cls, "validate", None)
+    if validate is None:
+        return params
+    try:
+        return validate(params)
+    except (ValueError, KeyError, TypeError) as exc:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=str(exc)) from exc
+
+async def build_payload(template: str, params: dict[str, Any]) -> dict[str, Any]:
+    """
+    Job payload for *template*.  Data is fetched exactly once: by default in
+    the worker (``Report.FETCH_STAGE = "worker"``), so the API only validates.
+    Templates with ``FETCH_STAGE = "api"`` are fetched here and the payload is
+    marked ``fetched`` so the worker does not repeat it.
+    """
     report_cls = _import_report(template)
-    obj = report_cls(params)
-    result = obj.fetch()
-    if asyncio.iscoroutine(result):
-        result = await result
+    params     = _validate_params(report_cls, params)
+    if getattr(report_cls, "FETCH_STAGE", "worker") != "api":
+        return {"template": template, "params": params}
+    placeholders = await run_report(report_cls, params)
+    return {"template": template, "params": {**params, **placeholders}, "fetched": True}
+
+# Sync fetch() implementations (SQL, matplotlib) run on a dedicated, bounded
+# thread pool so they never block the event loop – /live and /ready included.
+_fetch_pool = ThreadPoolExecutor(max_workers=FETCH_POOL, thread_name_prefix="report-fetch")
+_fetch_busy = 0                                   # running + queued sync fetches
+
+def _release_fetch_slot(_) -> None:
+    global _fetch_busy
+    _fetch_busy -= 1
+
+async def _run_sync_fetch(fn, timeout: float):
+    global _fetch_busy
+    if _fetch_busy >= FETCH_POOL + FETCH_QUEUE:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="report fetch pool saturated",
+                            headers={"Retry-After": str(RETRY_AFTER)})
+    _fetch_busy += 1
+    loop = asyncio.get_running_loop()
+    fut  = _fetch_pool.submit(fn)
+    # the slot is held until the thread really finishes, even after a timeout,
+    # so hung fetches show up as saturation instead of piling up unseen
+    fut.add_done_callback(lambda f: loop.call_soon_threadsafe(_release_fetch_slot, f))
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(fut), timeout)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                            detail=f"report fetch exceeded {timeout:g}s")
+
+async def run_report(report_cls, params: dict[str, Any]) -> dict[str, Any]:
+    """Instantiate Report, run fetch() off the event loop, return placeholders."""
+    from deps import SYNC_ENGINE                  # only API-stage templates need SQL
+    obj = report_cls(params, SYNC_ENGINE)
+    timeout = float(getattr(report_cls, "FETCH_TIMEOUT", FETCH_SECS))
+    if asyncio.iscoroutinefunction(obj.fetch):
+        try:
+            result = await asyncio.wait_for(obj.fetch(), timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                                detail=f"report fetch exceeded {timeout:g}s")
+    else:
+        result = await _run_sync_fetch(obj.fetch, timeout)
     if not isinstance(result, dict):
         raise HTTPException(status_code=500, detail="Report.fetch() did not return dict")
     return result
@@ -93,16 +173,84 @@ def _verify_sig(tpl: str, sub: str, exp: int, sig: str) -> None:
     if not hmac.compare_digest(sig, _sign(tpl, sub, exp)):
         raise HTTPException(403, "invalid or reused link")
 
+# ─── Queue message: inline payload or claim-check blob ───────────────────
+def _message_id(file_id: str) -> str:
+    """
+    file_id plus the PDF_CACHE_TTL window it was sent in: broker duplicate
+    detection still folds repeats within one window (the cache would answer
+    them anyway), but a re-render after the cached PDF expired gets a new id
+    and is not silently dropped for the rest of the detection window.  The
+    worker takes the job id from the body, never from message_id.
+    """
+    return f"{file_id}:{int(time.time() // max(CACHE_TTL, 1))}"
+
+async def _job_message(file_id: str, payload: dict[str, Any]) -> ServiceBusMessage:
+    """
+    Payloads up to PAYLOAD_INLINE_MAX bytes travel in the message body
+    (gzip'd above PAYLOAD_COMPRESS_MIN, flagged by content_type); larger ones
+    are uploaded to the payload container and the message carries the blob name.
+    """
+    props = {"template": payload["template"]}         # lets the worker size the job unopened
+    mid   = _message_id(file_id)
+    data, ctype = json.dumps({"id": file_id, **payload}, separators=(",", ":")).encode(), "application/json"
+    if COMPRESS_MIN and len(data) > COMPRESS_MIN:
+        data, ctype = gzip.compress(data), "application/gzip"
+    if len(data) <= INLINE_MAX:
+        return ServiceBusMessage(data, message_id=mid, content_type=ctype,
+                                 application_properties=props)
+
+    payload_blob = clients.blob(PAYLOAD_CTN, file_id)     # same key, no .pdf
+    await payload_blob.upload_blob(json.dumps(payload),
+                                   overwrite=True,
+                                   content_type="application/json")
+    return ServiceBusMessage(file_id, message_id=mid, application_properties=props)
+
+# ─── Single-flight: one enqueue per cache key, other callers attach ──────
+_inflight: dict[str, asyncio.Task] = {}
+
+async def _single_flight(key: str, factory) -> Any:
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # shield: a caller that disconnects must not cancel the shared work
+    return await asyncio.shield(task)
+
+# ─── Priority lanes ──────────────────────────────────────────────────────
+Priority = Literal["interactive", "bulk"]
+LANES: dict[str, str] = {"interactive": SB_QUEUE, "bulk": BULK_QUEUE}
+QUEUES = admission.QueueMonitor(LANES)
+
+def _lane(priority: Priority | None, claims: dict) -> Priority:
+    """An explicit hint wins; machine-to-machine tokens default to bulk."""
+    if priority:
+        return priority
+    if claims.get("gty") == "client-credentials" or claims.get("idtyp") == "app":
+        return "bulk"
+    return "interactive"
+
 # ─── Core enqueue logic (factored out so both routes can reuse it) ───────
 async def _enqueue_core(template: str,
                         body_dict: dict[str, Any],
-                        claims: dict) -> dict[str, Any]:
+                        claims: dict,
+                        lane: Priority = "interactive",
+                        admit: bool = True) -> dict[str, Any]:
+    """*admit=False*: the caller already passed admission (batch items)."""
     file_id = _make_cache_key(template, body_dict)
+    sub     = claims.get("sub") if admit else None
+    # per lane: an interactive request must not wait on a queued bulk job
+    return await _single_flight(f"{lane}:{file_id}",
+                                lambda: _enqueue_once(template, body_dict, file_id, lane, admit, sub))
+
+async def _enqueue_once(template: str,
+                        body_dict: dict[str, Any],
+                        file_id: str,
+                        lane: Priority = "interactive",
+                        admit: bool = True,
+                        sub: str | None = None) -> dict[str, Any]:
     pdf_blob_name = f"{file_id}.pdf"
-    pdf_blob = BlobClient(account_url=STORAGE_URL,
-                          container_name=OUTPUT_CTN,
-                          blob_name=pdf_blob_name,
-                          credential=CRED)
+    pdf_blob = clients.blob(OUTPUT_CTN, pdf_blob_name)
 
     # ── Cache check ──────────────────────────────────────────────────
     try:
@@ -113,22 +261,21 @@ async def _enqueue_core(template: str,
     except ResourceNotFoundError:
         pass  # not cached
 
-    # ── Render job payload ───────────────────────────────────────────
-    placeholders = await run_report(template, body_dict)
-    payload = {"template": template, "params": placeholders}
+    # ── Backpressure: 429 + Retry-After when the lane is too far behind ──
+    # checked before the (possibly expensive) payload build; the caller's
+    # quota is only used once the job is really queued, not by a 422
+    eta = QUEUES.admit(lane, sub, reserve=False) if admit else QUEUES.lanes[lane].eta()
 
-    payload_blob = BlobClient(account_url=STORAGE_URL,
-                              container_name=PAYLOAD_CTN,
-                              blob_name=file_id,      # same key, no .pdf
-                              credential=CRED)
-    await payload_blob.upload_blob(json.dumps(payload),
-                                   overwrite=True,
-                                   content_type="application/json")
+    # ── Render job payload ───────────────────────────────────────────
+    payload = await build_payload(template, body_dict)
 
-    async with SB_CLIENT.get_queue_sender(SB_QUEUE) as sender:
-        await sender.send_messages(ServiceBusMessage(file_id))
+    # resolves once the micro-batch carrying this message is acknowledged;
+    # message_id = file_id + cache window lets duplicate detection drop repeats
+    await clients.batcher(LANES[lane]).send(await _job_message(file_id, payload))
+    QUEUES.sent(lane, sub=sub)
 
-    return {"status": "queued", "id": file_id}
+    return {"status": "queued", "id": file_id, "priority": lane,
+            "eta_seconds": round(eta) if eta is not None and eta != float("inf") else None}
 
 # ─── 1. Public “issue link” endpoint ─────────────────────────────────────
 @app.get("/link/{template}")
@@ -151,28 +298,155 @@ async def enqueue_secure_pdf(template: str,
                              body: ParamDict = Depends(),
                              t: str = Query(...),
                              exp: int = Query(...),
+                             priority: Priority | None = Query(None),
                              claims: dict = Depends(verify_jwt)):
     _verify_sig(template, claims["sub"], exp, t)
-    return await _enqueue_core(template, body.dict(), claims)
+    return await _enqueue_core(template, body.dict(), claims, _lane(priority, claims))
 
 # ─── (Optional) legacy route – keep for internal clients if you wish ────
 @app.post("/generate-pdf/{template}")
 async def enqueue_pdf(template: str,
                       body: ParamDict = Depends(),
+                      priority: Priority | None = Query(None),
                       claims: dict = Depends(verify_jwt)):
     """
     Legacy entry point – behaves exactly as before but remains shareable.
     """
-    return await _enqueue_core(template, body.dict(), claims)
+    return await _enqueue_core(template, body.dict(), claims, _lane(priority, claims))
+
+# ─── 3. Bulk render: many parameter sets for one template ───────────────
+BATCH_RE = re.compile(r"[0-9a-f]{32}$")
+_batch_tasks: set[asyncio.Task] = set()
+_batch_done:  dict[str, set[str]] = {}          # open batch_id → ids seen rendered
+_DONE_MAX    = 1000                             # open batches remembered per replica
+
+def _manifest_blob(batch_id: str):
+    return clients.blob(PAYLOAD_CTN, f"batches/{batch_id}.json")
+
+async def _save_manifest(batch_id: str, manifest: dict[str, Any]) -> None:
+    await _manifest_blob(batch_id).upload_blob(json.dumps(manifest), overwrite=True,
+                                               content_type="application/json")
+
+async def _gather_bounded(coros, limit: int) -> list:
+    sem = asyncio.Semaphore(limit)
+    async def run(c):
+        async with sem:
+            return await c
+    return await asyncio.gather(*(run(c) for c in coros))
+
+async def _run_batch(batch_id: str, manifest: dict[str, Any],
+                     items: list[dict[str, Any]], claims: dict) -> None:
+    """Cache checks + payload uploads run BATCH_PARALLELISM at a time; the
+    Service Bus batcher folds the resulting sends into batched messages.
+    API-stage templates fetch in the API, so there at most API_FETCH_WORKERS
+    items run at once – the fetch queue stays free for interactive requests –
+    and an item that still finds the pool saturated (503) is retried."""
+    async def one(params: dict[str, Any]) -> str:
+        for attempt in range(BATCH_TRIES):
+            try:
+                return (await _enqueue_core(manifest["template"], params, claims, "bulk",
+                                            admit=False))["status"]
+            except HTTPException as exc:
+                if exc.status_code != status.HTTP_503_SERVICE_UNAVAILABLE or attempt == BATCH_TRIES - 1:
+                    return f"error: {exc.detail}"
+            except Exception as exc:
+                return f"error: {exc}"
+            await asyncio.sleep(RETRY_AFTER)
+
+    try:
+        api_stage = getattr(_import_report(manifest["template"]), "FETCH_STAGE", "worker") == "api"
+        limit     = min(BATCH_PAR, FETCH_POOL) if api_stage else BATCH_PAR
+        results   = await _gather_bounded((one(p) for p in items), limit)
+        manifest["enqueue"] = "done"
+        manifest["errors"]  = {i: r for i, r in zip(manifest["ids"], results) if r.startswith("error")}
+        # items that failed or were already cached never reached the queue
+        QUEUES.release("bulk", manifest["sub"], sum(r != "queued" for r in results))
+        await _save_manifest(batch_id, manifest)
+    except Exception as exc:
+        logging.exception("batch %s: enqueue failed", batch_id)
+        manifest["enqueue"] = "failed"
+        manifest["error"]   = str(exc)
+        try:
+            await _save_manifest(batch_id, manifest)
+        except Exception:
+            logging.exception("batch %s: could not record the failure", batch_id)
+
+@app.post("/generate-batch/{template}", status_code=status.HTTP_202_ACCEPTED)
+async def enqueue_batch(template: str,
+                        body: BatchBody,
+                        claims: dict = Depends(verify_jwt)):
+    """
+    Accepts up to BATCH_MAX_ITEMS parameter sets; returns a batch id plus the
+    per-item ids immediately and enqueues in the background.
+    """
+    if not body.items:
+        raise HTTPException(400, "empty batch")
+    if len(body.items) > BATCH_MAX:
+        raise HTTPException(413, f"batch exceeds {BATCH_MAX} items")
+    _import_report(template)                      # fail fast on a bad template
+    eta = QUEUES.admit("bulk", claims.get("sub"), len(body.items))   # whole batch or nothing
+
+    batch_id = uuid.uuid4().hex
+    manifest = {"template": template, "sub": claims.get("sub"),
+                "created": int(time.time()), "enqueue": "running",
+                "ids": [_make_cache_key(template, p) for p in body.items]}
+    await _save_manifest(batch_id, manifest)
+
+    task = asyncio.create_task(_run_batch(batch_id, manifest, body.items, claims))
+    _batch_tasks.add(task)
+    task.add_done_callback(_batch_tasks.discard)
+    return {"batch_id": batch_id,
+            "status_url": f"/batch/{batch_id}",
+            "eta_seconds": round(eta) if eta is not None and eta != float("inf") else None,
+            "items": [{"id": i} for i in manifest["ids"]]}
+
+@app.get("/batch/{batch_id}")
+async def batch_status(batch_id: str, claims: dict = Depends(verify_jwt)):
+    if not BATCH_RE.fullmatch(batch_id):
+        raise HTTPException(400, "invalid batch id")
+    try:
+        manifest = json.loads(await (await _manifest_blob(batch_id).download_blob()).readall())
+    except ResourceNotFoundError:
+        raise HTTPException(404, "batch not found")
+    if manifest.get("sub") != claims.get("sub"):
+        raise HTTPException(404, "batch not found")
+
+    # a PDF counts once it is younger than the batch (minus the cache window
+    # in which _enqueue_core reports it as "cached" instead of re-rendering)
+    since  = manifest["created"] - CACHE_TTL
+    done   = _batch_done.pop(batch_id, set())       # re-inserted below while still open
+    errors = manifest.get("errors", {})
+    async def rendered(file_id: str) -> None:
+        try:
+            props = await clients.blob(OUTPUT_CTN, f"{file_id}.pdf").get_blob_properties()
+        except ResourceNotFoundError:
+            return
+        if props.last_modified.timestamp() >= since:
+            done.add(file_id)
+    todo = {i for i in manifest["ids"] if i not in done and i not in errors}
+    await _gather_bounded((rendered(i) for i in todo), BATCH_PAR)
+
+    ids     = set(manifest["ids"])
+    pending = len(ids) - len(done) - len(errors)
+    if manifest["enqueue"] == "running" or (manifest["enqueue"] == "done" and pending):
+        _batch_done[batch_id] = done                # most recently polled last
+        while len(_batch_done) > _DONE_MAX:
+            _batch_done.pop(next(iter(_batch_done)))
+    return {"batch_id": batch_id,
+            "template": manifest["template"],
+            "enqueue":  manifest["enqueue"],
+            "total":    len(ids),
+            "rendered": len(done),
+            "failed":   len(errors),
+            "pending":  pending,
+            "errors":   errors,
+            **({"error": manifest["error"]} if "error" in manifest else {})}
 
 # ─── Stream PDF (unchanged) ──────────────────────────────────────────────
 @app.get("/pdf/{payload_id}")
 async def get_pdf(payload_id: str, _: dict = Depends(verify_jwt)):
     blob_name = f"{payload_id}.pdf"
-    blob = BlobClient(account_url=STORAGE_URL,
-                      container_name=OUTPUT_CTN,
-                      blob_name=blob_name,
-                      credential=CRED)
+    blob = clients.blob(OUTPUT_CTN, blob_name)
     try:
         downloader = await blob.download_blob()
     except ResourceNotFoundError:
@@ -189,3 +463,11 @@ async def live():  return {"status": "ok"}
 
 @app.get("/ready")
 async def ready(): return {"status": "ok"}
+
+@app.get("/stats")
+async def stats(_: dict = Depends(verify_jwt)):
+    deps = sys.modules.get("deps")                # imported on first API-stage fetch
+    return {"auth": auth.stats(),
+            "admission": QUEUES.stats(),
+            "enqueue": clients.sender_stats(),
+            "sql_token": deps.SQL_TOKEN.stats() if deps else None}
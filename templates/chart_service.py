@@ -0,0 +1,204 @@
+"""
+chart_service.py – matplotlib charts rendered to SVG in a pool of warm processes
+
+Templates describe a chart as data (``LineChart`` of ``Series`` plus style)
+and get the SVG back.  Rendering uses the object-oriented ``Figure`` API only –
+no pyplot, so no global figure manager shared between fetch threads – and
+runs in a process pool whose workers import matplotlib once, so CPU-bound
+SVG export happens outside the caller's GIL, in parallel with the SQL
+threads.  The workers fork from a ``forkserver`` that has only this module
+preloaded (``spawn`` where there is none), never from the worker process
+with its threads and event loop.
+
+    from chart_service import LineChart, Series, render
+    svg = render(LineChart([Series(df.index.to_numpy(), df["Geldkurs"].to_numpy())],
+                           ylabel="Geldkurs"))
+
+``submit()`` returns a ``concurrent.futures.Future`` instead.  With
+CHART_WORKERS=0 (or after the pool breaks) charts render in the calling
+thread, one at a time.
+"""
+from __future__ import annotations
+
+import io, os, time, hashlib, threading
+import multiprocessing as mp
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import matplotlib as mpl
+from matplotlib.figure import Figure
+
+WORKERS      = int(os.getenv("CHART_WORKERS", str(min(2, os.cpu_count() or 1))))   # 0 = inline
+TIMEOUT      = float(os.getenv("CHART_TIMEOUT", "60"))                # seconds per chart
+
+SOURCE_VERSION = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()[:16]   # as imported, for fragment_cache
+
+FONT_RC = {                                        # the report font, as product-de had it
+    "font.family": "sans-serif",
+    "font.sans-serif": ["DejaVu Sans"],
+    "font.weight": "light",
+    "font.size": 6,
+}
+
+
+@dataclass(frozen=True)
+class Series:
+    x:     object                                  # array-like (datetime64 fine)
+    y:     object
+    label: str | None = None
+    color: str = "grey"
+
+
+@dataclass(frozen=True)
+class LineChart:
+    series:     list[Series]
+    size:       tuple[float, float] = (9, 3)       # inches
+    ylabel:     str = ""
+    axis_color: str = "grey"                       # spines, ticks and tick labels
+    tick_width: float = 0.5
+    xrotation:  float = 45                         # x tick label rotation (degrees)
+    legend:     dict | None = None                 # Axes.legend() kwargs; None = no legend
+    rc:         dict = field(default_factory=lambda: dict(FONT_RC))
+    savefig:    dict = field(default_factory=lambda: {"bbox_inches": "tight"})
+
+
+# ── rendering (runs in the pool workers) ───────────────────────────────
+def render_svg(chart: LineChart) -> str:
+    """Draw *chart* on a fresh Figure and return the SVG text."""
+    with mpl.rc_context(chart.rc):
+        fig = Figure(figsize=chart.size)
+        ax  = fig.add_subplot()
+        for s in chart.series:
+            ax.plot(s.x, s.y, label=s.label, color=s.color)
+
+        ax.spines["top"].set_visible(False)
+        ax.spines["right"].set_visible(False)
+        ax.spines["bottom"].set_color(chart.axis_color)
+        ax.spines["left"].set_color(chart.axis_color)
+        ax.yaxis.tick_left()
+        ax.xaxis.tick_bottom()
+        ax.tick_params(axis="x", width=chart.tick_width, colors=chart.axis_color,
+                       labelrotation=chart.xrotation)
+        ax.tick_params(axis="y", width=chart.tick_width, colors=chart.axis_color)
+        ax.set_xlabel("")
+        ax.set_ylabel(chart.ylabel)
+        ax.grid(False)
+        if chart.legend is not None:
+            ax.legend(**chart.legend)
+
+        buf = io.StringIO()
+        fig.savefig(buf, format="svg", **chart.savefig)
+    return buf.getvalue()
+
+
+def _warm() -> int:
+    """Pool initializer: headless backend, fonts and the SVG backend loaded once."""
+    mpl.use("Agg")
+    render_svg(LineChart([Series([0, 1], [0, 1])]))
+    return os.getpid()
+
+
+def _context():
+    """Not fork: the worker process runs threads and an event loop."""
+    if "forkserver" not in mp.get_all_start_methods():
+        return mp.get_context("spawn")
+    ctx = mp.get_context("forkserver")
+    ctx.set_forkserver_preload([__name__])          # matplotlib imported once, in the server
+    return ctx
+
+
+# ── service ────────────────────────────────────────────────────────────
+class ChartService:
+    def __init__(self, workers: int = WORKERS, timeout: float = TIMEOUT):
+        self.workers = max(workers, 0)
+        self.timeout = timeout
+        self._pool: ProcessPoolExecutor | None = None
+        self._lock   = threading.Lock()                 # pool creation
+        self._inline = threading.Lock()                 # rc_context is process-global
+        self._stats  = {"submitted": 0, "rendered": 0, "inline": 0,
+                        "failures": 0, "broken_pools": 0, "render_ms_total": 0}
+
+    def start(self) -> None:
+        """Spawn the workers now rather than on the first chart."""
+        pool = self._ensure()
+        if pool is not None:
+            for _ in range(self.workers):           # each submit spawns while none is idle
+                pool.submit(os.getpid)
+
+    def _ensure(self) -> ProcessPoolExecutor | None:
+        if not self.workers:
+            return None
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=_context(),
+                                                 initializer=_warm)
+            return self._pool
+
+    def submit(self, chart: LineChart) -> Future:
+        """Queue *chart*; the future resolves to its SVG text."""
+        self._stats["submitted"] += 1
+        t0   = time.perf_counter()
+        pool = self._ensure()
+        if pool is not None:
+            try:
+                fut = pool.submit(render_svg, chart)
+            except BrokenProcessPool:
+                self._reset(pool)
+            else:
+                fut.add_done_callback(lambda f: self._done(f, t0))
+                return fut
+        fut = Future()
+        try:
+            fut.set_result(self._render_inline(chart))
+        except Exception as exc:
+            fut.set_exception(exc)
+        self._done(fut, t0)
+        return fut
+
+    def render(self, chart: LineChart, timeout: float | None = None) -> str:
+        """Blocking ``submit()``; a chart lost to a crashed worker is redrawn inline."""
+        fut = self.submit(chart)
+        try:
+            return fut.result(self.timeout if timeout is None else timeout)
+        except BrokenProcessPool:
+            self._reset(self._pool)
+            return self._render_inline(chart)
+
+    def _render_inline(self, chart: LineChart) -> str:
+        with self._inline:
+            self._stats["inline"] += 1
+            return render_svg(chart)
+
+    def _done(self, fut: Future, t0: float) -> None:
+        if fut.cancelled() or fut.exception() is not None:
+            self._stats["failures"] += 1
+        else:
+            self._stats["rendered"] += 1
+            self._stats["render_ms_total"] += int((time.perf_counter() - t0) * 1000)
+
+    def _reset(self, pool: ProcessPoolExecutor | None) -> None:
+        with self._lock:
+            if pool is not None and self._pool is pool:
+                self._pool = None
+                self._stats["broken_pools"] += 1
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def close(self) -> None:
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self) -> dict:
+        s = dict(self._stats)
+        done = s.pop("render_ms_total")
+        return {**s, "workers": self.workers,
+                "render_ms_avg": round(done / s["rendered"]) if s["rendered"] else None}
+
+
+SERVICE = ChartService()
+submit  = SERVICE.submit
+render  = SERVICE.render
@@ -1,6 +1,7 @@
 """
 Helper for the crm-trade-invoice template:
 - PDF_OPTIONS: A4 portrait invoice settings
+- RESOURCE_WEIGHT / STAGE_TIMEOUTS / MAX_RENDER_SECONDS: worker scheduling limits
 - async get_header_html(params): inlines logo SVG and displays mandator + client info
 - async get_footer_html(params): simple footer with page numbers and optional note
 - async authenticate_blob_routes(page): inject AD Bearer token for Blob urls
@@ -9,13 +10,18 @@ Helper for the crm-trade-invoice template:
 import os
 import base64
 from datetime import datetime
-from azure.identity.aio import DefaultAzureCredential
-from azure.storage.blob.aio import BlobClient
 from playwright.async_api import Page
 
+import clients                      # process-wide credential + container clients
+
 # ─── Configuration ─────────────────────────────────────────────────────────
 STORAGE_URL = os.getenv("STORAGE_URL")
 
+# ─── Worker resource profile ───────────────────────────────────────────────
+RESOURCE_WEIGHT    = 1                                  # render slots per job
+STAGE_TIMEOUTS     = {"fetch": 20, "load": 10, "render": 10, "pdf": 20, "upload": 15}
+MAX_RENDER_SECONDS = 60
+
 # ─── Playwright PDF options ────────────────────────────────────────────────
 PDF_OPTIONS = {
     "format": "A4",
@@ -37,15 +43,12 @@ async def get_header_html(params: dict) -> str:
     logo_html = ""
     logo_url = params.get("logo_url")
     if logo_url:
-        cred = DefaultAzureCredential()
         parsed = logo_url.replace("https://", "").split("/")
         container, blob_name = parsed[1], "/".join(parsed[2:])
-        client = BlobClient(account_url=f"https://{parsed[0]}",
-                            container_name=container,
-                            blob_name=blob_name,
-                            credential=cred)
-        download = await client.download_blob()
-        data = await download.readall()
+        # another account's client is not cached – async with closes it
+        async with clients.blob(container, blob_name, account_url=f"https://{parsed[0]}") as blob:
+            download = await blob.download_blob()
+            data = await download.readall()
         b64 = base64.b64encode(data).decode("utf-8")
         logo_html = f'<img src="data:image/svg+xml;base64,{b64}" style="height:24px;"/>'
 
@@ -83,8 +86,7 @@ async def authenticate_blob_routes(page: Page) -> None:
     """
     Intercept all requests to Azure Blob Storage and attach an Azure AD Bearer token.
     """
-    cred = DefaultAzureCredential()
-    token = (await cred.get_token("https://storage.azure.com/.default")).token
+    token = (await clients.credential().get_token("https://storage.azure.com/.default")).token
     bearer = f"Bearer {token}"
     await page.route(
         "https://*.blob.core.windows.net/*",
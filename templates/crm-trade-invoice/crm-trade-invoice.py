@@ -10,10 +10,18 @@ logger = logging.getLogger(__name__)
 
 class Report:
     SETTINGS = {}
+    FETCH_STAGE = "worker"
+
     def __init__(self, process_args, engine):
         self.engine = engine
         self.input_args = process_args
         self.placeholders = {}
+
+    @staticmethod
+    def validate(params):
+        if not params.get("tradeid"):
+            raise ValueError("'tradeid' is required")
+        return params
         
     def fetch(self):
         logger.debug(self.input_args)
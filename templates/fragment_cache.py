@@ -0,0 +1,110 @@
+"""
+fragment_cache.py – reuse rendered report fragments whose input data is unchanged
+
+A report section (an HTML table, an SVG chart) is a pure function of its
+DataFrame and of the code that formats it, so it is cached under
+
+    placeholder + hash(DataFrame: values, index, columns, dtypes) + version
+
+where *version* covers the template and the shared formatting modules:
+``source_version(__file__)`` hashes the template file, which template_cache
+reloads whenever it changes, and ``loaded_version(german_format, ...)``
+combines the ``SOURCE_VERSION`` each shared module took when it was
+imported – those are never reloaded, so their files on disk may be newer
+than the code that runs.  Only sections whose rows changed are rendered
+again.  The cache is an LRU bounded by FRAGMENT_CACHE_MB of fragment text;
+``stats()`` reports hits and misses per placeholder.
+"""
+from __future__ import annotations
+
+import os, hashlib, threading
+from collections import OrderedDict
+from pathlib import Path
+
+import pandas as pd
+
+CACHE_MB     = int(os.getenv("FRAGMENT_CACHE_MB", "64"))             # 0 = off
+
+MISS = object()
+
+
+def source_version(*paths) -> str:
+    """Short digest of the given source files – bump-free template versioning."""
+    h = hashlib.sha256()
+    for p in paths:
+        h.update(Path(p).read_bytes())
+    return h.hexdigest()[:16]
+
+
+def loaded_version(*modules) -> str:
+    """Digest of the shared *modules* as imported (their ``SOURCE_VERSION``)."""
+    return hashlib.sha256("".join(m.SOURCE_VERSION for m in modules).encode()).hexdigest()[:16]
+
+
+def data_key(df, version: str) -> str:
+    """Digest of a section's input (DataFrame or None) plus *version*."""
+    h = hashlib.sha256(version.encode())
+    if isinstance(df, pd.DataFrame):
+        h.update(repr(list(df.columns)).encode())
+        h.update(repr([str(t) for t in df.dtypes]).encode())
+        h.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    else:
+        h.update(repr(df).encode())
+    return h.hexdigest()
+
+
+def _size(value) -> int:
+    return len(value) if isinstance(value, str) else 64
+
+
+class FragmentCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lru: OrderedDict[tuple[str, str], object] = OrderedDict()
+        self._bytes    = 0
+        self._lock     = threading.Lock()
+        self._counts: dict[str, list[int]] = {}            # placeholder → [hits, misses]
+        self._evictions = 0
+
+    def get(self, name: str, key: str):
+        """The cached fragment, or MISS."""
+        with self._lock:
+            row = self._counts.setdefault(name, [0, 0])
+            value = self._lru.get((name, key), MISS) if self.max_bytes else MISS
+            if value is MISS:
+                row[1] += 1
+            else:
+                row[0] += 1
+                self._lru.move_to_end((name, key))
+            return value
+
+    def put(self, name: str, key: str, value) -> None:
+        size = _size(value)
+        if not self.max_bytes or size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._lru.pop((name, key), MISS)
+            if old is not MISS:
+                self._bytes -= _size(old)
+            self._lru[(name, key)] = value
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, dropped = self._lru.popitem(last=False)
+                self._bytes -= _size(dropped)
+                self._evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._lru.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            per = {n: {"hits": h, "misses": m, "hit_rate": round(h / (h + m), 3) if h + m else None}
+                   for n, (h, m) in self._counts.items()}
+            return {"entries": len(self._lru), "mb": round(self._bytes / 2**20, 1),
+                    "max_mb": self.max_bytes >> 20, "evictions": self._evictions,
+                    "fragments": per}
+
+
+FRAGMENTS = FragmentCache(CACHE_MB << 20)
@@ -0,0 +1,252 @@
+"""
+german_format.py – column-wise Swiss/German number formatting for report tables
+
+Drop-in replacement for the per-cell ``Report.apply_german_d3_formatting`` /
+``Report.format_german`` pair: same output, cell for cell (an all-missing
+column, on which the per-cell version raised, comes back blank).
+
+* integer-digit counts (which decide thousands grouping) come from a
+  powers-of-ten ``searchsorted`` instead of stringifying every value; only
+  values Python would print in scientific notation fall back to ``str``
+* each column is factorized and only its distinct values are formatted, with
+  a single ``str.translate`` for the separators
+
+The formatting itself is still one ``str.format`` per distinct value – Python
+has no array-level equivalent of ``{:,.Nf}`` with the same rounding – so the
+gain is modest: roughly 1.2–3× over the per-cell version, most on long
+tables with repeated values (``python german_format.py`` measures it).
+
+Shared by all templates: ``from german_format import apply_german_format``.
+"""
+from __future__ import annotations
+
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+IGNORE_COLUMNS  = ("PA Nr.", "Datum (Kurs)")
+NO_DECIMAL      = ("Bestand", "Bestand (Eur)", "Bestand EUR")
+PERCENT_COLUMNS = ("1 Tag", "seit Lancierung", "%Anteil", "participationMinDE", "participationMaxDE")
+CUSTOM_DECIMALS = {
+    "Geldkurs": 2,
+    "1 Tag": 2,
+    "seit Lancierung": 2,
+    "%Anteil": 2,
+    "Kupon": 3,
+    "Kupon Level %": 2,
+    "participationMinDE": 2,
+    "participationMaxDE": 2,
+}
+MAX_AUTO_DECIMALS = 4                   # cap when decimals are taken from the data
+
+SOURCE_VERSION = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()[:16]   # as imported, for fragment_cache
+
+_POW10_F = 10.0 ** np.arange(1, 16)                     # exact in float64
+_POW10_I = 10 ** np.arange(1, 19, dtype=np.int64)
+
+
+# ── per-column measurements ────────────────────────────────────────────
+def _str_int_digits(x) -> int:
+    s = str(x)
+    return len(s.split(".")[0]) if "." in s else len(s)
+
+
+def _str_decimals(x) -> int:
+    s = str(x)
+    return len(s.split(".")[-1]) if "." in s else 0
+
+
+def int_digits(values: np.ndarray) -> int | None:
+    """
+    Longest integer part (sign included) as ``str(x)`` would print it, over
+    the non-NaN *values*; None if there are none.
+    """
+    if values.dtype.kind in "iu":
+        if values.size == 0:
+            return None
+        v = values.astype(np.int64, copy=False)
+        a = np.abs(v)
+        return int((np.searchsorted(_POW10_I, a, side="right") + 1 + (v < 0)).max())
+
+    v = values[~np.isnan(values)]
+    if v.size == 0:
+        return None
+    a   = np.abs(v)
+    # str() switches to scientific notation outside [1e-4, 1e16)
+    sci = ~np.isfinite(a) | (a >= 1e16) | ((a < 1e-4) & (a > 0))
+    fixed, best = v[~sci], 0
+    if fixed.size:
+        digits = np.searchsorted(_POW10_F, np.floor(np.abs(fixed)), side="right") + 1
+        best   = int((digits + np.signbit(fixed)).max())
+    if sci.any():
+        best = max(best, max(_str_int_digits(x) for x in np.unique(v[sci]).tolist()))
+    return best
+
+
+def max_decimals(values: np.ndarray) -> int | None:
+    """Longest fractional part as ``str(x)`` prints it (rare path: no dec_places)."""
+    if values.dtype.kind in "iu":
+        return 0 if values.size else None
+    v = values[~np.isnan(values)]
+    if v.size == 0:
+        return None
+    return max(_str_decimals(x) for x in np.unique(v).tolist())
+
+
+# ── formatting ─────────────────────────────────────────────────────────
+def format_values(values: np.ndarray, dec_places: int, grouping: bool = True,
+                  decimal: bool = True, percent: bool = False) -> np.ndarray:
+    """
+    ``format_german`` over a whole int or float array: ``{:,.Nf}`` then "."
+    for thousands (or nothing) and "," for decimals; without *decimal* the
+    fraction is cut after rounding.  NaN becomes ``"nan"`` (``"nan%"``).
+    """
+    suffix = "%" if percent else ""
+    fmt    = "{:,.%df}" % dec_places
+    table  = str.maketrans({",": "." if grouping else "", ".": ","})
+
+    if values.dtype.kind in "iu":
+        nan = np.zeros(len(values), dtype=bool)
+        codes, uniques = pd.factorize(values)
+        numbers = uniques.tolist()
+    else:
+        nan = np.isnan(values)
+        # factorize on the bit pattern so 0.0 and -0.0 keep their own text
+        codes, uniques = pd.factorize(values[~nan].view(np.int64))
+        numbers = uniques.view(np.float64).tolist()
+    if decimal:
+        texts = [fmt.format(x).translate(table) + suffix for x in numbers]
+    else:
+        texts = [fmt.format(x).split(".")[0].translate(table) + suffix for x in numbers]
+
+    out = np.empty(len(values), dtype=object)
+    out[nan]  = "nan" + suffix
+    out[~nan] = np.asarray(texts, dtype=object)[codes] if texts else []
+    return out
+
+
+def apply_german_format(df, dec_places=None, *,
+                        ignore_columns=IGNORE_COLUMNS, no_decimal=NO_DECIMAL,
+                        percent_columns=PERCENT_COLUMNS, custom_decimals=CUSTOM_DECIMALS):
+    """
+    Format every numeric column of *df* (in place, like the original) and
+    return the frame with NaN / "nan" / "nan%" cells blanked.
+
+    Grouping is used when the longest integer part exceeds five characters;
+    decimals come from *custom_decimals*, else *dec_places*, else the data
+    (capped at MAX_AUTO_DECIMALS).  Integer columns – nullable ones with NA
+    included – are formatted as integers.  An all-missing column comes back
+    blank, where the per-cell version raised.
+    """
+    if not isinstance(df, pd.DataFrame):
+        return None
+    for col in df.select_dtypes(include=np.number).columns.tolist():
+        if col in ignore_columns:
+            continue
+        series = df[col]
+        na     = None
+        if series.dtype.kind in "iu":           # numpy ints and nullable Int64 & co.
+            if series.hasnans:
+                na = series.isna().to_numpy()
+                series = series[~na]
+            raw = series.to_numpy(dtype=getattr(series.dtype, "numpy_dtype", series.dtype))
+        else:                                   # floats, nullable Float64
+            raw = series.to_numpy(dtype=np.float64, na_value=np.nan)
+        digits   = int_digits(raw)
+        grouping = digits is None or digits > 5
+
+        if col in custom_decimals:
+            maxdec = custom_decimals[col]
+        elif dec_places:
+            maxdec = dec_places
+        else:
+            maxdec = min(max_decimals(raw) or 0, MAX_AUTO_DECIMALS)
+
+        texts = format_values(raw, maxdec,
+                              grouping=grouping,
+                              decimal=col not in no_decimal,
+                              percent=col in percent_columns)
+        if na is not None:                      # NA cells stay empty
+            out = np.full(len(na), "", dtype=object)
+            out[~na] = texts
+            texts = out
+        df[col] = texts
+
+    df = df.fillna("")
+    df = df.replace("nan%", "")
+    df = df.replace("nan", "")
+    return df
+
+
+# ── benchmark: python german_format.py ────────────────────────────────
+def _reference(df, dec_places=None):
+    """The per-cell implementation this module replaces (for comparison)."""
+    def format_german(x, dec_places, grouping=True, decimal=True, percent=False):
+        if isinstance(x, (int, float)):
+            number = ("{:,.%df}" % dec_places).format(x).replace(",", "X")
+            number = number.replace(".", ",") if decimal else number.split(".")[0]
+            number = number.replace("X", "." if grouping else "")
+            return number + "%" if percent else number
+        return x + "%" if percent else x
+
+    for col in df.select_dtypes(include=np.number).columns.tolist():
+        if col in IGNORE_COLUMNS:
+            continue
+        max_digits = df[col].dropna().apply(
+            lambda x: len(str(x).split(".")[0]) if "." in str(x) else len(str(x))).max()
+        grouping = not max_digits <= 5
+        if col in CUSTOM_DECIMALS:
+            maxdec = CUSTOM_DECIMALS[col]
+        elif dec_places:
+            maxdec = dec_places
+        else:
+            maxdec = min(df[col].dropna().apply(
+                lambda x: len(str(x).split(".")[-1]) if "." in str(x) else 0).max(), 4)
+        df[col] = df[col].apply(format_german, dec_places=maxdec, grouping=grouping,
+                                decimal=col not in NO_DECIMAL, percent=col in PERCENT_COLUMNS)
+    return df.fillna("").replace("nan%", "").replace("nan", "")
+
+
+def _sample_table(rows: int, seed: int = 0) -> pd.DataFrame:
+    """Shaped like get_table4 / get_table1: text, levels, prices, percentages, holdings."""
+    rng = np.random.default_rng(seed)
+    price = np.array([round(p, d) for p, d in zip(rng.lognormal(4, 2, rows), rng.integers(0, 6, rows))])
+    price[rng.random(rows) < 0.05] = np.nan
+    return pd.DataFrame({
+        "BBG":                  rng.choice(["ABBN SW", "NESN SW", "ROG SW", "UBSG SW"], rows),
+        "Autocall Level %":     rng.choice([80.0, 90.0, 100.0, np.nan], rows),
+        "Autocall Level":       rng.normal(250, 120, rows).round(2),
+        "Kurs":                 price,
+        "% zum Autocall Level": rng.normal(0, 25, rows),
+        "1 Tag":                rng.normal(0, 2, rows),
+        "Kupon":                rng.uniform(0, 12, rows).round(4),
+        "Bestand":              rng.integers(-5_000_000, 50_000_000, rows),
+        "Tiny":                 rng.normal(0, 1e-5, rows),
+        "Huge":                 rng.choice([0.0, -0.0, 1e16, 2.5e17, np.inf], rows),
+        "Stück":                pd.array(np.where(rng.random(rows) < 0.1, None,
+                                                  rng.integers(-2_000_000, 2_000_000, rows)),
+                                         dtype="Int64"),
+    })
+
+
+if __name__ == "__main__":
+    import timeit
+
+    empty = pd.DataFrame({"Kurs": [np.nan, np.nan], "Stück": pd.array([None, None], dtype="Int64")})
+    for dec in (2, 3):
+        assert apply_german_format(empty.copy(), dec).equals(_reference(empty[["Kurs"]].copy(), dec)
+                                                             .assign(**{"Stück": ""}))
+    assert (apply_german_format(empty.copy()) == "").all(axis=None), "all-NaN columns not blank"
+
+    for rows in (100, 1000, 10000):
+        base = _sample_table(rows)
+        for dec in (2, 3, None):
+            new, old = apply_german_format(base.copy(), dec), _reference(base.copy(), dec)
+            assert new.equals(old), f"output differs (rows={rows}, dec_places={dec})"
+        reps  = max(1, 2000 // rows)
+        t_new = min(timeit.repeat(lambda: apply_german_format(base.copy(), 2), number=reps, repeat=5)) / reps
+        t_old = min(timeit.repeat(lambda: _reference(base.copy(), 2), number=reps, repeat=5)) / reps
+        print(f"{rows:>6} rows × {base.shape[1]} cols: per-cell {t_old * 1e3:8.2f} ms   "
+              f"column-wise {t_new * 1e3:7.2f} ms   ×{t_old / t_new:5.1f}")
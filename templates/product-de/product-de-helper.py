@@ -1,6 +1,7 @@
 """
 Helper for the product-de template:
 - PDF_OPTIONS: A4 portrait with margins
+- RESOURCE_WEIGHT / STAGE_TIMEOUTS / MAX_RENDER_SECONDS: worker scheduling limits
 - async get_header_html(params): inlines logo SVG and shows date
 - async get_footer_html(params): simple page number footer
 - async authenticate_blob_routes(page): inject AD Bearer token for Blob urls
@@ -9,13 +10,19 @@ Helper for the product-de template:
 import os
 import base64
 from datetime import datetime
-from azure.identity.aio import DefaultAzureCredential
-from azure.storage.blob.aio import BlobClient
 from playwright.async_api import Page
 
+import clients                      # process-wide credential + container clients
+
 # ─── Configuration ─────────────────────────────────────────────────────────
 STORAGE_URL = os.getenv("STORAGE_URL")
 
+# ─── Worker resource profile ───────────────────────────────────────────────
+# eleven queries + two matplotlib charts and a long, table-heavy page
+RESOURCE_WEIGHT    = 2                                  # render slots per job
+STAGE_TIMEOUTS     = {"fetch": 90, "load": 30, "render": 30, "pdf": 60, "upload": 30}
+MAX_RENDER_SECONDS = 180
+
 # ─── Playwright PDF options ────────────────────────────────────────────────
 PDF_OPTIONS = {
     "format": "A4",
@@ -38,16 +45,13 @@ async def get_header_html(params: dict) -> str:
     logo_html = ""
     logo_url = params.get("logo_url")
     if logo_url:
-        cred = DefaultAzureCredential()
         # parse container & blob from URL path
         parsed = logo_url.replace("https://", "").split("/")
         container, blob_name = parsed[1], "/".join(parsed[2:])
-        client = BlobClient(account_url=f"https://{parsed[0]}",
-                            container_name=container,
-                            blob_name=blob_name,
-                            credential=cred)
-        blob_data = await client.download_blob()
-        data = await blob_data.readall()
+        # another account's client is not cached – async with closes it
+        async with clients.blob(container, blob_name, account_url=f"https://{parsed[0]}") as client:
+            blob_data = await client.download_blob()
+            data = await blob_data.readall()
         b64 = base64.b64encode(data).decode("utf-8")
         logo_html = f'<img src="data:image/svg+xml;base64,{b64}" style="height:20px;"/>'
 
@@ -74,8 +78,7 @@ async def authenticate_blob_routes(page: Page) -> None:
     """
     Intercept all requests to Azure Blob Storage and attach an Azure AD Bearer token.
     """
-    cred = DefaultAzureCredential()
-    token = (await cred.get_token("https://storage.azure.com/.default")).token
+    token = (await clients.credential().get_token("https://storage.azure.com/.default")).token
     bearer = f"Bearer {token}"
     await page.route(
         "https://*.blob.core.windows.net/*",
@@ -1,23 +1,16 @@
 import threading
 import itertools
-import matplotlib.pyplot as plt
-import io
 import numpy as np
 import pandas as pd
-import matplotlib as mpl
-import matplotlib.dates as mdates
-from datetime import datetime, timedelta
+from datetime import datetime
 
-
-
-font = {
-    "family": "sans-serif",
-    "sans-serif": "DejaVu Sans",
-    "weight": "light",
-    "size": 6,
-}
-
-mpl.rc("font", **font)
+import chart_service
+import german_format
+from german_format import apply_german_format
+# charts render in chart_service's process pool (report font: chart_service.FONT_RC)
+from chart_service import LineChart, Series, render as render_chart
+from report_data import QueryBatch
+from fragment_cache import FRAGMENTS, MISS, data_key, loaded_version, source_version
 
 
 def get_header():
@@ -48,62 +41,17 @@ def get_footer():
 
 class Report:
 
+    # header carries today's date, so it is built per fetch (see fetch()) –
+    # the worker keeps this module loaded across days
     SETTINGS = {
-        "header": get_header(),
         "footer": get_footer(),
     }
-    
-    def __init__(self, process_args, engine):
-        self.engine = engine
-        self.input_args = process_args
-        self.placeholders = {}
-    
-
-    def fetch(self):
-        threads = []
-
-        for func in [
-            self.get_product_detail,
-            self.get_table1,
-            self.get_table2,
-            self.get_table2b,
-            self.get_table3,
-            self.get_table4,
-            self.get_table4b,
-            self.get_table5,
-            self.get_table6,
-            self.get_chart1,
-            self.get_chart2,
-        ]:
-            t = threading.Thread(target=func)
-            threads.append(t)
+    # all SQL + chart work runs in the worker; the API only calls validate()
+    FETCH_STAGE = "worker"
 
-        for thread in threads:
-            thread.start()
-
-        for thread in threads:
-            thread.join()
-
-        return {**self.placeholders, **self.SETTINGS}
-
-    def fetch_data(self):
-        placeholders = {
-            **self.product_detail,
-            "table1": self.get_table1(),
-            "table2": self.get_table2(),
-            "table2b": self.get_table2b(),
-            "table3": self.get_table3(),
-            "table4": self.get_table4(),
-            "table4b": self.get_table4b(),
-            "table5": self.get_table5(),
-            "table6": self.get_table6(),
-            "product_chart": self.get_chart1(),
-            "basiswert_chart": self.get_chart2(),
-        }
-        return placeholders
-
-    def get_product_detail(self):
-        query = """
+    # every section's SQL, declared together and run as one batch (see queries())
+    QUERIES = {
+        "product_detail": """
         SELECT TOP 1 [titleDe] AS [titleDe],
                 [nameDe] AS [nameDe],
                 [issuerName] AS [issuerName],
@@ -151,20 +99,8 @@ class Report:
                 [product_date] AS [product_date]
         FROM clients.products_header_info
         WHERE (isin = ?) AND (product_date = ?)
-        """
-        df = self.engine.read_sql(query, none_on_empty_df=True,  params=((self.input_args.get("isin"), self.input_args.get("date"))))
-        current_date = datetime.now().strftime("%Y/%m/%d")  # Get current date in "dd.mm.yyyy" format
-        df["product_date"] = np.where(df["product_date"] == "latest", current_date, df["product_date"])
-        df["product_date"] = pd.to_datetime(df["product_date"])
-        df["product_date"] = df["product_date"].dt.strftime("%d.%m.%Y")
-        if not len(df):
-            return {}
-
-        self.placeholders = {**self.placeholders, **df.to_dict("records")[0]}
-        return 
-
-    def get_table1(self):
-        query = """SELECT TOP 100 [Underlying_BBG] AS [BBG],
+        """,
+        "table1": """SELECT TOP 100 [Underlying_BBG] AS [BBG],
            [Underlying_NameDE] AS [Basiswert],
            [CurrencyDE] AS [Währung],
            [Initial_FixingDE] AS [Anfangsfixierung],
@@ -187,18 +123,8 @@ GROUP BY [Underlying_BBG],
          [Cap_PriceDE],
          [Underlying_Last_PriceDE],
          [Underlying_Last_Price_Date_UTCDE],
-         [Pct_InitialFixingDE];"""
-         
-        df = self.engine.read_sql(query, none_on_empty_df=True, params=((self.input_args.get("isin"), self.input_args.get("date"))))
-        ##df["Kursdatum"] = pd.to_datetime(df["Kursdatum"]).dt.date
-        df = df.dropna(axis=1, how='all')
-        df = self.apply_german_d3_formatting(df, 2)
-        self.placeholders["table1"] = self.to_mdl_html(df)
-        return
-
-
-    def get_table2(self):
-        query = """SELECT TOP 100
+         [Pct_InitialFixingDE];""",
+        "table2": """SELECT TOP 100
            [observationTypeDE] AS [Beobachtungstyp],
            [monitoringTypeDE] AS [Beobachtungsart],
            [observationdateDE] AS [Beobachtungstag],
@@ -210,20 +136,8 @@ GROUP BY [observationTypeDE],
          [monitoringTypeDE],
          [observationdateDE],
          [paymentDateDE],
-         [observationlevelpct];"""
-
-        df = self.engine.read_sql(query, none_on_empty_df=True, params=((self.input_args.get("isin"), self.input_args.get("date"))))
-        # Filter columns where all values are the same and non-NaN
-        df = df.dropna(axis=1, how='all')
-        df = self.apply_german_d3_formatting(df, 2)
-        self.placeholders["table2"] = self.to_mdl_html(df)
-        return
-    
-    
-    
-    
-    def get_table2b(self):
-        query = """SELECT TOP 100
+         [observationlevelpct];""",
+        "table2b": """SELECT TOP 100
             [PaymentDate],
            [observationTypeDE] AS [Kupontyp],
            [observationDateDE] AS [Beobachtung],
@@ -238,44 +152,8 @@ GROUP BY [observationTypeDE],
              [paymentDateDE],
              [couponAmountPctDE]
             ORDER BY 
-            [PaymentDate] DESC;""" 
-             
-        df = self.engine.read_sql(query, none_on_empty_df=True, params=((self.input_args.get("isin"), self.input_args.get("date"))))
-         # Filter columns where all values are the same and non-NaN
-        df = df.drop('PaymentDate', axis=1)
-        df = df.dropna(axis=1, how='all')
-        df = self.apply_german_d3_formatting(df, 3)
-        def transform_dataframe(df):
-            n_rows = len(df)
-            if n_rows > 3:
-                third = n_rows // 3
-                # Calculate the number of rows for each section
-                first_end = third
-                second_end = 2 * third
-                # Slice the DataFrame into three sections
-                first_section = df.iloc[:first_end+1]
-                second_section = df.iloc[first_end+1:second_end++2]
-                third_section = df.iloc[second_end+2:]
-                # Reset index for all sections
-                first_section.reset_index(drop=True, inplace=True)
-                second_section.reset_index(drop=True, inplace=True)
-                third_section.reset_index(drop=True, inplace=True)
-                # Concatenate the three sections side by side
-                result = pd.concat([first_section, second_section, third_section], axis=1)
-            else:
-                # Handle cases when there are 7 rows or less
-                result = df  # Placeholder for additional logic if needed
-            return result
-        transformed_df = transform_dataframe(df)
-        transformed_df = transformed_df.dropna(axis=1, how='all')
-        transformed_df.fillna('', inplace=True)
-        self.placeholders["table2b"] = self.to_mdl_html(transformed_df)
-        return
-    
-    
-
-    def get_table3(self):
-        query = """
+            [PaymentDate] DESC;""",
+        "table3": """
 SELECT TOP 20 [UnderlyingTicker] AS [BBG],
            [observationTypeDe] AS [Kupontyp],
            [monitoringTypeDe] AS [Beobachtungsart],
@@ -306,17 +184,8 @@ GROUP BY [UnderlyingTicker],
          [price_closeDE],
          [price_dateDE],
          [Pct_Coupon_BarrierDE];
-        """
-
-        df = self.engine.read_sql(query, none_on_empty_df=True, params=((self.input_args.get("isin"), self.input_args.get("date"))))
-         # Filter columns where all values are the same and non-NaN
-        df = df.dropna(axis=1, how='all')
-        df = self.apply_german_d3_formatting(df, 2)
-        self.placeholders["table3"] = self.to_mdl_html(df)
-        return
-
-    def get_table4(self):
-        query = """
+        """,
+        "table4": """
 SELECT TOP 1000 [UnderlyingTicker] AS [BBG],
            [observationTypeDe] AS [Beobachtungstyp],
            [observationDateDE] AS [Beobachtungstag],
@@ -339,20 +208,8 @@ GROUP BY [UnderlyingTicker],
          [price_closeDE],
          [price_dateDE],
          [pct_autocall_levelDE];
-        """
-
-        df = self.engine.read_sql(query, none_on_empty_df=True, params=((self.input_args.get("isin"), self.input_args.get("date"))))
-         # Filter columns where all values are the same and non-NaN
-        df = df.dropna(axis=1, how='all')
-        df = self.apply_german_d3_formatting(df, 2)
-        self.placeholders["table4"] = self.to_mdl_html(df)
-        return
-
-
-
-    
-    def get_table4b(self):
-        query = """SELECT TOP 100
+        """,
+        "table4b": """SELECT TOP 100
             [PaymentDate],
            [observationTypeDE] AS [Beobachtungstyp],
            [observationDateDE] AS [Beobachtungstag],
@@ -365,9 +222,286 @@ GROUP BY [UnderlyingTicker],
              [observationDateDE],
              [paymentDateDE]
             ORDER BY 
-            [PaymentDate] DESC;""" 
-             
-        df = self.engine.read_sql(query, none_on_empty_df=True, params=((self.input_args.get("isin"), self.input_args.get("date"))))
+            [PaymentDate] DESC;""",
+        "table5": """
+SELECT TOP 50 [UnderlyingTicker] AS [BBG],
+           [observationTypeDE] AS [Beobachtungstyp],
+           [monitoringTypeDE] AS [Beobachtungsart],
+           [First_Barrier_hit_DateDE] AS [Barriere Kontakt],
+           [currencyDE] AS [Währung],
+           [observationLevelPctDE] AS [Barriere in %],
+           [BarrierDE] AS [Barriere],
+           [price_closeDE] AS [Kurs],
+           [Distance_dailyDE] AS [% zur Barriere]
+FROM clients.products_barrier_obs
+WHERE (isin = ?) AND (product_date = ?)
+GROUP BY [UnderlyingTicker],
+         [Underlying_NameDE],
+         [observationTypeDE],
+         [monitoringTypeDE],
+         [First_Barrier_hit_DateDE],
+         [currencyDE],
+         [observationLevelPctDE],
+         [BarrierDE],
+         [price_closeDE],
+         [price_dateDE],
+         [Distance_dailyDE];
+        """,
+        "table6": """
+SELECT TOP 50 [observationDateDE] AS [Investition],
+           [displaynameDE] AS [Basiswert],
+           [currencyDE] AS [Währung],
+           [invested_partDE] AS [Investiert (%)],
+           [obsfixingDE] AS [Investitionsfixierung],
+           [observationlevelpctDE] AS [Level %],
+           [BarrierDE] AS [Level],
+           [Underlying_Last_PriceDE] AS [aktueller Kurs],
+           [Pct_InitialFixingDE] AS [% zu Fixierung oder Level]
+FROM clients.products_dropback_obs_hist
+WHERE (isin = ?) AND (product_date = ?)
+GROUP BY [observationDateDE],
+           [displaynameDE],
+           [currencyDE],
+           [invested_partDE],
+           [obsfixingDE],
+           [observationlevelpctDE],
+           [BarrierDE],
+           [Underlying_Last_PriceDE],
+           [Pct_InitialFixingDE]
+ORDER BY 
+            [observationlevelpctDE] DESC;
+        """,
+        "chart1": """
+    SELECT TOP 10000 DATEADD(DAY, DATEDIFF(DAY, 0, price_date), 0) AS price_date,
+               max(price_bid) AS [Geldkurs]
+    FROM clients.products_price_history
+    WHERE (isin = ?) AND (product_date = ?)
+    GROUP BY DATEADD(DAY, DATEDIFF(DAY, 0, price_date), 0)
+    ORDER BY [Geldkurs] DESC;
+        """,
+        "chart2": """
+    SELECT TOP 10000 DATEADD(DAY, DATEDIFF(DAY, 0, price_date), 0) AS __timestamp,
+            bbg_comp_ticker AS bbg_comp_ticker,
+            max(price_close) AS [Schlusskurs]
+    FROM clients.products_underlyings_price_history
+    JOIN
+    (SELECT TOP 5 bbg_comp_ticker AS bbg_comp_ticker__,
+                max(price_close) AS mme_inner__
+    FROM clients.products_underlyings_price_history
+    WHERE (isin = ?) AND (product_date = ?)
+    GROUP BY bbg_comp_ticker
+    ORDER BY mme_inner__ DESC) AS anon_1 ON bbg_comp_ticker = bbg_comp_ticker__
+    WHERE (isin = ?) AND (product_date = ?)
+    GROUP BY bbg_comp_ticker,
+            DATEADD(DAY, DATEDIFF(DAY, 0, price_date), 0)
+    ORDER BY [Schlusskurs] DESC;
+        """,
+    }
+
+    # result-cache seconds (report_data.CACHE) for the read-mostly lookups: header
+    # data and observation schedules, requested over and over for popular ISINs.
+    # Anything carrying prices stays uncached so corrections show up at once.
+    QUERY_TTL = {
+        "product_detail": 60,
+        "table2": 60,
+        "table2b": 60,
+        "table4b": 60,
+    }
+
+    # rendered tables / charts are reused while their rows and this code are unchanged
+    FRAGMENT_VERSION = source_version(__file__) + loaded_version(german_format, chart_service)
+
+    def __init__(self, process_args, engine):
+        self.engine = engine
+        self.input_args = process_args
+        self.placeholders = {}
+        self.data = None
+        self._fragment_keys = {}
+
+    @staticmethod
+    def validate(params):
+        if not params.get("isin"):
+            raise ValueError("'isin' is required")
+        return params
+
+    def queries(self):
+        key = (self.input_args.get("isin"), self.input_args.get("date"))
+        batch = QueryBatch(self.engine)
+        for name in ("product_detail", "table1", "table2", "table2b", "table3",
+                     "table4", "table4b", "table5", "table6"):
+            batch.add(name, self.QUERIES[name], key, none_on_empty_df=True,
+                      ttl=self.QUERY_TTL.get(name))
+        batch.add("chart1", self.QUERIES["chart1"], key)
+        batch.add("chart2", self.QUERIES["chart2"], key + key)
+        return batch
+
+    def _read(self, name):
+        # all sections share one batch; fetch() runs it before starting the threads
+        if self.data is None:
+            self.data = self.queries().run()
+        return self.data.frame(name)
+
+    def _cached(self, placeholder, df):
+        """Fill *placeholder* from the fragment cache if its input rows are unchanged."""
+        key = self._fragment_keys[placeholder] = data_key(df, self.FRAGMENT_VERSION)
+        fragment = FRAGMENTS.get(placeholder, key)
+        if fragment is MISS:
+            return False
+        self.placeholders[placeholder] = fragment
+        return True
+
+    def _store(self, placeholder):
+        FRAGMENTS.put(placeholder, self._fragment_keys[placeholder], self.placeholders[placeholder])
+
+    def fetch(self):
+        self.data = self.queries().run()
+        threads = []
+
+        for func in [
+            self.get_product_detail,
+            self.get_table1,
+            self.get_table2,
+            self.get_table2b,
+            self.get_table3,
+            self.get_table4,
+            self.get_table4b,
+            self.get_table5,
+            self.get_table6,
+            self.get_chart1,
+            self.get_chart2,
+        ]:
+            t = threading.Thread(target=func)
+            threads.append(t)
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        return {**self.placeholders, **self.SETTINGS, "header": get_header()}
+
+    def fetch_data(self):
+        placeholders = {
+            **self.product_detail,
+            "table1": self.get_table1(),
+            "table2": self.get_table2(),
+            "table2b": self.get_table2b(),
+            "table3": self.get_table3(),
+            "table4": self.get_table4(),
+            "table4b": self.get_table4b(),
+            "table5": self.get_table5(),
+            "table6": self.get_table6(),
+            "product_chart": self.get_chart1(),
+            "basiswert_chart": self.get_chart2(),
+        }
+        return placeholders
+
+    def get_product_detail(self):
+        df = self._read("product_detail")
+        current_date = datetime.now().strftime("%Y/%m/%d")  # Get current date in "dd.mm.yyyy" format
+        df["product_date"] = np.where(df["product_date"] == "latest", current_date, df["product_date"])
+        df["product_date"] = pd.to_datetime(df["product_date"])
+        df["product_date"] = df["product_date"].dt.strftime("%d.%m.%Y")
+        if not len(df):
+            return {}
+
+        self.placeholders.update(df.to_dict("records")[0])   # in place: other sections write concurrently
+        return 
+
+    def get_table1(self):
+        df = self._read("table1")
+        if self._cached("table1", df):
+            return
+        ##df["Kursdatum"] = pd.to_datetime(df["Kursdatum"]).dt.date
+        df = df.dropna(axis=1, how='all')
+        df = self.apply_german_d3_formatting(df, 2)
+        self.placeholders["table1"] = self.to_mdl_html(df)
+        self._store("table1")
+        return
+
+
+    def get_table2(self):
+        df = self._read("table2")
+        if self._cached("table2", df):
+            return
+        # Filter columns where all values are the same and non-NaN
+        df = df.dropna(axis=1, how='all')
+        df = self.apply_german_d3_formatting(df, 2)
+        self.placeholders["table2"] = self.to_mdl_html(df)
+        self._store("table2")
+        return
+    
+    
+    
+    
+    def get_table2b(self):
+        df = self._read("table2b")
+        if self._cached("table2b", df):
+            return
+         # Filter columns where all values are the same and non-NaN
+        df = df.drop('PaymentDate', axis=1)
+        df = df.dropna(axis=1, how='all')
+        df = self.apply_german_d3_formatting(df, 3)
+        def transform_dataframe(df):
+            n_rows = len(df)
+            if n_rows > 3:
+                third = n_rows // 3
+                # Calculate the number of rows for each section
+                first_end = third
+                second_end = 2 * third
+                # Slice the DataFrame into three sections
+                first_section = df.iloc[:first_end+1]
+                second_section = df.iloc[first_end+1:second_end++2]
+                third_section = df.iloc[second_end+2:]
+                # Reset index for all sections
+                first_section.reset_index(drop=True, inplace=True)
+                second_section.reset_index(drop=True, inplace=True)
+                third_section.reset_index(drop=True, inplace=True)
+                # Concatenate the three sections side by side
+                result = pd.concat([first_section, second_section, third_section], axis=1)
+            else:
+                # Handle cases when there are 7 rows or less
+                result = df  # Placeholder for additional logic if needed
+            return result
+        transformed_df = transform_dataframe(df)
+        transformed_df = transformed_df.dropna(axis=1, how='all')
+        transformed_df.fillna('', inplace=True)
+        self.placeholders["table2b"] = self.to_mdl_html(transformed_df)
+        self._store("table2b")
+        return
+    
+    
+
+    def get_table3(self):
+        df = self._read("table3")
+        if self._cached("table3", df):
+            return
+         # Filter columns where all values are the same and non-NaN
+        df = df.dropna(axis=1, how='all')
+        df = self.apply_german_d3_formatting(df, 2)
+        self.placeholders["table3"] = self.to_mdl_html(df)
+        self._store("table3")
+        return
+
+    def get_table4(self):
+        df = self._read("table4")
+        if self._cached("table4", df):
+            return
+         # Filter columns where all values are the same and non-NaN
+        df = df.dropna(axis=1, how='all')
+        df = self.apply_german_d3_formatting(df, 2)
+        self.placeholders["table4"] = self.to_mdl_html(df)
+        self._store("table4")
+        return
+
+
+
+    
+    def get_table4b(self):
+        df = self._read("table4b")
+        if self._cached("table4b", df):
+            return
          # Filter columns where all values are the same and non-NaN
         df = df.drop('PaymentDate', axis=1)
         df = df.dropna(axis=1, how='all')
@@ -397,6 +531,7 @@ GROUP BY [UnderlyingTicker],
         transformed_df = transformed_df.dropna(axis=1, how='all')
         transformed_df.fillna('', inplace=True)
         self.placeholders["table4b"] = self.to_mdl_html(transformed_df)
+        self._store("table4b")
         return
     
 
@@ -408,71 +543,27 @@ GROUP BY [UnderlyingTicker],
 
 
     def get_table5(self):
-        query = """
-SELECT TOP 50 [UnderlyingTicker] AS [BBG],
-           [observationTypeDE] AS [Beobachtungstyp],
-           [monitoringTypeDE] AS [Beobachtungsart],
-           [First_Barrier_hit_DateDE] AS [Barriere Kontakt],
-           [currencyDE] AS [Währung],
-           [observationLevelPctDE] AS [Barriere in %],
-           [BarrierDE] AS [Barriere],
-           [price_closeDE] AS [Kurs],
-           [Distance_dailyDE] AS [% zur Barriere]
-FROM clients.products_barrier_obs
-WHERE (isin = ?) AND (product_date = ?)
-GROUP BY [UnderlyingTicker],
-         [Underlying_NameDE],
-         [observationTypeDE],
-         [monitoringTypeDE],
-         [First_Barrier_hit_DateDE],
-         [currencyDE],
-         [observationLevelPctDE],
-         [BarrierDE],
-         [price_closeDE],
-         [price_dateDE],
-         [Distance_dailyDE];
-        """
-
-        df = self.engine.read_sql(query, none_on_empty_df=True, params=((self.input_args.get("isin"), self.input_args.get("date"))))
+        df = self._read("table5")
+        if self._cached("table5", df):
+            return
          # Filter columns where all values are the same and non-NaN
         df = df.dropna(axis=1, how='all')
         df = self.apply_german_d3_formatting(df, 2)
         self.placeholders["table5"] = self.to_mdl_html(df)
+        self._store("table5")
         return
 
 
 
     def get_table6(self):
-        query = """
-SELECT TOP 50 [observationDateDE] AS [Investition],
-           [displaynameDE] AS [Basiswert],
-           [currencyDE] AS [Währung],
-           [invested_partDE] AS [Investiert (%)],
-           [obsfixingDE] AS [Investitionsfixierung],
-           [observationlevelpctDE] AS [Level %],
-           [BarrierDE] AS [Level],
-           [Underlying_Last_PriceDE] AS [aktueller Kurs],
-           [Pct_InitialFixingDE] AS [% zu Fixierung oder Level]
-FROM clients.products_dropback_obs_hist
-WHERE (isin = ?) AND (product_date = ?)
-GROUP BY [observationDateDE],
-           [displaynameDE],
-           [currencyDE],
-           [invested_partDE],
-           [obsfixingDE],
-           [observationlevelpctDE],
-           [BarrierDE],
-           [Underlying_Last_PriceDE],
-           [Pct_InitialFixingDE]
-ORDER BY 
-            [observationlevelpctDE] DESC;
-        """
-
-        df = self.engine.read_sql(query, none_on_empty_df=True, params=((self.input_args.get("isin"), self.input_args.get("date"))))
+        df = self._read("table6")
+        if self._cached("table6", df):
+            return
          # Filter columns where all values are the same and non-NaN
         df = df.dropna(axis=1, how='all')
         df = self.apply_german_d3_formatting(df, 2)
         self.placeholders["table6"] = self.to_mdl_html(df)
+        self._store("table6")
         return
 
 
@@ -486,16 +577,10 @@ ORDER BY
 
 
     def get_chart1(self):
-        query = """
-    SELECT TOP 10000 DATEADD(DAY, DATEDIFF(DAY, 0, price_date), 0) AS price_date,
-               max(price_bid) AS [Geldkurs]
-    FROM clients.products_price_history
-    WHERE (isin = ?) AND (product_date = ?)
-    GROUP BY DATEADD(DAY, DATEDIFF(DAY, 0, price_date), 0)
-    ORDER BY [Geldkurs] DESC;
-        """
         colors = ["#13294B", "#FDC600", "#A9C13F", "#0092D0", "#747476"]
-        df = self.engine.read_sql(query, (self.input_args.get("isin"), self.input_args.get("date")))
+        df = self._read("chart1")
+        if self._cached("product_chart", df):
+            return
         df["price_date"] = pd.to_datetime(df["price_date"])
         df.set_index("price_date", inplace=True)
 
@@ -506,38 +591,13 @@ ORDER BY
         # Sort the dataframe by date
         df.sort_index(inplace=True)
 
-        fig, ax = plt.subplots(figsize=(9, 3))
-        ax.plot(df.index, df["Geldkurs"], color="grey")
-
-
-        # Hide spines
-        ax.spines["top"].set_visible(False)
-        ax.spines["right"].set_visible(False)
-        ax.spines["bottom"].set_color("grey")
-        ax.spines["left"].set_color("grey")
-    
-        ax.yaxis.tick_left()
-        ax.xaxis.tick_bottom()
-
-        # Set tick color to grey
-        ax.tick_params(axis='x', width=0.5, colors="grey")
-        ax.tick_params(axis='y', width=0.5, colors="grey")
-        plt.setp(ax.get_xticklabels(), rotation=45)
-        
-        # Change the x-axis color to grey and remove title
-        ax.tick_params(axis="x", colors="grey")
-        ax.set_xlabel("")
-        
-        
-        ax.set_ylabel("Geldkurs")
-        ax.grid(False)
-
-        svg_io = io.StringIO()
-        fig.savefig(svg_io, format="svg", bbox_inches="tight", pad_inches=0)
-        plt.close(fig)
-        svg_str = svg_io.getvalue()
-        svg_io.close()
+        svg_str = render_chart(LineChart(
+            [Series(df.index.to_numpy(), df["Geldkurs"].to_numpy(), color="grey")],
+            ylabel="Geldkurs",
+            savefig={"bbox_inches": "tight", "pad_inches": 0},
+        ))
         self.placeholders["product_chart"] = svg_str
+        self._store("product_chart")
         return 
 
 
@@ -549,37 +609,20 @@ ORDER BY
 
 
     def get_chart2(self):
-        query = """
-    SELECT TOP 10000 DATEADD(DAY, DATEDIFF(DAY, 0, price_date), 0) AS __timestamp,
-            bbg_comp_ticker AS bbg_comp_ticker,
-            max(price_close) AS [Schlusskurs]
-    FROM clients.products_underlyings_price_history
-    JOIN
-    (SELECT TOP 5 bbg_comp_ticker AS bbg_comp_ticker__,
-                max(price_close) AS mme_inner__
-    FROM clients.products_underlyings_price_history
-    WHERE (isin = ?) AND (product_date = ?)
-    GROUP BY bbg_comp_ticker
-    ORDER BY mme_inner__ DESC) AS anon_1 ON bbg_comp_ticker = bbg_comp_ticker__
-    WHERE (isin = ?) AND (product_date = ?)
-    GROUP BY bbg_comp_ticker,
-            DATEADD(DAY, DATEDIFF(DAY, 0, price_date), 0)
-    ORDER BY [Schlusskurs] DESC;
-        """
-        df = self.engine.read_sql(
-            query, (self.input_args.get("isin"), self.input_args.get("date"), self.input_args.get("isin"), self.input_args.get("date"))
-        )
+        df = self._read("chart2")
+        if self._cached("basiswert_chart", df):
+            return
         
         # passing False to hide the chart in generated report upon empty dfs
         if not len(df):
             self.placeholders["basiswert_chart"] = False
+            self._store("basiswert_chart")
             return
         
         df["__timestamp"] = pd.to_datetime(df["__timestamp"])
         df.set_index("__timestamp", inplace=True)
         df.sort_index(inplace=True, ascending=True)
         
-        fig, ax = plt.subplots(figsize=(9, 3))
         colors = ['#42546f', '#657426', '#98ae39', '#a1a9b7',
                   '#76872c', '#bacd65', '#d4e09f', '#fed74d',
                   '#515153', '#68686a', '#909091', '#acacad',
@@ -587,52 +630,23 @@ ORDER BY
                   '#111306', '#191400', '#000f15']
         
         color_cycle = itertools.cycle(colors)
-    
-        for ticker in df["bbg_comp_ticker"].unique():
-            ax.plot(
-                df[df["bbg_comp_ticker"] == ticker]["Schlusskurs"],
-                label=ticker,
-                color=next(color_cycle),
+        tickers = df["bbg_comp_ticker"].unique()
+        series = []
+        for ticker in tickers:
+            prices = df[df["bbg_comp_ticker"] == ticker]["Schlusskurs"]
+            series.append(
+                Series(prices.index.to_numpy(), prices.to_numpy(), label=ticker, color=next(color_cycle))
             )
-    
-        # Change the x-axis color to grey and remove title
-        ax.tick_params(axis="x", colors="grey")
-        ax.set_xlabel("")
-        
-        
-        # Hide spines
-        ax.spines["top"].set_visible(False)
-        ax.spines["right"].set_visible(False)
-        ax.spines["bottom"].set_color("grey")
-        ax.spines["left"].set_color("grey")
-        ax.yaxis.tick_left()
-        ax.xaxis.tick_bottom()
-        
-        plt.setp(ax.get_xticklabels(), rotation=45)
-        
-        # Set tick color to grey
-        ax.tick_params(axis='x', width=0.5, colors="grey")
-        ax.tick_params(axis='y', width=0.5, colors="grey")
-    
-        ax.set_ylabel("Preis (normalisiert auf 100)")
-    
-        # Remove grid
-        ax.grid(False)
-    
-        # Create legend with no frame, at the top and in one line
-        ax.legend(
-            frameon=False,
-            loc="upper center",
-            bbox_to_anchor=(0.5, 1.05),
-            ncol=len(df["bbg_comp_ticker"].unique()),
-        )
 
-        svg_io = io.StringIO()
-        fig.savefig(svg_io, format="svg", bbox_inches="tight")
-        plt.close(fig) 
-        svg_str = svg_io.getvalue()
-        svg_io.close()
+        # legend with no frame, at the top and in one line
+        svg_str = render_chart(LineChart(
+            series,
+            ylabel="Preis (normalisiert auf 100)",
+            legend={"frameon": False, "loc": "upper center",
+                    "bbox_to_anchor": (0.5, 1.05), "ncol": len(tickers)},
+        ))
         self.placeholders["basiswert_chart"] = svg_str
+        self._store("basiswert_chart")
         return
 
 
@@ -653,94 +667,7 @@ ORDER BY
         )
         return html_table
 
-    @staticmethod
-    def format_german(x, dec_places, grouping=True, decimal=True, percent=False):
-        if isinstance(x, (int, float)):
-            format_str = "{:,.%df}" % dec_places
-            number = format_str.format(x).replace(",", "X")
-            if decimal:
-                number = number.replace(".", ",")
-            else:
-                number = number.split(".")[0]
-
-            if grouping:
-                number = number.replace("X", ".")
-            else:
-                number = number.replace("X", "")
-
-            if percent:
-                number = number + "%"
-
-            return number
-
-        if percent:
-            x = x + "%"
-
-        return x
-
     @staticmethod
     def apply_german_d3_formatting(df, dec_places=None):
-        if not isinstance(df, pd.DataFrame):
-            return None
-        # Get numerical columns only
-        ignore_columns = ["PA Nr.", "Datum (Kurs)"]
-        no_decimal = ["Bestand", "Bestand (Eur)", "Bestand EUR"]       
-        percent_columns = ["1 Tag", "seit Lancierung", "%Anteil", "participationMinDE", "participationMaxDE"]   
-        num_cols = df.select_dtypes(include=np.number).columns.tolist()
-        custom_decimal_places = {
-            "Geldkurs": 2,
-            "1 Tag": 2,
-            "seit Lancierung": 2,
-            "%Anteil": 2,
-            "Kupon": 3,
-            "Kupon Level %": 2,
-            "participationMinDE": 2,
-            "participationMaxDE": 2,
-        }
-
-        for col in num_cols:
-            if col in ignore_columns:
-                continue
-            # Calculate maximum decimal places needed
-            grouping = True
-            max_digits = (
-                df[col]
-                .dropna()
-                .apply(
-                    lambda x: len(str(x).split(".")[0])
-                    if "." in str(x)
-                    else len(str(x))
-                )
-                .max()
-            )
-            if max_digits <= 5:
-                grouping = False
-
-            if col not in custom_decimal_places:
-                if not dec_places:
-                    maxdec = min(
-                        df[col]
-                        .dropna()
-                        .apply(
-                            lambda x: len(str(x).split(".")[-1]) if "." in str(x) else 0
-                        )
-                        .max(),
-                        4,
-                    )
-                else:
-                    maxdec = dec_places
-            else:
-                maxdec = custom_decimal_places[col]
-            # Apply german d3 formatting to the column with dynamic decimal places
-            df[col] = df[col].apply(
-                Report.format_german,
-                dec_places=maxdec,
-                grouping=grouping,
-                decimal=not col in no_decimal,
-                percent=col in percent_columns,
-            )
-
-        df = df.fillna("")
-        df = df.replace("nan%", "")
-        df = df.replace("nan", "")
-        return df
\ No newline at end of file
+        # same output as the former per-cell format_german, see german_format
+        return apply_german_format(df, dec_places)
\ No newline at end of file
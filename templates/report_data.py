@@ -0,0 +1,322 @@
+"""
+report_data.py – run a report's declared queries in one database round trip
+
+A report adds all of its queries to a ``QueryBatch`` and gets every
+DataFrame back at once:
+
+    batch = QueryBatch(self.engine)
+    batch.add("table1", SQL_TABLE1, (isin, date), none_on_empty_df=True)
+    batch.add("chart1", SQL_CHART1, (isin, date))
+    data = batch.run()
+    df = data.frame("table1")
+
+When the engine exposes a DB-API connection (``raw_connection()``, on itself
+or on ``.engine``, and not through an async driver), the statements go to Azure SQL as ONE batch with
+``SET NOCOUNT ON`` and the result sets are read back with ``nextset()``: one
+connection checkout and one network round trip instead of one per query.
+Otherwise – or if the batch fails – each query runs through
+``engine.read_sql`` (``pandas.read_sql`` for a plain SQLAlchemy engine) on
+its own thread, as the templates did before.  One broken query only fails
+its own section: ``frame()`` re-raises its error.
+
+Results are cached per process (``CACHE``) under the normalised SQL plus its
+parameters, for the query's ``ttl`` (REPORT_CACHE_TTL by default, 0 = never
+cached).  REPORT_CACHE_TTL defaults to 0, so nothing is cached unless a
+query passes its own ``ttl`` – corrected rows must show up in the next
+report, so only queries over data known to be static should.  Entries live in an LRU bounded by DataFrame memory (REPORT_CACHE_MB).  With
+REPORT_CACHE_DIR set, entries are also pickled there so worker processes on
+the node share them.  Only misses reach the database; callers always get
+their own copy.
+"""
+from __future__ import annotations
+
+import os, re, time, pickle, hashlib, logging, tempfile, threading, contextlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+CACHE_MB     = int(os.getenv("REPORT_CACHE_MB", "256"))              # 0 = no result cache
+CACHE_TTL    = int(os.getenv("REPORT_CACHE_TTL", "0"))               # seconds, 0 = opt-in per query
+CACHE_DIR    = os.getenv("REPORT_CACHE_DIR", "")                     # shared disk tier, "" = off
+
+
+@dataclass(frozen=True)
+class Query:
+    sql:              str
+    params:           tuple = ()
+    none_on_empty_df: bool = False         # same meaning as engine.read_sql's flag
+    ttl:              int | None = None    # cache seconds; None = CACHE_TTL, 0 = never
+
+
+class BatchResult:
+    def __init__(self, frames: dict, errors: dict, mode: str, ms: int, cached: tuple = ()):
+        self.frames = frames               # name → DataFrame | None
+        self.errors = errors               # name → exception
+        self.mode   = mode                 # "batch" | "parallel" | "cache"
+        self.ms     = ms
+        self.cached = cached               # names served from the result cache
+
+    def frame(self, name: str) -> pd.DataFrame | None:
+        if name in self.errors:
+            raise self.errors[name]
+        return self.frames[name]
+
+
+class QueryBatch:
+    def __init__(self, engine, cache: "ResultCache | None" = None):
+        self.engine  = engine
+        self.cache   = CACHE if cache is None else cache
+        self.queries: dict[str, Query] = {}
+
+    def add(self, name: str, sql: str, params=(), none_on_empty_df: bool = False,
+            ttl: int | None = None) -> "QueryBatch":
+        self.queries[name] = Query(sql, tuple(params), none_on_empty_df, ttl)
+        return self
+
+    def run(self) -> BatchResult:
+        t0     = time.perf_counter()
+        frames = {}
+        for name, q in self.queries.items():
+            hit, value = self.cache.get(name, q)
+            if hit:
+                frames[name] = value
+        cached  = tuple(frames)
+        pending = {n: q for n, q in self.queries.items() if n not in frames}
+        if not pending:
+            return BatchResult(frames, {}, "cache", _ms(t0), cached)
+
+        raw = _raw_connection(self.engine)
+        if raw is not None:
+            try:
+                fresh = self._run_batch(raw, pending)
+                self._store(pending, fresh)
+                return BatchResult({**frames, **fresh}, {}, "batch", _ms(t0), cached)
+            except Exception:
+                logger.warning("query batch failed – running queries one by one", exc_info=True)
+        fresh, errors = self._run_parallel(pending)
+        self._store(pending, fresh)
+        return BatchResult({**frames, **fresh}, errors, "parallel", _ms(t0), cached)
+
+    def _store(self, queries: dict, frames: dict) -> None:
+        for name, value in frames.items():
+            self.cache.put(name, queries[name], value)
+
+    # ── one round trip ─────────────────────────────────────────────────
+    def _run_batch(self, raw_connection, queries: dict) -> dict:
+        sql    = "SET NOCOUNT ON;\n" + "\n".join(q.sql.strip().rstrip(";") + ";"
+                                                for q in queries.values())
+        params = [p for q in queries.values() for p in q.params]
+        conn   = raw_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            frames = {}
+            for name, q in queries.items():
+                while cur.description is None:      # skip anything that returned no rows
+                    if not cur.nextset():
+                        raise RuntimeError(f"query batch ended before result set {name!r}")
+                cols = [d[0] for d in cur.description]
+                df   = pd.DataFrame.from_records([tuple(r) for r in cur.fetchall()],
+                                                 columns=cols, coerce_float=True)
+                frames[name] = None if q.none_on_empty_df and df.empty else df
+                cur.nextset()
+            cur.close()
+        finally:
+            conn.close()                            # back to the pool
+        return frames
+
+    # ── fallback: one read_sql per query, concurrently ─────────────────
+    def _run_parallel(self, queries: dict) -> tuple[dict, dict]:
+        frames, errors = {}, {}
+
+        def read(q: Query):
+            if hasattr(self.engine, "read_sql"):
+                return self.engine.read_sql(q.sql, none_on_empty_df=q.none_on_empty_df, params=q.params)
+            df = pd.read_sql(q.sql, self.engine, params=q.params, coerce_float=True)
+            return None if q.none_on_empty_df and df.empty else df
+
+        with ThreadPoolExecutor(len(queries)) as pool:
+            futures = {name: pool.submit(read, q) for name, q in queries.items()}
+        for name, fut in futures.items():
+            try:
+                frames[name] = fut.result()
+            except Exception as exc:
+                errors[name] = exc
+        return frames, errors
+
+
+# ── result cache ───────────────────────────────────────────────────────
+_WS = re.compile(r"\s+")
+
+def normalize_sql(sql: str) -> str:
+    """Collapse whitespace outside string literals and drop the trailing ';'."""
+    parts = sql.strip().rstrip(";").strip().split("'")
+    parts[::2] = [_WS.sub(" ", p) for p in parts[::2]]     # even parts are outside quotes
+    return "'".join(parts)
+
+
+def cache_key(q: Query) -> str:
+    raw = f"{normalize_sql(q.sql)}\x00{q.params!r}\x00{q.none_on_empty_df}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _copy(value):
+    return value.copy(deep=True) if isinstance(value, pd.DataFrame) else value
+
+
+def _nbytes(value) -> int:
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    return 64
+
+
+class ResultCache:
+    def __init__(self, max_bytes: int, ttl: int = CACHE_TTL, disk_dir: str = ""):
+        self.max_bytes = max_bytes
+        self.ttl       = ttl
+        self.disk      = Path(disk_dir) if disk_dir else None
+        self._mem: OrderedDict[str, tuple[float, object, int]] = OrderedDict()  # key → (expires, value, bytes)
+        self._bytes    = 0
+        self._lock     = threading.Lock()
+        self._stats    = {"hits": 0, "disk_hits": 0, "misses": 0, "stores": 0,
+                          "evictions": 0, "expired": 0, "disk_errors": 0}
+        self._by_name: dict[str, list[int]] = {}         # name → [hits, misses]
+        if self.disk:
+            self.disk.mkdir(parents=True, exist_ok=True)
+
+    def _ttl(self, q: Query) -> int:
+        return self.ttl if q.ttl is None else q.ttl
+
+    def get(self, name: str, q: Query) -> tuple[bool, object]:
+        """(True, copy of the cached result) or (False, None)."""
+        if not self.max_bytes or self._ttl(q) <= 0:
+            return False, None
+        key = cache_key(q)
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry and entry[0] <= time.time():
+                self._drop(key)
+                self._stats["expired"] += 1
+                entry = None
+            if entry:
+                self._mem.move_to_end(key)
+                self._count(name, "hits")
+                return True, _copy(entry[1])
+        entry = self._disk_get(key)
+        if entry:
+            self.put(name, q, entry[1], expires=entry[0], disk=False)
+            with self._lock:
+                self._count(name, "disk_hits")
+            return True, _copy(entry[1])
+        with self._lock:
+            self._count(name, "misses")
+        return False, None
+
+    def put(self, name: str, q: Query, value, *, expires: float | None = None,
+            disk: bool = True) -> None:
+        ttl = self._ttl(q)
+        if not self.max_bytes or ttl <= 0:
+            return
+        key, size = cache_key(q), _nbytes(value)
+        if size > self.max_bytes:
+            return
+        expires = time.time() + ttl if expires is None else expires
+        value   = _copy(value)                   # the caller keeps mutating its own frame
+        with self._lock:
+            self._drop(key)
+            self._mem[key] = (expires, value, size)
+            self._bytes += size
+            self._stats["stores"] += 1
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._mem)))
+                self._stats["evictions"] += 1
+        if disk:
+            self._disk_put(key, expires, value)
+
+    def _drop(self, key: str) -> None:
+        entry = self._mem.pop(key, None)
+        if entry:
+            self._bytes -= entry[2]
+
+    def _count(self, name: str, kind: str) -> None:
+        self._stats[kind] += 1
+        row = self._by_name.setdefault(name, [0, 0])
+        row[kind == "misses"] += 1
+
+    # ── shared disk tier ───────────────────────────────────────────────
+    def _disk_get(self, key: str):
+        if not self.disk:
+            return None
+        path = self.disk / f"{key}.pkl"
+        try:
+            with path.open("rb") as fh:
+                expires, value = pickle.load(fh)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            self._stats["disk_errors"] += 1
+            return None
+        if expires <= time.time():
+            path.unlink(missing_ok=True)
+            return None
+        return expires, value
+
+    def _disk_put(self, key: str, expires: float, value) -> None:
+        if not self.disk:
+            return
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.disk, suffix=".tmp")
+            with os.fdopen(fd, "wb") as fh:
+                pickle.dump((expires, value), fh, protocol=pickle.HIGHEST_PROTOCOL)
+            path = self.disk / f"{key}.pkl"
+            os.replace(tmp, path)                          # readers never see a partial file
+            os.utime(path, (expires, expires))             # mtime = expiry, for _sweep()
+        except Exception:
+            self._stats["disk_errors"] += 1
+            logger.warning("report cache: disk write failed", exc_info=True)
+        else:
+            self._sweep()
+
+    def _sweep(self) -> None:
+        """Every 100th store: remove expired files written by any process."""
+        if self._stats["stores"] % 100:
+            return
+        now = time.time()
+        for path in self.disk.glob("*.pkl"):             # type: ignore[union-attr]
+            with contextlib.suppress(OSError):
+                if path.stat().st_mtime <= now:
+                    path.unlink(missing_ok=True)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._mem.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["disk_hits"] + self._stats["misses"]
+            return {**self._stats, "entries": len(self._mem), "mb": round(self._bytes / 2**20, 1),
+                    "max_mb": self.max_bytes >> 20, "disk": bool(self.disk),
+                    "hit_rate": round((lookups - self._stats["misses"]) / lookups, 3) if lookups else None,
+                    "queries": {n: {"hits": h, "misses": m} for n, (h, m) in self._by_name.items()}}
+
+
+CACHE = ResultCache(CACHE_MB << 20, CACHE_TTL, CACHE_DIR)
+
+
+def _raw_connection(engine):
+    for obj in (engine, getattr(engine, "engine", None)):
+        fn = getattr(obj, "raw_connection", None)
+        if callable(fn):
+            # an async engine's sync facade only works inside its event loop
+            return None if getattr(getattr(obj, "dialect", None), "is_async", False) else fn
+    return None
+
+
+def _ms(t0: float) -> int:
+    return int((time.perf_counter() - t0) * 1000)
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# shared template modules are imported flat, as the worker does with SCRIPTS_DIR
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "templates"))
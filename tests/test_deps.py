@@ -0,0 +1,63 @@
+import importlib
+import struct
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+import sqlalchemy as sa
+
+pytest.importorskip("pyodbc", exc_type=ImportError)        # needs unixODBC, as in the images
+
+APP = Path(__file__).resolve().parents[1] / "app"
+
+
+class FakeCredential:
+    def __init__(self):
+        self.calls = 0
+
+    def get_token(self, scope):
+        self.calls += 1
+        return SimpleNamespace(token="eyJ0b2tlbg", expires_on=time.time() + 3600)
+
+
+@pytest.fixture
+def deps(monkeypatch):
+    monkeypatch.setenv("SQL_SERVER", "example.database.windows.net")
+    monkeypatch.setenv("SQL_DB", "PdfCore")
+    monkeypatch.syspath_prepend(str(APP))
+    module = importlib.import_module("deps")
+    monkeypatch.setattr(module.SQL_TOKEN, "_credential", FakeCredential())
+    yield module
+    module.SQL_TOKEN.close()
+    for name in ("deps", "db"):
+        sys.modules.pop(name, None)
+
+
+@pytest.mark.parametrize("engine", ["SYNC_ENGINE", "ASYNC_ENGINE"])
+def test_connect_hook_supplies_the_access_token(deps, engine):
+    engine = getattr(deps, engine)
+    engine = getattr(engine, "sync_engine", engine)
+    assert sa.event.contains(engine, "do_connect", deps._inject_token)
+
+    cparams = {}
+    engine.dialect.dispatch.do_connect(engine.dialect, None, [], cparams)
+
+    token = cparams["attrs_before"][deps.SQL_COPT_SS_ACCESS_TOKEN]
+    (size,) = struct.unpack_from("<I", token)
+    assert token[4:].decode("utf-16-le") == "eyJ0b2tlbg" and size == len(token) - 4
+
+
+def test_connect_hook_reuses_the_cached_token(deps):
+    for _ in range(3):
+        deps.SYNC_ENGINE.dialect.dispatch.do_connect(deps.SYNC_ENGINE.dialect, None, [], {})
+    assert deps.SQL_TOKEN._credential.calls == 1
+    assert deps.SQL_TOKEN.stats()["connects"] == 3
+
+
+def test_connection_string_has_no_authentication_keyword(deps):
+    url = sa.engine.make_url(deps.build_url())
+    odbc = url.query["odbc_connect"]
+    assert "Authentication=" not in odbc
+    assert "Server=tcp:example.database.windows.net,1433;" in odbc and "Database=PdfCore;" in odbc
@@ -0,0 +1,64 @@
+import importlib
+import importlib.util
+import sys
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+import chart_service
+import german_format
+from fragment_cache import MISS, FragmentCache, data_key, loaded_version, source_version
+
+TEMPLATES = Path(__file__).resolve().parents[1] / "templates"
+
+SHARED = '''
+import hashlib
+from pathlib import Path
+
+SOURCE_VERSION = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()[:16]
+DECIMALS = {decimals}
+'''
+
+
+@pytest.fixture
+def shared_module(tmp_path, monkeypatch):
+    path = tmp_path / "shared_fmt.py"
+    path.write_text(SHARED.format(decimals=2))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    yield path
+    sys.modules.pop("shared_fmt", None)
+
+
+def test_version_follows_the_loaded_code_not_the_file(shared_module):
+    mod = importlib.import_module("shared_fmt")
+    before = loaded_version(mod)
+
+    shared_module.write_text(SHARED.format(decimals=3))     # edited, not reloaded
+    assert mod.DECIMALS == 2
+    assert loaded_version(mod) == before
+
+    mod = importlib.reload(mod)
+    assert mod.DECIMALS == 3
+    assert loaded_version(mod) != before
+
+
+def test_template_version_combines_its_file_and_the_loaded_helpers():
+    path = TEMPLATES / "product-de" / "product-de.py"
+    spec = importlib.util.spec_from_file_location("tpl_product-de", path)   # as template_cache does
+    mod  = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+
+    assert mod.Report.FRAGMENT_VERSION == (source_version(path)
+                                           + loaded_version(german_format, chart_service))
+
+
+def test_fragments_are_keyed_by_data_and_version():
+    cache = FragmentCache(1 << 20)
+    df = pd.DataFrame({"Kurs": [1.5, 2.5]})
+    cache.put("table1", data_key(df, "v1"), "<table/>")
+
+    assert cache.get("table1", data_key(df.copy(), "v1")) == "<table/>"
+    assert cache.get("table1", data_key(df, "v2")) is MISS
+    assert cache.get("table1", data_key(df.assign(Kurs=[1.5, 2.6]), "v1")) is MISS
+    assert cache.stats()["fragments"]["table1"] == {"hits": 1, "misses": 2, "hit_rate": 0.333}
@@ -0,0 +1,231 @@
+import sqlite3
+
+import pandas as pd
+import pytest
+import sqlalchemy as sa
+
+import report_data
+from report_data import Query, QueryBatch, ResultCache
+
+
+class MultiResultCursor:
+    """pyodbc-style cursor over sqlite: one execute() of a ';' batch, nextset() between results."""
+
+    def __init__(self, db, log):
+        self.db, self.log = db, log
+        self.sets, self.i = [], 0
+
+    def execute(self, sql, params):
+        self.log.append(sql)
+        params, self.sets, self.i = list(params), [], 0
+        for stmt in filter(None, (s.strip() for s in sql.split(";"))):
+            if stmt.startswith("SET "):
+                continue
+            n   = stmt.count("?")
+            cur = self.db.execute(stmt, params[:n])
+            params = params[n:]
+            self.sets.append((cur.description, cur.fetchall()))
+
+    @property
+    def description(self):
+        return self.sets[self.i][0] if self.i < len(self.sets) else None
+
+    def fetchall(self):
+        return self.sets[self.i][1]
+
+    def nextset(self):
+        self.i += 1
+        return self.i < len(self.sets)
+
+    def close(self):
+        pass
+
+
+class RawConnection:
+    def __init__(self, db, log):
+        self.db, self.log, self.closed = db, log, False
+
+    def cursor(self):
+        return MultiResultCursor(self.db, self.log)
+
+    def close(self):
+        self.closed = True
+
+
+class BatchEngine:
+    """Exposes raw_connection() only: a failed batch would have nothing to fall back to."""
+
+    def __init__(self, db):
+        self.db, self.log, self.connections = db, [], []
+
+    def raw_connection(self):
+        conn = RawConnection(self.db, self.log)
+        self.connections.append(conn)
+        return conn
+
+
+@pytest.fixture
+def db():
+    db = sqlite3.connect(":memory:", check_same_thread=False)
+    db.execute("CREATE TABLE prices (isin TEXT, d TEXT, v REAL)")
+    db.executemany("INSERT INTO prices VALUES (?, ?, ?)",
+                   [("A", "x", 1.5), ("A", "x", 2.5), ("B", "x", 3.0)])
+    db.commit()
+    return db
+
+
+def _batch(engine):
+    return (QueryBatch(engine, cache=ResultCache(0))
+            .add("a", "SELECT v FROM prices WHERE isin = ? AND d = ?;", ("A", "x"))
+            .add("empty", "SELECT v FROM prices WHERE isin = ?", ("Z",), none_on_empty_df=True)
+            .add("both", "SELECT * FROM prices WHERE isin = ? OR isin = ?", ("A", "B")))
+
+
+def test_batch_runs_all_queries_in_one_round_trip(db):
+    engine = BatchEngine(db)
+    result = _batch(engine).run()
+
+    assert result.mode == "batch"
+    assert len(engine.log) == 1 and engine.log[0].startswith("SET NOCOUNT ON;")
+    assert len(engine.connections) == 1 and engine.connections[0].closed
+    assert result.frame("a")["v"].tolist() == [1.5, 2.5]
+    assert result.frame("empty") is None
+    assert len(result.frame("both")) == 3
+
+
+def test_sqlalchemy_engine_batches_through_its_raw_connection(db):
+    engine = sa.create_engine("sqlite://", creator=lambda: db, poolclass=sa.pool.StaticPool)
+    log = []
+    # sqlite cursors cannot run a multi-statement batch: hand out the pyodbc-style wrapper
+    engine.raw_connection = lambda: RawConnection(db, log)
+
+    result = _batch(engine).run()
+    assert result.mode == "batch"
+    assert len(log) == 1
+
+
+def test_async_engine_facade_is_not_batched(db):
+    engine = sa.create_engine("sqlite://", creator=lambda: db, poolclass=sa.pool.StaticPool)
+    engine.dialect.is_async = True               # what ASYNC_ENGINE.sync_engine reports
+    result = _batch(engine).run()
+
+    assert result.mode == "parallel"
+    assert result.frame("a")["v"].tolist() == [1.5, 2.5]
+    assert result.frame("empty") is None
+
+
+def test_failing_query_only_fails_its_own_frame(db):
+    engine = sa.create_engine("sqlite://", creator=lambda: db, poolclass=sa.pool.StaticPool)
+    engine.dialect.is_async = True
+    result = (QueryBatch(engine, cache=ResultCache(0))
+              .add("a", "SELECT v FROM prices WHERE isin = ?", ("A",))
+              .add("bad", "SELECT nope FROM prices").run())
+
+    assert result.frame("a")["v"].tolist() == [1.5, 2.5]
+    with pytest.raises(Exception):
+        result.frame("bad")
+
+
+# ── ResultCache ────────────────────────────────────────────────────────
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(report_data.time, "time", lambda: now[0])
+    return now
+
+
+def _frame(rows: int) -> pd.DataFrame:
+    return pd.DataFrame({"v": [float(i) for i in range(rows)]})
+
+
+def _size(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def test_cache_entries_expire_after_their_ttl(clock):
+    cache = ResultCache(1 << 20, ttl=0)
+    q = Query("SELECT v FROM prices WHERE isin = ?", ("A",), ttl=60)
+    cache.put("a", q, _frame(3))
+
+    clock[0] += 59
+    assert cache.get("a", q)[0]
+    clock[0] += 2
+    assert cache.get("a", q) == (False, None)
+    assert cache.stats()["expired"] == 1
+
+
+def test_queries_without_a_ttl_follow_the_default(clock):
+    q = Query("SELECT 1")
+    off, on = ResultCache(1 << 20, ttl=0), ResultCache(1 << 20, ttl=30)
+    off.put("q", q, _frame(1))
+    on.put("q", q, _frame(1))
+    assert off.get("q", q) == (False, None)
+    assert on.get("q", q)[0]
+
+
+def test_cache_evicts_least_recently_used_by_bytes(clock):
+    df = _frame(100)
+    cache = ResultCache(2 * _size(df) + _size(df) // 2, ttl=60)     # room for two
+    a, b, c = (Query(f"SELECT {n}") for n in "abc")
+    cache.put("a", a, df)
+    cache.put("b", b, df)
+    cache.get("a", a)                                               # a is now newer than b
+    cache.put("c", c, df)
+
+    assert cache.get("b", b) == (False, None)
+    assert cache.get("a", a)[0] and cache.get("c", c)[0]
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["mb"] <= cache.max_bytes / 2**20
+
+
+def test_cache_hands_out_copies(clock):
+    cache = ResultCache(1 << 20, ttl=60)
+    q = Query("SELECT v")
+    df = _frame(2)
+    cache.put("q", q, df)
+    df.loc[0, "v"] = 99.0
+    hit = cache.get("q", q)[1]
+    hit.loc[1, "v"] = 99.0
+    assert cache.get("q", q)[1]["v"].tolist() == [0.0, 1.0]
+
+
+def test_disk_tier_is_shared_between_caches(clock, tmp_path):
+    q = Query("SELECT v FROM prices WHERE isin = ?", ("A",))
+    ResultCache(1 << 20, ttl=60, disk_dir=str(tmp_path)).put("a", q, _frame(3))
+    other = ResultCache(1 << 20, ttl=60, disk_dir=str(tmp_path))    # another worker process
+
+    hit, df = other.get("a", q)
+    assert hit and df["v"].tolist() == [0.0, 1.0, 2.0]
+    assert other.stats()["disk_hits"] == 1
+
+    clock[0] += 61
+    fresh = ResultCache(1 << 20, ttl=60, disk_dir=str(tmp_path))
+    assert fresh.get("a", q) == (False, None)
+    assert not list(tmp_path.glob("*.pkl"))                        # expired file removed
+
+
+def test_cache_counts_hits_and_misses_per_query(clock):
+    cache = ResultCache(1 << 20, ttl=60)
+    a, b = Query("SELECT  v\n FROM t"), Query("SELECT 2")
+    cache.get("a", a)
+    cache.put("a", a, _frame(1))
+    cache.get("a", Query("SELECT v FROM t;"))                       # same SQL, normalised
+    cache.get("b", b)
+
+    stats = cache.stats()
+    assert stats["queries"] == {"a": {"hits": 1, "misses": 1}, "b": {"hits": 0, "misses": 1}}
+    assert (stats["hits"], stats["misses"], stats["hit_rate"]) == (1, 2, 0.333)
+
+
+def test_batch_serves_cached_queries_without_the_database(db, clock):
+    engine = BatchEngine(db)
+    cache = ResultCache(1 << 20, ttl=0)
+    batch = lambda: (QueryBatch(engine, cache=cache)
+                     .add("a", "SELECT v FROM prices WHERE isin = ?", ("A",), ttl=60)
+                     .add("both", "SELECT * FROM prices", ()))
+    batch().run()
+    result = batch().run()
+
+    assert result.cached == ("a",)
+    assert result.frame("a")["v"].tolist() == [1.5, 2.5]
+    assert "isin = ?" not in engine.log[-1]                         # only the miss was sent
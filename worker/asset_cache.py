@@ -0,0 +1,119 @@
+"""
+asset_cache.py – local cache for third-party template assets (CDN CSS, fonts)
+
+Requests to the configured hosts are intercepted via Playwright routing and
+answered from an on-disk store (plus an in-memory copy).  The store is filled
+at start-up from ASSET_PRELOAD_URLS and on first use; with offline=True a
+miss is aborted instead of going to the network, so renders are
+deterministic and work without egress.
+"""
+from __future__ import annotations
+
+import os, re, json, hashlib, contextlib
+from pathlib import Path
+
+# response headers worth replaying (fonts need CORS, CSS needs its type)
+_KEEP_HEADERS = ("content-type", "access-control-allow-origin", "cache-control")
+_CSS_URL_RE   = re.compile(r"url\((['\"]?)(https://[^)'\"]+)\1\)")
+
+
+class AssetCache:
+    def __init__(self, directory: str, hosts: list[str], offline: bool = False):
+        self.dir     = Path(directory)
+        self.hosts   = [h.strip() for h in hosts if h.strip()]
+        self.offline = offline
+        self.pattern = re.compile(
+            r"^https://(" + "|".join(re.escape(h) for h in self.hosts) + r")/"
+        )
+        self._mem: dict[str, tuple[int, dict, bytes]] = {}
+        self._stats = {"hits": 0, "misses": 0, "errors": 0, "bytes_served": 0}
+        self.dir.mkdir(parents=True, exist_ok=True)
+
+    # ── storage ────────────────────────────────────────────────────────
+    @staticmethod
+    def _key(url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def _get(self, url: str):
+        key = self._key(url)
+        if key in self._mem:
+            return self._mem[key]
+        meta, body = self.dir / f"{key}.json", self.dir / f"{key}.body"
+        with contextlib.suppress(OSError, ValueError):
+            info  = json.loads(meta.read_text())
+            entry = (info["status"], info["headers"], body.read_bytes())
+            self._mem[key] = entry
+            return entry
+        return None
+
+    def _put(self, url: str, status: int, headers: dict, body: bytes) -> None:
+        key     = self._key(url)
+        headers = {k: v for k, v in headers.items() if k.lower() in _KEEP_HEADERS}
+        self._mem[key] = (status, headers, body)
+        for suffix, data in ((".body", body),
+                             (".json", json.dumps({"url": url, "status": status,
+                                                   "headers": headers}).encode())):
+            tmp = self.dir / f"{key}{suffix}.tmp"
+            tmp.write_bytes(data)
+            os.replace(tmp, self.dir / f"{key}{suffix}")   # atomic for readers
+
+    # ── Playwright integration ─────────────────────────────────────────
+    async def install(self, context) -> None:
+        """Route matching requests of *context* (all its pages) through the cache."""
+        if self.hosts:
+            await context.route(self.pattern, self._handle)
+
+    async def _handle(self, route, request) -> None:
+        if request.method != "GET":
+            await route.continue_()
+            return
+        entry = self._get(request.url)
+        if entry:
+            self._stats["hits"] += 1
+            self._stats["bytes_served"] += len(entry[2])
+            await route.fulfill(status=entry[0], headers=entry[1], body=entry[2])
+            return
+
+        self._stats["misses"] += 1
+        if self.offline:
+            await route.abort("internetdisconnected")
+            return
+        try:
+            resp = await route.fetch()
+            body = await resp.body()
+        except Exception:
+            self._stats["errors"] += 1
+            await route.abort()
+            return
+        if resp.ok:
+            self._put(request.url, resp.status, resp.headers, body)
+        await route.fulfill(response=resp, body=body)
+
+    async def preload(self, request_context, urls: list[str]) -> None:
+        """Fill the store at start-up; CSS is scanned for referenced fonts."""
+        pending, seen = [u.strip() for u in urls if u.strip()], set()
+        while pending:
+            url = pending.pop()
+            if url in seen or not self.pattern.match(url):
+                continue
+            seen.add(url)
+            entry = self._get(url)
+            if not entry:
+                try:
+                    resp = await request_context.get(url)
+                    body = await resp.body()
+                except Exception:
+                    self._stats["errors"] += 1
+                    continue
+                if not resp.ok:
+                    self._stats["errors"] += 1
+                    continue
+                entry = (resp.status, resp.headers, body)
+                self._put(url, *entry)
+            if "css" in {k.lower(): v for k, v in entry[1].items()}.get("content-type", ""):
+                pending.extend(m.group(2) for m in _CSS_URL_RE.finditer(entry[2].decode(errors="ignore")))
+
+    def stats(self) -> dict:
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {**self._stats, "entries": len(self._mem),
+                "hit_rate": round(self._stats["hits"] / lookups, 3) if lookups else None}
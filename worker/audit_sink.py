@@ -0,0 +1,171 @@
+"""
+audit_sink.py – buffered writer for the render audit table
+
+Renders call ``record()``, which only appends to a bounded in-memory queue.
+A single flusher task drains it as multi-row INSERTs, as soon as
+*batch_size* rows are waiting or *flush_every* seconds after the first one.
+Rows that do not fit into the queue, or whose INSERT failed, are appended to
+a local JSONL spool and replayed once the database accepts writes again, so
+a slow or unavailable SQL server never holds up a render.
+"""
+from __future__ import annotations
+
+import os, json, asyncio, contextlib
+from pathlib import Path
+
+import sqlalchemy as sa
+
+COLUMNS  = ("id", "template", "payload_id", "duration_ms", "success", "error_msg")
+MAX_ROWS = 2000 // len(COLUMNS)         # SQL Server: ≤ 2100 parameters per statement
+
+
+class AuditSink:
+    def __init__(self, engine, table: str, *, max_queue: int = 10000,
+                 batch_size: int = 200, flush_every: float = 1.0,
+                 spool_dir: str = "/tmp/nava-audit", replay_every: float = 60.0,
+                 log=lambda *a, **kw: None):
+        self.engine       = engine
+        self.table        = table
+        self.batch_size   = max(1, min(batch_size, MAX_ROWS))
+        self.flush_every  = flush_every
+        self.replay_every = replay_every
+        self.spool        = Path(spool_dir) / "audit-spool.jsonl"
+        self._log         = log
+        self._queue: asyncio.Queue = asyncio.Queue(max_queue)
+        self._task: asyncio.Task | None = None
+        self._stmts: dict[int, sa.TextClause] = {}
+        self._stats = {"recorded": 0, "written": 0, "batches": 0, "spooled": 0,
+                       "replayed": 0, "errors": 0}
+        self.spool.parent.mkdir(parents=True, exist_ok=True)
+
+    # ── producer side ──────────────────────────────────────────────────
+    def record(self, run_id, payload_id, tpl, dur_ms, ok, err) -> None:
+        row = dict(id=str(run_id), template=tpl, payload_id=payload_id,
+                   duration_ms=dur_ms, success=ok, error_msg=err)
+        self._stats["recorded"] += 1
+        try:
+            self._queue.put_nowait(row)
+        except asyncio.QueueFull:
+            self._spool([row])
+
+    # ── lifecycle ──────────────────────────────────────────────────────
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        """Flush everything still queued, then stop."""
+        if self._task and not self._task.done():
+            await self._queue.put(None)
+            await self._task
+
+    # ── flusher ────────────────────────────────────────────────────────
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        next_replay = loop.time()
+        while True:
+            try:
+                first = await asyncio.wait_for(self._queue.get(), self.replay_every)
+            except asyncio.TimeoutError:
+                first = ...                         # idle – only replay
+            rows, stop = [], first is None
+            if first not in (None, ...):
+                rows.append(first)
+                deadline = loop.time() + self.flush_every
+                while len(rows) < self.batch_size:
+                    try:
+                        row = self._queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        timeout = deadline - loop.time()
+                        if timeout <= 0:
+                            break
+                        try:
+                            row = await asyncio.wait_for(self._queue.get(), timeout)
+                        except asyncio.TimeoutError:
+                            break
+                    if row is None:
+                        stop = True
+                        break
+                    rows.append(row)
+            if rows and not await self._write(rows):
+                self._spool(rows)
+            elif loop.time() >= next_replay and self._has_spool():
+                await self._replay()
+                next_replay = loop.time() + self.replay_every
+            if stop:
+                await self._drain()
+                return
+
+    async def _drain(self) -> None:
+        """Rows recorded after close(): written in batches, spooled at once on failure."""
+        rows = []
+        while not self._queue.empty():
+            row = self._queue.get_nowait()
+            if row is not None:
+                rows.append(row)
+        for i in range(0, len(rows), self.batch_size):
+            if not await self._write(rows[i:i + self.batch_size]):
+                self._spool(rows[i:])
+                return
+
+    def _stmt(self, n: int) -> sa.TextClause:
+        if n not in self._stmts:
+            values = ", ".join("(" + ", ".join(f":{c}_{i}" for c in COLUMNS) + ")"
+                               for i in range(n))
+            self._stmts[n] = sa.text(
+                f"INSERT INTO {self.table} ({', '.join(COLUMNS)}) VALUES {values}")
+        return self._stmts[n]
+
+    async def _write(self, rows: list[dict]) -> bool:
+        try:
+            async with self.engine.begin() as conn:
+                for i in range(0, len(rows), self.batch_size):
+                    chunk  = rows[i:i + self.batch_size]
+                    params = {f"{c}_{j}": row[c] for j, row in enumerate(chunk) for c in COLUMNS}
+                    await conn.execute(self._stmt(len(chunk)), params)
+        except Exception as exc:
+            self._stats["errors"] += 1
+            self._log("audit.error", rows=len(rows), err=str(exc))
+            return False
+        self._stats["written"] += len(rows)
+        self._stats["batches"] += 1
+        return True
+
+    # ── local spool ────────────────────────────────────────────────────
+    def _spool(self, rows: list[dict]) -> None:
+        with self.spool.open("a") as fh:
+            fh.writelines(json.dumps(r) + "\n" for r in rows)
+        self._stats["spooled"] += len(rows)
+
+    def _has_spool(self) -> bool:
+        return self.spool.exists() or self.spool.with_suffix(".replay").exists()
+
+    async def _replay(self) -> None:
+        """
+        Write the spool back in batches.  The spool is first moved aside to
+        ``.replay`` so new overflow goes to a fresh file; a partly replayed
+        ``.replay`` keeps only its unwritten rows and is finished first on
+        the next run, then the spool that filled up meanwhile follows – the
+        two files are replayed in sequence, never merged.
+        """
+        replay = self.spool.with_suffix(".replay")
+        while replay.exists() or self.spool.exists():
+            if not replay.exists():
+                os.replace(self.spool, replay)
+            rows = []
+            with replay.open() as fh:
+                for line in fh:
+                    with contextlib.suppress(ValueError):
+                        rows.append(json.loads(line))
+            for i in range(0, len(rows), self.batch_size):
+                if not await self._write(rows[i:i + self.batch_size]):
+                    with replay.open("w") as fh:    # keep what is left for next time
+                        fh.writelines(json.dumps(r) + "\n" for r in rows[i:])
+                    return
+                self._stats["replayed"] += len(rows[i:i + self.batch_size])
+            replay.unlink()
+            self._log("audit.replayed", rows=len(rows))
+
+    def stats(self) -> dict:
+        return {**self._stats, "queued": self._queue.qsize(),
+                "spool_pending": self._has_spool()}
@@ -0,0 +1,288 @@
+"""
+browser_pool.py – pre-warmed Playwright page pools and browser shards for the worker
+"""
+from __future__ import annotations
+
+import os, asyncio, contextlib
+from dataclasses import dataclass
+
+from procstats import rss_by_marker
+
+
+@dataclass
+class _Slot:
+    context: object
+    page:    object
+    uses:    int = 0
+
+
+class PagePool:
+    """
+    Keeps up to *size* idle (context, page) pairs warm on *browser*.
+
+    Every page gets its own context so cookies / storage never leak between
+    jobs.  On release the page is reset (page routes, storage, DOM) and
+    returned to the pool, or closed once it has served *max_uses* jobs.
+    *setup(context)* runs once per new context; routes it installs on the
+    context survive the reset.
+    """
+
+    def __init__(self, browser, size: int, max_uses: int, media: str = "screen",
+                 setup=None):
+        self.browser  = browser
+        self.size     = max(size, 1)
+        self.max_uses = max(max_uses, 1)
+        self.media    = media
+        self.setup    = setup
+        self._idle: asyncio.Queue[_Slot] = asyncio.Queue()
+        self._stats = {"hits": 0, "misses": 0, "recycled": 0, "discarded": 0}
+
+    # ── lifecycle ──────────────────────────────────────────────────────
+    async def start(self) -> None:
+        for _ in range(self.size):
+            self._idle.put_nowait(await self._new_slot())
+
+    async def close(self) -> None:
+        while not self._idle.empty():
+            await self._close_slot(self._idle.get_nowait())
+
+    # ── lease / return ─────────────────────────────────────────────────
+    @contextlib.asynccontextmanager
+    async def page(self):
+        """Lease a clean page for one job; broken pages are not reused."""
+        slot = await self._acquire()
+        healthy = False
+        try:
+            yield slot.page
+            healthy = True
+        finally:
+            await self._release(slot, healthy)
+
+    async def _acquire(self) -> _Slot:
+        try:
+            slot = self._idle.get_nowait()
+            self._stats["hits"] += 1
+        except asyncio.QueueEmpty:
+            slot = await self._new_slot()
+            self._stats["misses"] += 1
+        slot.uses += 1
+        return slot
+
+    async def _release(self, slot: _Slot, healthy: bool) -> None:
+        if not healthy:
+            self._stats["discarded"] += 1
+        elif slot.uses >= self.max_uses:
+            self._stats["recycled"] += 1
+        elif self._idle.qsize() < self.size:
+            try:
+                await self._reset(slot)
+                self._idle.put_nowait(slot)
+                return
+            except Exception:
+                self._stats["discarded"] += 1
+        await self._close_slot(slot)
+
+    # ── helpers ────────────────────────────────────────────────────────
+    async def _new_slot(self) -> _Slot:
+        context = await self.browser.new_context()
+        if self.setup:
+            await self.setup(context)
+        page    = await context.new_page()
+        await page.emulate_media(media=self.media)
+        return _Slot(context, page)
+
+    async def _reset(self, slot: _Slot) -> None:
+        page = slot.page
+        await page.unroute_all(behavior="ignoreErrors")
+        await page.evaluate(
+            "() => { try { localStorage.clear(); sessionStorage.clear(); } catch (e) {} }"
+        )
+        await slot.context.clear_cookies()
+        await page.goto("about:blank")
+
+    @staticmethod
+    async def _close_slot(slot: _Slot) -> None:
+        with contextlib.suppress(Exception):
+            await slot.context.close()
+
+    def stats(self) -> dict:
+        return {**self._stats, "idle": self._idle.qsize(), "size": self.size}
+
+
+# ── multi-browser sharding ─────────────────────────────────────────────
+class BrowserCrashed(RuntimeError):
+    """The browser serving a job died mid-render; the job may be retried."""
+
+
+class BrowserShard:
+    """One Chromium process plus its page pool."""
+
+    def __init__(self, fleet: "BrowserFleet", idx: int):
+        self.fleet    = fleet
+        self.idx      = idx
+        self.marker   = f"--nava-shard={os.getpid()}-{idx}"
+        self.state    = "down"            # down | up | draining | crashed | restarting
+        self.browser  = None
+        self.pool: PagePool | None = None
+        self.inflight = 0
+        self.renders  = 0
+        self.restarts = 0
+        self.rss      = 0
+        self._closing = False
+
+    async def launch(self) -> None:
+        self._closing = False
+        self.browser  = await self.fleet.browser_type.launch(
+            args=["--no-sandbox", self.marker]
+        )
+        self.browser.on("disconnected", lambda _: self._on_disconnect())
+        self.pool = PagePool(self.browser, self.fleet.pool_size, self.fleet.max_uses,
+                             setup=self.fleet.setup)
+        await self.pool.start()
+        self.renders, self.rss, self.state = 0, 0, "up"
+        self.fleet._ready.set()
+
+    async def close(self) -> None:
+        self._closing = True
+        if self.pool:
+            await self.pool.close()
+        if self.browser:
+            with contextlib.suppress(Exception):
+                await self.browser.close()
+        self.state = "down"
+
+    async def restart(self, reason: str) -> None:
+        if self.state == "restarting":
+            return
+        self.state = "restarting"
+        self.fleet.log("browser.restart", shard=self.idx, reason=reason,
+                       renders=self.renders, rss_mb=self.rss >> 20)
+        await self.close()
+        delay = 1.0
+        while not self.fleet.closed:
+            try:
+                await self.launch()
+                self.restarts += 1
+                return
+            except Exception as exc:
+                self.fleet.log("browser.launch.error", shard=self.idx, err=str(exc))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30.0)
+
+    def _on_disconnect(self) -> None:
+        if self._closing or self.fleet.closed:
+            return
+        self.state = "crashed"
+        self.fleet.spawn(self.restart("crash"))
+
+    @property
+    def connected(self) -> bool:
+        return bool(self.browser and self.browser.is_connected())
+
+    def stats(self) -> dict:
+        return {"shard": self.idx, "state": self.state, "inflight": self.inflight,
+                "renders": self.renders, "restarts": self.restarts,
+                "rss_mb": self.rss >> 20,
+                **(self.pool.stats() if self.pool else {})}
+
+
+class BrowserFleet:
+    """
+    Runs *shards* Chromium instances and routes each job to the least-loaded
+    healthy one.  A shard is drained and relaunched after *recycle_after*
+    renders or once its process tree exceeds *max_rss_mb*; a crashed shard
+    is relaunched in the background while the others keep serving.
+    """
+
+    def __init__(self, browser_type, shards: int, pool_size: int, max_uses: int,
+                 recycle_after: int, max_rss_mb: int, log=lambda *a, **kv: None,
+                 check_every: float = 10.0, setup=None):
+        self.browser_type  = browser_type
+        self.pool_size     = pool_size
+        self.max_uses      = max_uses
+        self.recycle_after = recycle_after
+        self.max_rss       = max_rss_mb << 20
+        self.check_every   = check_every
+        self.log           = log
+        self.setup         = setup
+        self.closed        = False
+        self.shards        = [BrowserShard(self, i) for i in range(max(shards, 1))]
+        self._ready        = asyncio.Event()
+        self._tasks: set[asyncio.Task] = set()
+
+    # ── lifecycle ──────────────────────────────────────────────────────
+    async def start(self) -> None:
+        await asyncio.gather(*(s.launch() for s in self.shards))
+        self.spawn(self._watch())
+
+    async def close(self) -> None:
+        self.closed = True
+        for t in list(self._tasks):
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await asyncio.gather(*(s.close() for s in self.shards), return_exceptions=True)
+
+    def spawn(self, coro) -> None:
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    # ── routing ────────────────────────────────────────────────────────
+    async def _pick(self) -> BrowserShard:
+        while True:
+            up = [s for s in self.shards if s.state == "up"]
+            if up:
+                return min(up, key=lambda s: s.inflight)
+            self._ready.clear()
+            await self._ready.wait()
+
+    @contextlib.asynccontextmanager
+    async def page(self):
+        """Lease a page from the least-loaded shard."""
+        shard = await self._pick()
+        browser = shard.browser
+        shard.inflight += 1
+        try:
+            async with shard.pool.page() as page:     # type: ignore[union-attr]
+                yield page
+        except Exception as exc:
+            if not shard.connected:
+                raise BrowserCrashed(f"browser shard {shard.idx} crashed") from exc
+            raise
+        finally:
+            shard.inflight -= 1
+            # a render on a browser that has since crashed / been replaced
+            # says nothing about the current one
+            if shard.browser is browser and shard.state in ("up", "draining"):
+                shard.renders += 1
+                if shard.state == "up" and shard.renders >= self.recycle_after:
+                    shard.state = "draining"
+                if shard.state == "draining" and shard.inflight == 0:
+                    self.spawn(shard.restart("recycle"))
+
+    def rss(self) -> int:
+        """Bytes held by all browser process trees (as of the last check)."""
+        return sum(s.rss for s in self.shards)
+
+    # ── background health / RSS check ──────────────────────────────────
+    async def _watch(self) -> None:
+        while not self.closed:
+            await asyncio.sleep(self.check_every)
+            markers = {s.marker: s for s in self.shards}
+            rss = await asyncio.get_running_loop().run_in_executor(
+                None, rss_by_marker, list(markers))
+            for marker, shard in markers.items():
+                shard.rss = rss.get(marker, 0)
+                if shard.state == "up" and not shard.connected:
+                    shard._on_disconnect()
+                elif shard.state == "up" and self.max_rss and shard.rss > self.max_rss:
+                    shard.state = "draining"
+                    self.log("browser.drain", shard=shard.idx, rss_mb=shard.rss >> 20)
+                if shard.state == "draining" and shard.inflight == 0:
+                    self.spawn(shard.restart("rss" if shard.rss > self.max_rss > 0 else "recycle"))
+
+    def stats(self) -> dict:
+        shards = [s.stats() for s in self.shards]
+        return {"hits":   sum(s.get("hits", 0) for s in shards),
+                "misses": sum(s.get("misses", 0) for s in shards),
+                "shards": shards}
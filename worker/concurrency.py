@@ -0,0 +1,142 @@
+"""
+concurrency.py – adaptive limit on in-flight renders (AIMD)
+
+``async with LIMITER.slot(weight):`` replaces the fixed semaphore; a heavy
+template occupies several slots (never more than the current limit, so it
+can always run on its own).  Every *interval* the
+worker feeds the controller Chromium's total RSS and node CPU; together with
+the render latencies observed since the last step it either
+
+* cuts the limit multiplicatively when memory, CPU or latency says the node
+  is overloaded (or a browser just crashed), or
+* raises it by one when every slot was in use and nothing looked
+  strained,
+
+always staying within [floor, ceiling].  Latency is judged per template
+against that template's own near-best time, so a heavy report and a tiny
+invoice share one controller.
+"""
+from __future__ import annotations
+
+import time, asyncio, contextlib
+from collections import deque
+
+
+class AdaptiveLimiter:
+    def __init__(self, floor: int, ceiling: int, initial: int, *,
+                 rss_high: int = 0, cpu_high: float = 0.85,
+                 latency_factor: float = 2.0, decrease: float = 0.7):
+        self.floor          = max(floor, 1)
+        self.ceiling        = max(ceiling, self.floor)
+        self.limit          = min(max(initial, self.floor), self.ceiling)
+        self.rss_high       = rss_high                  # bytes; 0 = ignore memory
+        self.cpu_high       = cpu_high
+        self.latency_factor = latency_factor
+        self.decrease       = decrease
+        self.in_flight      = 0
+        self._waiters: deque[tuple[asyncio.Future, int]] = deque()
+        self._peak          = 0                         # max in_flight + waiting this step
+        self._baseline: dict[str, float] = {}           # per-key near-best latency
+        self._ratios: list[float] = []                  # latency / baseline this step
+        self._last_cut      = 0.0
+        self._gauges        = {"decision": "init", "cpu": None, "rss_mb": None,
+                               "latency_ratio": None}
+        self._stats         = {"increases": 0, "decreases": 0}
+
+    # ── slots ──────────────────────────────────────────────────────────
+    async def acquire(self, weight: int = 1) -> int:
+        """Wait for *weight* slots (FIFO); returns the number actually taken."""
+        weight = max(weight, 1)
+        if not self._waiters and self._fits(weight):
+            return self._take(weight)
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append((fut, weight))
+        self._peak = max(self._peak, self.in_flight + sum(w for _, w in self._waiters))
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(fut.result())              # granted, then cancelled
+            else:
+                self._waiters = deque(x for x in self._waiters if x[0] is not fut)
+                self._wake()                            # we may have blocked lighter jobs
+            raise
+
+    def release(self, taken: int = 1) -> None:
+        self.in_flight -= taken
+        self._wake()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, weight: int = 1):
+        taken = await self.acquire(weight)
+        try:
+            yield
+        finally:
+            self.release(taken)
+
+    def _fits(self, weight: int) -> bool:
+        # an over-weight job runs alone instead of waiting forever
+        return self.in_flight + min(weight, self.limit) <= self.limit
+
+    def _take(self, weight: int) -> int:
+        taken = min(weight, self.limit)
+        self.in_flight += taken
+        self._peak = max(self._peak, self.in_flight)
+        return taken
+
+    def _wake(self) -> None:
+        while self._waiters and self._fits(self._waiters[0][1]):
+            fut, weight = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(self._take(weight))
+
+    # ── signals ────────────────────────────────────────────────────────
+    def observe(self, key: str, ms: float) -> None:
+        """Record one render; the baseline follows the best times, drifting up slowly."""
+        base = self._baseline.get(key)
+        base = ms if base is None else min(ms, base + (ms - base) * 0.01)
+        self._baseline[key] = base
+        self._ratios.append(ms / base if base > 0 else 1.0)
+
+    def backoff(self, reason: str) -> None:
+        """Immediate multiplicative decrease, e.g. after a browser crash."""
+        self._cut(reason)
+
+    def _cut(self, reason: str) -> None:
+        if time.monotonic() - self._last_cut < 1.0:   # one cut per burst of bad news
+            return
+        self._last_cut = time.monotonic()
+        new = max(self.floor, int(self.limit * self.decrease))
+        if new < self.limit:
+            self._stats["decreases"] += 1
+        self.limit = new
+        self._gauges["decision"] = f"decrease:{reason}"
+
+    def adjust(self, rss: int, cpu: float | None) -> str:
+        """One control step; returns the decision taken."""
+        ratios, self._ratios = sorted(self._ratios), []
+        ratio = ratios[len(ratios) // 2] if ratios else None
+        self._gauges.update(cpu=None if cpu is None else round(cpu, 2),
+                            rss_mb=rss >> 20,
+                            latency_ratio=None if ratio is None else round(ratio, 2))
+        demand, self._peak = self._peak, self.in_flight
+
+        if self.rss_high and rss > self.rss_high:
+            self._cut("rss")
+        elif cpu is not None and cpu > self.cpu_high:
+            self._cut("cpu")
+        elif ratio is not None and ratio > self.latency_factor:
+            self._cut("latency")
+        elif demand >= self.limit and self.limit < self.ceiling:
+            self.limit += 1
+            self._stats["increases"] += 1
+            self._gauges["decision"] = "increase"
+            self._wake()
+        else:
+            self._gauges["decision"] = "hold"
+        return self._gauges["decision"]
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "in_flight": self.in_flight,
+                "waiting": len(self._waiters), "floor": self.floor,
+                "ceiling": self.ceiling, **self._gauges, **self._stats}
@@ -0,0 +1,69 @@
+"""
+procstats.py – cheap /proc readers for Chromium memory and node CPU (Linux only)
+"""
+from __future__ import annotations
+
+import os
+
+_PAGE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def _processes() -> dict[int, tuple[int, str, int]]:
+    """Return {pid: (ppid, cmdline, rss_bytes)} for every readable process."""
+    procs: dict[int, tuple[int, str, int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "rb") as f:
+                stat = f.read().decode(errors="replace")
+            with open(f"/proc/{entry}/cmdline", "rb") as f:
+                cmd = f.read().replace(b"\0", b" ").decode(errors="replace")
+            with open(f"/proc/{entry}/statm", "rb") as f:
+                rss = int(f.read().split()[1]) * _PAGE
+        except (OSError, IndexError, ValueError):
+            continue                      # process vanished or not ours
+        # comm may contain spaces/parens – ppid is the 2nd field after ")"
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        procs[int(entry)] = (ppid, cmd, rss)
+    return procs
+
+
+def rss_by_marker(markers: list[str]) -> dict[str, int]:
+    """
+    Sum RSS of every process tree whose root command line contains a marker.
+
+    Each browser shard is launched with a unique ``--nava-shard=<id>`` switch;
+    renderer / GPU / zygote processes are descendants of that root.
+    """
+    if not os.path.isdir("/proc"):
+        return {m: 0 for m in markers}
+    procs    = _processes()
+    children: dict[int, list[int]] = {}
+    for pid, (ppid, _, _) in procs.items():
+        children.setdefault(ppid, []).append(pid)
+
+    out = {m: 0 for m in markers}
+    for pid, (ppid, cmd, _) in procs.items():
+        marker = next((m for m in markers if m in cmd.split()), None)
+        # only count the root of the tree, not children that echo the switch
+        if marker is None or marker in procs.get(ppid, (0, "", 0))[1].split():
+            continue
+        stack = [pid]
+        while stack:
+            cur = stack.pop()
+            out[marker] += procs[cur][2]
+            stack.extend(children.get(cur, ()))
+    return out
+
+
+def cpu_times() -> tuple[int, int]:
+    """(busy, total) jiffies since boot from the aggregate ``cpu`` line of /proc/stat."""
+    try:
+        with open("/proc/stat", "rb") as f:
+            fields = [int(x) for x in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return 0, 0
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)      # idle + iowait
+    total = sum(fields[:8])                                       # guest time is in user
+    return total - idle, total
@@ -0,0 +1,66 @@
+"""
+template_cache.py – process-wide cache of compiled Jinja templates and
+template modules, keyed by file path + fingerprint (mtime, size, inode).
+
+A ConfigMap update swaps the file underneath us; the next lookup sees a new
+fingerprint and rebuilds, while unchanged templates are never re-read.
+"""
+from __future__ import annotations
+
+import os, importlib.util
+from pathlib import Path
+from typing import Any, Callable
+
+from jinja2 import Environment, BaseLoader, select_autoescape
+
+
+def _fingerprint(path: Path) -> tuple[int, int, int]:
+    st = os.stat(path)                     # follows ConfigMap ..data symlinks
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+class FileCache:
+    """{path: (fingerprint, value)} – *build(path)* runs only on change."""
+
+    def __init__(self, build: Callable[[Path], Any]):
+        self._build   = build
+        self._entries: dict[Path, tuple[tuple[int, int, int], Any]] = {}
+        self.hits = self.misses = 0
+
+    def get(self, path: Path) -> Any:
+        fp    = _fingerprint(path)
+        entry = self._entries.get(path)
+        if entry and entry[0] == fp:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = self._build(path)
+        self._entries[path] = (fp, value)
+        return value
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+# ── builders ───────────────────────────────────────────────────────────
+_ENV = Environment(loader=BaseLoader(),
+                   autoescape=select_autoescape(default_for_string=True))
+
+
+def _compile_html(path: Path):
+    return _ENV.from_string(path.read_text())
+
+
+def _exec_module(path: Path):
+    spec = importlib.util.spec_from_file_location(f"tpl_{path.stem}", path)
+    mod  = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)  # type: ignore[union-attr]
+    return mod
+
+
+TEMPLATES = FileCache(_compile_html)
+MODULES   = FileCache(_exec_module)
+
+
+def stats() -> dict:
+    return {"templates": TEMPLATES.stats(), "modules": MODULES.stats()}
@@ -3,33 +3,68 @@ worker.py – Playwright-based PDF renderer (queue & helpers)
 """
 from __future__ import annotations
 
-import os, json, uuid, asyncio, signal, logging, traceback, contextlib, importlib, re
-from datetime import datetime, timedelta
+import os, sys, json, gzip, time, uuid, asyncio, signal, logging, traceback, contextlib, importlib, re
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
+from types import ModuleType
+from dataclasses import dataclass, field
 import tempfile
 
-from jinja2 import Environment, BaseLoader, select_autoescape
-import sqlalchemy as sa
-from azure.identity.aio import DefaultAzureCredential
-from azure.servicebus.aio import ServiceBusClient
-from azure.storage.blob.aio import BlobClient
-from playwright.async_api import async_playwright
+from azure.core.exceptions import ResourceNotFoundError
+from playwright.async_api import async_playwright, TimeoutError as PlaywrightTimeout
 
-from deps import ASYNC_ENGINE
+from deps import ASYNC_ENGINE, SYNC_ENGINE, SQL_TOKEN
+import clients
+from browser_pool import BrowserFleet, BrowserCrashed
+from asset_cache import AssetCache
+from audit_sink import AuditSink
+from concurrency import AdaptiveLimiter
+from procstats import cpu_times
+import template_cache
 
 # ── Environment & config ────────────────────────────────────────────────
-SB_NAMESPACE = os.getenv("SB_NAMESPACE")
-SB_QUEUE     = os.getenv("SB_QUEUE")
-STORAGE_URL  = os.getenv("STORAGE_URL")
+SB_QUEUE     = os.getenv("SB_QUEUE")                                 # interactive lane
+BULK_QUEUE   = os.getenv("SB_QUEUE_BULK") or SB_QUEUE                # unset = one lane
+LANE_WEIGHT  = int(os.getenv("SB_INTERACTIVE_WEIGHT", "3"))          # : 1 for bulk
+LANE_IDLE    = 30                                                    # s without interactive work
 PAYLOAD_CTN  = os.getenv("PAYLOAD_CONTAINER")
 OUTPUT_CTN   = os.getenv("OUTPUT_CONTAINER", "pdfs")
-CONCURRENCY  = int(os.getenv("WORKER_CONCURRENCY", "3"))
+CONCURRENCY  = int(os.getenv("WORKER_CONCURRENCY", "3"))             # initial render limit
+MIN_RENDERS  = int(os.getenv("WORKER_CONCURRENCY_MIN", "1"))
+MAX_RENDERS  = int(os.getenv("WORKER_CONCURRENCY_MAX", str(CONCURRENCY * 4)))
+ADAPT_EVERY  = float(os.getenv("CONCURRENCY_ADJUST_INTERVAL", "10"))  # seconds
+CPU_HIGH     = float(os.getenv("CONCURRENCY_CPU_HIGH", "0.85"))      # node CPU share
+LAT_FACTOR   = float(os.getenv("CONCURRENCY_LATENCY_FACTOR", "2.0")) # × template best
 MAX_DELIVERY = int(os.getenv("MAX_DELIVERY", "5"))
 AUDIT_TABLE  = os.getenv("PDF_AUDIT_TABLE", "PdfLog")
+AUDIT_QUEUE  = int(os.getenv("AUDIT_QUEUE_MAX", "10000"))          # rows held in memory
+AUDIT_BATCH  = int(os.getenv("AUDIT_BATCH_SIZE", "200"))            # rows per INSERT
+AUDIT_FLUSH  = int(os.getenv("AUDIT_FLUSH_MS", "1000")) / 1000      # seconds
+AUDIT_SPOOL  = os.getenv("AUDIT_SPOOL_DIR", "/tmp/nava-audit")
+SHARDS       = int(os.getenv("BROWSER_SHARDS", "1"))
+POOL_SIZE    = int(os.getenv("PAGE_POOL_SIZE", str(-(-CONCURRENCY // SHARDS))))  # per shard
+RECYCLE_N    = int(os.getenv("BROWSER_RECYCLE_AFTER", "1000"))      # renders
+MAX_RSS_MB   = int(os.getenv("BROWSER_MAX_RSS_MB", "1536"))         # 0 = off
+PAGE_MAX_USE = int(os.getenv("PAGE_MAX_USES", "100"))
+LOAD_MODE    = os.getenv("PAGE_LOAD_MODE", "inline")                # inline | file
+READY_WAIT   = float(os.getenv("RENDER_READY_TIMEOUT", "15"))       # seconds
+STAGE_SECS   = float(os.getenv("STAGE_TIMEOUT", "120"))             # default per stage
+MAX_RENDER   = float(os.getenv("RENDER_MAX_SECONDS", "300"))        # default per job
+ASSET_DIR    = os.getenv("ASSET_CACHE_DIR", "/tmp/nava-assets")
+ASSET_HOSTS  = os.getenv("ASSET_CACHE_HOSTS",
+                         "cdnjs.cloudflare.com,fonts.googleapis.com,fonts.gstatic.com").split(",")
+ASSET_URLS   = os.getenv("ASSET_PRELOAD_URLS", "").split(",")
+OFFLINE      = os.getenv("ASSET_OFFLINE", "0") == "1"
+STATS_EVERY  = int(os.getenv("STATS_INTERVAL", "60"))                # seconds
+RSS_HIGH_MB  = int(os.getenv("CONCURRENCY_RSS_MB",                   # all browsers; 0 = off
+                             str(int(MAX_RSS_MB * SHARDS * 0.85))))
+SETTLE_WAIT  = int(os.getenv("SB_SETTLE_LINGER_MS", "20")) / 1000    # seconds
 
 # Template path & validation
 TPL_RE       = re.compile(r"[A-Za-z0-9_-]{1,64}$")
 TEMPLATE_DIR = Path(os.getenv("SCRIPTS_DIR", "/opt/app/scripts")).resolve()
+if str(TEMPLATE_DIR) not in sys.path:                    # shared modules, e.g. german_format
+    sys.path.insert(0, str(TEMPLATE_DIR))
 
 DEFAULT_PDF_OPTIONS = {
     "format": "A4",
@@ -39,13 +74,22 @@ DEFAULT_PDF_OPTIONS = {
     "margin": {"top": "20mm", "bottom": "20mm", "left": "10mm", "right": "10mm"},
 }
 
-sem         = asyncio.Semaphore(CONCURRENCY)
+LIMITER     = AdaptiveLimiter(MIN_RENDERS, MAX_RENDERS, CONCURRENCY,
+                              rss_high=RSS_HIGH_MB << 20, cpu_high=CPU_HIGH,
+                              latency_factor=LAT_FACTOR)
 stop_event  = asyncio.Event()
-credential  = DefaultAzureCredential()
 logger      = logging.getLogger("pdf-worker")
 logging.basicConfig(level=logging.INFO, format="%(message)s")
-BROWSER:   asyncio.AbstractAsyncContextManager | None = None
-_active_tasks: set[asyncio.Task] = set()
+FLEET:     BrowserFleet | None = None
+ASSETS:    AssetCache | None = None
+AUDIT:     AuditSink | None = None
+CHARTS:    ModuleType | None = None          # chart_service, if mounted
+DATA:      ModuleType | None = None          # report_data, if mounted
+FRAGS:     ModuleType | None = None          # fragment_cache, if mounted
+_active_tasks: dict[asyncio.Task, tuple[str, int]] = {}     # task → (lane, weight)
+_slot_freed  = asyncio.Event()
+_timings: dict[str, list[float]] = {"queue_wait_ms_interactive": [], "queue_wait_ms_bulk": [],
+                                    "render_ms": []}
 
 _ts   = lambda: datetime.utcnow().isoformat(timespec="milliseconds") + "Z"
 _log  = lambda ev, **kv: logger.info(json.dumps({"ts": _ts(), "event": ev, **kv}))
@@ -62,157 +106,474 @@ def _load_template(name: str):
         if p.exists() and not str(p).startswith(str(TEMPLATE_DIR)):
             raise ValueError("template path escape detected")
 
-    mod = None
-    if py.is_file():
-        spec = importlib.util.spec_from_file_location(f"tpl_{name}", py)
-        mod  = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(mod)  # type: ignore[arg-type]
-
     if not html.is_file():
         raise FileNotFoundError(html)
-    return mod, html, js if js.is_file() else None
-
-
-async def _insert_log(run_id, payload_id, tpl, dur_ms, ok, err):
-    stmt = sa.text(f"""
-        INSERT INTO {AUDIT_TABLE}
-               (id, template, payload_id, duration_ms, success, error_msg)
-        VALUES (:run_id, :tpl, :pid, :dur, :succ, :err)
-    """)
-    async with ASYNC_ENGINE.begin() as conn:
-        await conn.execute(
-            stmt,
-            dict(run_id=run_id, tpl=tpl, pid=payload_id,
-                 dur=dur_ms, succ=ok, err=err)
-        )
+    mod = template_cache.MODULES.get(py) if py.is_file() else None
+    return mod, template_cache.TEMPLATES.get(html), js if js.is_file() else None
 
-# ── core render routine ────────────────────────────────────────────────
-async def _render_pdf(payload_id: str):
-    async with sem:
-        run_id, start = str(uuid.uuid4()), datetime.utcnow()
-        tpl_name = "<unknown>"
-        tmp_path = None
-        try:
-            # 1. Download payload JSON
-            blob = BlobClient(account_url=STORAGE_URL,
-                              container_name=PAYLOAD_CTN,
-                              blob_name=payload_id,
-                              credential=credential)
-            payload = json.loads(await blob.download_blob().readall())
-            tpl_name, params = payload["template"], payload.get("params", {})
-
-            # 2. Load template + optional data fetch
-            mod, html_path, js_path = _load_template(tpl_name)
-            if mod and hasattr(mod, "Report"):
-                report = mod.Report(params, ASYNC_ENGINE.sync_engine)  # type: ignore[arg-type]
-                placeholders = await asyncio.get_running_loop().run_in_executor(None, report.fetch)
-                params |= placeholders
-
-            # 3. Render Jinja (auto-escaped)
-            env = Environment(loader=BaseLoader(),
-                              autoescape=select_autoescape(default_for_string=True))
-            rendered = env.from_string(html_path.read_text()).render(**params)
 
-            with tempfile.NamedTemporaryFile("w", suffix=".html", delete=False) as tmp:
-                tmp.write(rendered)
-                tmp_path = tmp.name
+def _shared(name: str):
+    """Shared template module from SCRIPTS_DIR; None when no template ships it."""
+    try:
+        return importlib.import_module(name)
+    except ModuleNotFoundError:
+        return None
 
-            # 4. Playwright
-            page = await BROWSER.new_page()          # type: ignore[arg-type]
-            await page.emulate_media(media="screen")
 
-            # Optional helper module
-            try:
-                helper_mod = importlib.import_module(f"templates.{tpl_name.replace('-', '_')}_helper")
-                await helper_mod.authenticate_blob_routes(page)
-            except ModuleNotFoundError:
-                helper_mod = None
+async def _is_rendered(payload_id: str, payload_modified) -> bool:
+    """True if ``{payload_id}.pdf`` was written after the payload it renders."""
+    try:
+        props = await clients.blob(OUTPUT_CTN, f"{payload_id}.pdf").get_blob_properties()
+    except ResourceNotFoundError:
+        return False
+    return props.last_modified > payload_modified
+
+# ── per-template resource profile ──────────────────────────────────────
+# A template's helper module may declare
+#   RESOURCE_WEIGHT    = 2                       render slots one job occupies
+#   STAGE_TIMEOUTS     = {"fetch": 90, ...}      seconds per stage (see STAGES)
+#   MAX_RENDER_SECONDS = 180                     whole job once it holds its slots
+# Anything not declared falls back to weight 1 / STAGE_TIMEOUT / RENDER_MAX_SECONDS.
+STAGES = ("fetch", "load", "render", "pdf", "upload")
+
+class StageTimeout(TimeoutError):
+    def __init__(self, stage: str, seconds: float):
+        super().__init__(f"{stage} stage exceeded {seconds:g}s")
+        self.stage = stage
+
+@dataclass(frozen=True)
+class _Profile:
+    weight:      int = 1
+    timeouts:    dict = field(default_factory=lambda: dict.fromkeys(STAGES, STAGE_SECS))
+    max_seconds: float = MAX_RENDER
+
+def _helper(tpl_name: str):
+    try:
+        return importlib.import_module(f"templates.{tpl_name.replace('-', '_')}_helper")
+    except ModuleNotFoundError:
+        return None
+
+def _profile(helper) -> _Profile:
+    if helper is None:
+        return _Profile()
+    return _Profile(weight=int(getattr(helper, "RESOURCE_WEIGHT", 1)),
+                    timeouts={**dict.fromkeys(STAGES, STAGE_SECS),
+                              **getattr(helper, "STAGE_TIMEOUTS", {})},
+                    max_seconds=float(getattr(helper, "MAX_RENDER_SECONDS", MAX_RENDER)))
+
+async def _stage(name: str, aw, timeouts: dict):
+    try:
+        return await asyncio.wait_for(aw, timeouts[name])
+    except asyncio.TimeoutError:
+        raise StageTimeout(name, timeouts[name]) from None
 
-            await page.goto(f"file://{tmp_path}", wait_until="networkidle")
+# ── Playwright stage ───────────────────────────────────────────────────
+# A template may expose ``window.renderDone`` (a promise resolved once charts,
+# fonts etc. are in place); without it we fall back to network-idle.
+_READY_JS = "() => window.renderDone ? Promise.resolve(window.renderDone).then(() => true) : false"
+
+READY_MARGIN = 2.0                      # s of the render stage kept for window.render itself
+
+async def _wait_ready(page, tpl_name: str, inline: bool, budget: float) -> None:
+    """Wait for renderDone (or network-idle) – but never past the render stage."""
+    wait = max(min(READY_WAIT, budget - READY_MARGIN), 0.5)
+    try:
+        signalled = await asyncio.wait_for(page.evaluate(_READY_JS), wait)
+    except asyncio.TimeoutError:
+        _log("pdf.ready.timeout", tpl=tpl_name, timeout_s=wait)
+        return
+    if not signalled and inline:
+        with contextlib.suppress(PlaywrightTimeout):
+            await page.wait_for_load_state("networkidle", timeout=wait * 1000)
+
+async def _print_pdf(tpl_name: str, params: dict, rendered: str,
+                     tmp_path: str | None, js_path, helper_mod, timeouts: dict) -> bytes:
+    async with FLEET.page() as page:         # type: ignore[union-attr]
+        if helper_mod:
+            await helper_mod.authenticate_blob_routes(page)
+
+        async def load():
+            if tmp_path:
+                await page.goto(f"file://{tmp_path}", wait_until="networkidle")
+            else:
+                await page.set_content(rendered, wait_until="load")
             if js_path:
                 await page.add_script_tag(path=str(js_path))
+
+        async def render():
+            started = time.monotonic()
             await page.evaluate("(d)=>window.render && window.render(d)", params)
+            await _wait_ready(page, tpl_name, inline=not tmp_path,
+                              budget=timeouts["render"] - (time.monotonic() - started))
 
+        async def pdf():
             if helper_mod:
                 pdf_opts = {**DEFAULT_PDF_OPTIONS, **getattr(helper_mod, 'PDF_OPTIONS', {})}
                 header   = await helper_mod.get_header_html(params)
                 footer   = await helper_mod.get_footer_html(params)
             else:
                 pdf_opts, header, footer = DEFAULT_PDF_OPTIONS, "", ""
+            return await page.pdf(**pdf_opts,
+                                  header_template=header,
+                                  footer_template=footer)
 
-            pdf_bytes = await page.pdf(**pdf_opts,
-                                       header_template=header,
-                                       footer_template=footer)
-            await page.close()
-
-            # 5. Upload PDF
-            out_blob = BlobClient(account_url=STORAGE_URL,
-                                  container_name=OUTPUT_CTN,
-                                  blob_name=f"{payload_id}.pdf",
-                                  credential=credential)
-            await out_blob.upload_blob(pdf_bytes, overwrite=True, content_type="application/pdf")
-
-            dur = int((datetime.utcnow() - start).total_seconds() * 1000)
-            await _insert_log(run_id, payload_id, tpl_name, dur, True, None)
-            _log("pdf.done", tpl=tpl_name, pid=payload_id, dur_ms=dur)
-
-        except Exception as exc:
-            dur = int((datetime.utcnow() - start).total_seconds() * 1000)
-            await _insert_log(run_id, payload_id, tpl_name, dur, False, str(exc))
-            _log("pdf.error", tpl=tpl_name, pid=payload_id, err=str(exc))
-            traceback.print_exc()
-            raise
-
-        finally:
-            if tmp_path:
-                with contextlib.suppress(FileNotFoundError):
-                    os.unlink(tmp_path)
+        # a timed-out stage raises out of FLEET.page(), so the page is discarded
+        await _stage("load", load(), timeouts)
+        await _stage("render", render(), timeouts)
+        return await _stage("pdf", pdf(), timeouts)
+
+# ── core render routine ────────────────────────────────────────────────
+async def _render_pdf(payload_id: str, payload: dict | None = None, stamp=None,
+                      enqueued=None, lane: str = "interactive"):
+    run_id, start = str(uuid.uuid4()), datetime.utcnow()
+    tpl_name = "<unknown>"
+    try:
+        # 1. Payload JSON: inline in the message, or claim-check blob
+        if payload is None:
+            blob = clients.blob(PAYLOAD_CTN, payload_id)
+            download = await blob.download_blob()
+            payload  = json.loads(await download.readall())
+            stamp    = download.properties.last_modified
+        tpl_name, params = payload["template"], payload.get("params", {})
+
+        # Idempotency: a duplicate delivery of an already rendered job
+        if stamp and await _is_rendered(payload_id, stamp):
+            _log("pdf.skip", tpl=tpl_name, pid=payload_id, reason="already-rendered")
+            return
+
+        # 2. Take as many render slots as the template weighs, then run the
+        #    job under its overall deadline
+        helper  = _helper(tpl_name) if TPL_RE.fullmatch(tpl_name) else None
+        profile = _profile(helper)
+        async with LIMITER.slot(profile.weight):
+            queue_ms, held = _queue_wait_ms(enqueued, lane), datetime.utcnow()
+            try:
+                await asyncio.wait_for(
+                    _render_job(payload_id, payload, params, tpl_name, helper, profile),
+                    profile.max_seconds)
+            except asyncio.TimeoutError as exc:
+                if isinstance(exc, StageTimeout):
+                    raise
+                raise StageTimeout("total", profile.max_seconds) from None
+            held_ms = int((datetime.utcnow() - held).total_seconds() * 1000)
+
+        dur = int((datetime.utcnow() - start).total_seconds() * 1000)
+        AUDIT.record(run_id, payload_id, tpl_name, dur, True, None)
+        _timings["render_ms"].append(held_ms)
+        LIMITER.observe(tpl_name, held_ms)
+        _log("pdf.done", tpl=tpl_name, pid=payload_id, dur_ms=dur, render_ms=held_ms,
+             queue_ms=queue_ms, weight=profile.weight, lane=lane)
+
+    except Exception as exc:
+        dur = int((datetime.utcnow() - start).total_seconds() * 1000)
+        AUDIT.record(run_id, payload_id, tpl_name, dur, False, str(exc))
+        _log("pdf.error", tpl=tpl_name, pid=payload_id, err=str(exc),
+             stage=getattr(exc, "stage", None))
+        traceback.print_exc()
+        raise
+
+async def _render_job(payload_id: str, payload: dict, params: dict, tpl_name: str,
+                      helper, profile: _Profile) -> None:
+    timeouts = profile.timeouts
+    tmp_path = None
+    try:
+        # 3. Load template + data fetch (unless the API already did it)
+        mod, template, js_path = _load_template(tpl_name)
+        if mod and hasattr(mod, "Report") and not payload.get("fetched"):
+            report = mod.Report(params, SYNC_ENGINE)  # fetch() runs in a thread
+            # the executor thread cannot be interrupted; a timeout frees the slot
+            placeholders = await _stage(
+                "fetch", asyncio.get_running_loop().run_in_executor(None, report.fetch), timeouts)
+            params |= placeholders
+
+        # 4. Render Jinja (auto-escaped, compiled once per file version)
+        rendered = template.render(**params)
+
+        if LOAD_MODE == "file":
+            with tempfile.NamedTemporaryFile("w", suffix=".html", delete=False) as tmp:
+                tmp.write(rendered)
+                tmp_path = tmp.name
+
+        # 5. Playwright – retried once on another shard if the browser dies
+        for attempt in (1, 2):
+            try:
+                pdf_bytes = await _print_pdf(tpl_name, params, rendered, tmp_path, js_path,
+                                             helper, timeouts)
+                break
+            except BrowserCrashed as exc:
+                LIMITER.backoff("crash")
+                if attempt == 2:
+                    raise
+                _log("pdf.retry", tpl=tpl_name, pid=payload_id, err=str(exc))
+
+        # 6. Upload PDF
+        out_blob = clients.blob(OUTPUT_CTN, f"{payload_id}.pdf")
+        await _stage("upload", out_blob.upload_blob(pdf_bytes, overwrite=True,
+                                                    content_type="application/pdf"), timeouts)
+    finally:
+        if tmp_path:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp_path)
 
 # ── queue consumer loop ────────────────────────────────────────────────
-async def _handle_msg(receiver, msg):
+def _parse_job(msg) -> tuple[str, dict | None, datetime | None]:
+    """
+    Returns (payload_id, inline payload or None, payload timestamp).
+    content_type application/json | application/gzip → payload in the body;
+    anything else → the body is the payload blob name (claim-check).
+    """
+    body = msg.body
+    if not isinstance(body, (bytes, bytearray, str)):
+        body = b"".join(body)
+    if msg.content_type in ("application/json", "application/gzip"):
+        if msg.content_type == "application/gzip":
+            body = gzip.decompress(body)
+        payload = json.loads(body)
+        return payload.pop("id", None) or msg.message_id, payload, msg.enqueued_time_utc
+    return (body.decode() if isinstance(body, (bytes, bytearray)) else body), None, None
+
+def _queue_wait_ms(enqueued: datetime | None, lane: str) -> int | None:
+    """Enqueue → render start: broker backlog plus local wait for a slot."""
+    if enqueued is None:
+        return None
+    if enqueued.tzinfo is None:
+        enqueued = enqueued.replace(tzinfo=timezone.utc)
+    ms = max(int((datetime.now(timezone.utc) - enqueued).total_seconds() * 1000), 0)
+    _timings[f"queue_wait_ms_{lane}"].append(ms)
+    return ms
+
+class _Settler:
+    """
+    Settlements requested within *linger* seconds of each other go out as one
+    concurrent round instead of one awaited round trip per message.
+    """
+
+    def __init__(self, receiver, linger: float):
+        self._receiver = receiver
+        self._linger   = linger
+        self._pending: list[tuple] = []
+        self._flusher: asyncio.Task | None = None
+        self.stats = {"settled": 0, "rounds": 0, "errors": 0}
+
+    async def __call__(self, action: str, msg, **kwargs) -> None:
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((action, msg, kwargs, fut))
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush())
+        await fut
+
+    async def _flush(self) -> None:
+        await asyncio.sleep(self._linger)
+        batch, self._pending, self._flusher = self._pending, [], None
+        results = await asyncio.gather(
+            *(getattr(self._receiver, f"{action}_message")(msg, **kw)
+              for action, msg, kw, _ in batch),
+            return_exceptions=True)
+        self.stats["rounds"] += 1
+        for (*_, fut), res in zip(batch, results):
+            if isinstance(res, BaseException):
+                self.stats["errors"] += 1
+                fut.set_exception(res)
+            else:
+                self.stats["settled"] += 1
+                fut.set_result(None)
+
+SETTLERS: dict[str, _Settler] = {}                 # lane → settler of its receiver
+
+async def _handle_msg(settle: _Settler, msg, lane: str):
     try:
-        pid = msg.body.decode() if isinstance(msg.body, (bytes, bytearray)) else msg.body
-        await _render_pdf(pid)
-        await receiver.complete_message(msg)
+        await _render_pdf(*_parse_job(msg), enqueued=msg.enqueued_time_utc, lane=lane)
+        action, kwargs = "complete", {}
+    except BrowserCrashed:
+        # likely not the job's fault: we never dead-letter it ourselves, but
+        # abandon still counts a delivery, so a job that keeps crashing the
+        # browser is dead-lettered by the queue's own max delivery count
+        action, kwargs = "abandon", {}
     except Exception:
         if msg.delivery_count >= MAX_DELIVERY:
-            await receiver.dead_letter_message(msg, reason="render-failed", error_description="max attempts")
+            action, kwargs = "dead_letter", {"reason": "render-failed",
+                                             "error_description": "max attempts"}
         else:
-            await receiver.abandon_message(msg)
-    finally:
-        _active_tasks.discard(asyncio.current_task())
+            action, kwargs = "abandon", {}
+    try:
+        await settle(action, msg, **kwargs)
+    except Exception as exc:                     # lock lost – the broker redelivers
+        _log("sb.settle_error", action=action, mid=msg.message_id, err=str(exc))
+
+def _task_done(task: asyncio.Task) -> None:
+    _active_tasks.pop(task, None)
+    _slot_freed.set()
+
+def _msg_weight(msg) -> int:
+    """Resource weight from the ``template`` application property (set by the API)."""
+    props = msg.application_properties or {}
+    tpl   = props.get(b"template", props.get("template"))
+    if isinstance(tpl, bytes):
+        tpl = tpl.decode(errors="ignore")
+    if not tpl or not TPL_RE.fullmatch(tpl):
+        return 1
+    return min(max(_profile(_helper(tpl)).weight, 1), LIMITER.limit)
+
+def _committed(lane: str | None = None) -> int:
+    return sum(w for l, w in _active_tasks.values() if lane is None or l == lane)
+
+_last_interactive = 0.0
+
+def _allowance(lane: str) -> int:
+    """
+    Slots a lane may fill now.  Interactive work may take every free slot;
+    bulk may too while interactive has been idle for LANE_IDLE seconds, and
+    is otherwise held to its 1 : SB_INTERACTIVE_WEIGHT share of the limit.
+    """
+    free = LIMITER.limit - _committed()
+    if lane == "interactive" or BULK_QUEUE == SB_QUEUE:
+        return free
+    busy = _committed("interactive") or time.monotonic() - _last_interactive < LANE_IDLE
+    if not busy:
+        return free
+    share = max(LIMITER.limit // (LANE_WEIGHT + 1), 1)
+    return min(free, share - _committed("bulk"))
+
+async def _lane_consumer(lane: str, queue: str):
+    """
+    Receives only as many messages as the lane's allowance of free render
+    slots, so no message sits locked in the process waiting for a page.
+    Prefetch stays off: a prefetched message is locked but its lock is not
+    renewed until it is handed out.  Accepted jobs count with their
+    template's weight.
+    """
+    global _last_interactive
+    receiver = clients.servicebus().get_queue_receiver(
+        queue,
+        prefetch_count=0,                          # receive exactly `free` messages
+        max_auto_lock_renewal_duration=timedelta(minutes=10),
+    )
+    async with receiver:
+        settle = SETTLERS[lane] = _Settler(receiver, SETTLE_WAIT)
+        while not stop_event.is_set():
+            free = _allowance(lane)
+            if free <= 0:
+                _slot_freed.clear()
+                await _slot_freed.wait()
+                continue
+            msgs = await receiver.receive_messages(max_message_count=free, max_wait_time=5)
+            if msgs and lane == "interactive":
+                _last_interactive = time.monotonic()
+            for msg in msgs:
+                task = asyncio.create_task(_handle_msg(settle, msg, lane))
+                _active_tasks[task] = (lane, _msg_weight(msg))
+                task.add_done_callback(_task_done)
 
 async def _sb_consumer():
-    async with ServiceBusClient(f"{SB_NAMESPACE}.servicebus.windows.net", credential=credential) as sb:
-        receiver = sb.get_queue_receiver(
-            SB_QUEUE,
-            max_wait_time=5,
-            max_auto_lock_renewal_duration=timedelta(minutes=10),
-        )
-        async with receiver:
-            async for msg in receiver:
-                if stop_event.is_set():
-                    break
-                task = asyncio.create_task(_handle_msg(receiver, msg))
-                _active_tasks.add(task)
-    if _active_tasks:
-        await asyncio.gather(*_active_tasks, return_exceptions=True)
+    lanes = {"interactive": SB_QUEUE}
+    if BULK_QUEUE != SB_QUEUE:
+        lanes["bulk"] = BULK_QUEUE
+    try:
+        await asyncio.gather(*(_lane_consumer(l, q) for l, q in lanes.items()))
+    finally:
+        if _active_tasks:
+            await asyncio.gather(*_active_tasks, return_exceptions=True)
+
+# ── asset cache warm-up ────────────────────────────────────────────────
+_URL_RE = re.compile(r"https://[^\s\"'<>)]+")
+
+async def _preload_assets(p) -> None:
+    """Fetch CDN assets referenced by mounted templates (plus ASSET_PRELOAD_URLS)."""
+    urls = list(ASSET_URLS)
+    for html in TEMPLATE_DIR.glob("*.html"):
+        urls += _URL_RE.findall(html.read_text(errors="ignore"))
+    async with FLEET.page() as page:         # type: ignore[union-attr]
+        ua = await page.evaluate("navigator.userAgent")   # Google Fonts varies by UA
+    req = await p.request.new_context(user_agent=ua)
+    try:
+        await ASSETS.preload(req, urls)      # type: ignore[union-attr]
+    finally:
+        await req.dispose()
+    _log("assets.preload", **ASSETS.stats())  # type: ignore[union-attr]
+
+# ── periodic metrics ───────────────────────────────────────────────────
+def _stats() -> dict:
+    return {"browsers":  FLEET.stats() if FLEET else {},
+            "assets":    ASSETS.stats() if ASSETS else {},
+            "templates": template_cache.stats(),
+            "sql_token": SQL_TOKEN.stats(),
+            "audit":     AUDIT.stats() if AUDIT else {},
+            "charts":    CHARTS.SERVICE.stats() if CHARTS else {},
+            "report_cache": DATA.CACHE.stats() if DATA else {},
+            "fragments": FRAGS.FRAGMENTS.stats() if FRAGS else {},
+            "settle":    {lane: st.stats for lane, st in SETTLERS.items()},
+            "lanes":     {"interactive": _committed("interactive"), "bulk": _committed("bulk")},
+            "concurrency": LIMITER.stats(),
+            **{k: _summary(v) for k, v in _timings.items()}}
+
+def _summary(values: list[float]) -> dict:
+    if not values:
+        return {"n": 0}
+    v = sorted(values)
+    return {"n": len(v), "avg": round(sum(v) / len(v)),
+            "p95": v[int(0.95 * (len(v) - 1))], "max": v[-1]}
+
+async def _controller():
+    """Feeds Chromium RSS and node CPU to the limiter every ADAPT_EVERY seconds."""
+    prev = cpu_times()
+    while not stop_event.is_set():
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(stop_event.wait(), ADAPT_EVERY)
+        cur = cpu_times()
+        cpu = (cur[0] - prev[0]) / (cur[1] - prev[1]) if cur[1] > prev[1] else None
+        prev  = cur
+        limit = LIMITER.limit
+        LIMITER.adjust(FLEET.rss() if FLEET else 0, cpu)
+        if LIMITER.limit != limit:
+            _log("worker.concurrency", old=limit, **LIMITER.stats())
+        _slot_freed.set()                            # consumer re-reads the limit
+
+async def _stats_reporter():
+    while not stop_event.is_set():
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(stop_event.wait(), STATS_EVERY)
+        _log("worker.stats", **_stats())
+        for values in _timings.values():             # latencies are per interval
+            values.clear()
 
 async def main():
-    global BROWSER
-    _log("worker.start", concurrency=CONCURRENCY)
+    global FLEET, ASSETS, AUDIT, CHARTS, DATA, FRAGS
+    # here, not at import: chart pool processes re-import this module as __mp_main__
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop_event.set())
+    _log("worker.start", concurrency=CONCURRENCY, concurrency_min=MIN_RENDERS,
+         concurrency_max=MAX_RENDERS, shards=SHARDS, page_pool=POOL_SIZE)
+    SQL_TOKEN.start()                                 # token ready before the first job
+    AUDIT = AuditSink(ASYNC_ENGINE, AUDIT_TABLE, max_queue=AUDIT_QUEUE,
+                      batch_size=AUDIT_BATCH, flush_every=AUDIT_FLUSH,
+                      spool_dir=AUDIT_SPOOL, log=_log)
+    AUDIT.start()
+    CHARTS = _shared("chart_service")
+    DATA   = _shared("report_data")
+    FRAGS  = _shared("fragment_cache")
+    if CHARTS:
+        CHARTS.SERVICE.start()                        # warm chart processes spawn now
     async with async_playwright() as p:
-        BROWSER = await p.chromium.launch(args=["--no-sandbox"])
+        ASSETS = AssetCache(ASSET_DIR, ASSET_HOSTS, offline=OFFLINE)
+        FLEET  = BrowserFleet(p.chromium, SHARDS, POOL_SIZE, PAGE_MAX_USE,
+                              RECYCLE_N, MAX_RSS_MB, log=_log, setup=ASSETS.install)
+        await FLEET.start()
+        await _preload_assets(p)
+        reporter = asyncio.create_task(_stats_reporter())
+        control  = asyncio.create_task(_controller())
         consumer = asyncio.create_task(_sb_consumer())
         await stop_event.wait()
         consumer.cancel()
         with contextlib.suppress(asyncio.CancelledError):
             await consumer
-        await BROWSER.close()
+        await reporter
+        await control
+        await FLEET.close()
+    await AUDIT.close()                               # drain buffered audit rows
+    if CHARTS:
+        await asyncio.get_running_loop().run_in_executor(None, CHARTS.SERVICE.close)
+    await clients.close()
     _log("worker.stop")
 
-for sig in (signal.SIGINT, signal.SIGTERM):
-    signal.signal(sig, lambda *_: stop_event.set())
-
 if __name__ == "__main__":
     asyncio.run(main())